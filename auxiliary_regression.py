@@ -50,6 +50,7 @@ parser.add_argument('--num_channels', type=int, default=3, metavar='N')
 parser.add_argument('--img_size', type=int, default=64)
 parser.add_argument('--max_num_img_per_label', type=int, default=2**20, metavar='N')
 parser.add_argument('--num_img_per_label_after_replica', type=int, default=0, metavar='N')
+parser.add_argument('--data_backend', type=str, default='ram', choices=['ram', 'h5', 'memmap'])
 
 parser.add_argument('--net_name', type=str, default='resnet18',
                     help='CNN for training; ResNetXX')
@@ -95,7 +96,7 @@ with open(setting_log_file, 'a') as logging_file:
 '''                                Make dataset                                     '''
 #######################################################################################
 
-dataset = LoadDataSet(data_name=args.data_name, data_path=args.data_path, min_label=args.min_label, max_label=args.max_label, img_size=args.img_size, max_num_img_per_label=args.max_num_img_per_label, num_img_per_label_after_replica=args.num_img_per_label_after_replica, imbalance_type=args.imb_type)
+dataset = LoadDataSet(data_name=args.data_name, data_path=args.data_path, min_label=args.min_label, max_label=args.max_label, img_size=args.img_size, max_num_img_per_label=args.max_num_img_per_label, num_img_per_label_after_replica=args.num_img_per_label_after_replica, imbalance_type=args.imb_type, backend=args.data_backend)
     
 train_images, train_labels, train_labels_norm = dataset.load_train_data()
 num_classes = dataset.num_classes
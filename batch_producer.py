@@ -0,0 +1,61 @@
+"""
+Background producer of training batches.
+
+Worker threads prepare the host side of the next training iterations (target labels, vicinities, fake labels, vicinal weights and, if needed, the augmented real images) while the current step runs on the device.
+Each worker has its own `np.random.Generator` spawned from the experiment seed and its own bounded queue; batches are consumed round-robin over the workers, so the sequence of batches only depends on the seed, not on thread timing.
+
+"""
+
+import threading
+import queue
+import numpy as np
+
+
+class BatchProducer:
+    def __init__(self, fn_make_batch, num_workers=1, num_prefetch=2, seed=123):
+        """
+        fn_make_batch: fn_make_batch(rng) returns one batch, drawing all random numbers from the np.random.Generator rng
+        num_workers: number of worker threads
+        num_prefetch: number of batches prepared ahead of the consumer, shared among the workers
+        seed: experiment seed; worker k uses the k-th child of np.random.SeedSequence(seed)
+        """
+        self.fn_make_batch = fn_make_batch
+        self.num_workers = max(1, num_workers)
+        self.queues = [queue.Queue(maxsize=max(1, int(np.ceil(num_prefetch/self.num_workers)))) for _ in range(self.num_workers)]
+        self.rngs = [np.random.default_rng(s) for s in np.random.SeedSequence(seed).spawn(self.num_workers)]
+        self.stop_event = threading.Event()
+        self.next_worker = 0
+        self.threads = [threading.Thread(target=self._worker, args=(k,), daemon=True) for k in range(self.num_workers)]
+        for t in self.threads:
+            t.start()
+
+    def _worker(self, k):
+        while not self.stop_event.is_set():
+            try:
+                batch = self.fn_make_batch(self.rngs[k])
+            except Exception as e: #hand the error to the consumer
+                batch = e
+            while not self.stop_event.is_set():
+                try:
+                    self.queues[k].put(batch, timeout=0.1)
+                    break
+                except queue.Full:
+                    continue
+            if isinstance(batch, Exception):
+                return
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        batch = self.queues[self.next_worker].get()
+        self.next_worker = (self.next_worker + 1) % self.num_workers
+        if isinstance(batch, Exception):
+            self.close()
+            raise batch
+        return batch
+
+    def close(self):
+        self.stop_event.set()
+        for t in self.threads:
+            t.join()
@@ -0,0 +1,124 @@
+"""
+Benchmark for LoadDataSet.load_train_data on a synthetic label set.
+
+It writes a UTKFace-, Cell200- and SteeringAngle-like h5 file with tiny images to a temporary folder, runs the former per-label loops (one np.where scan per label, repeated np.concatenate of replicated images) and the grouped implementation in dataset.py with the same seed, checks that images, labels and the np.random state afterwards are identical, and reports both run times.
+
+Usage: python benchmarks/bench_dataset.py [--n_images 200000] [--img_size 4]
+"""
+
+import os
+import sys
+import argparse
+import tempfile
+import timeit
+import h5py
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from dataset import LoadDataSet, clear_data_cache
+
+
+## the former per-label loops of load_train_data
+def legacy_cap(images, labels, max_num_img_per_label):
+    sel_indx = []
+    unique_labels = np.sort(np.array(list(set(labels))))
+    for i in range(len(unique_labels)):
+        indx_i = np.where(labels == unique_labels[i])[0]
+        if len(indx_i)>max_num_img_per_label:
+            np.random.shuffle(indx_i)
+            indx_i = indx_i[0:max_num_img_per_label]
+        sel_indx.append(indx_i)
+    sel_indx = np.concatenate(sel_indx)
+    return images[sel_indx], labels[sel_indx]
+
+def legacy_select(images_all, labels_all, selected_labels):
+    images, labels = [], []
+    for curr_label in selected_labels:
+        index_curr_label = np.where(labels_all==curr_label)[0]
+        images.append(images_all[index_curr_label])
+        labels.append(labels_all[index_curr_label])
+    return np.concatenate(images, axis=0), np.concatenate(labels)
+
+def legacy_replicate(images, labels, max_num_img_per_label_after_replica):
+    unique_labels_replica = np.sort(np.array(list(set(labels))))
+    num_labels_replicated = 0
+    for curr_label in unique_labels_replica:
+        indx_i = np.where(labels == curr_label)[0]
+        if len(indx_i) < max_num_img_per_label_after_replica:
+            num_img_less = int(max_num_img_per_label_after_replica - len(indx_i))
+            indx_replica = np.random.choice(indx_i, size = num_img_less, replace=True)
+            if num_labels_replicated == 0:
+                images_replica = images[indx_replica]
+                labels_replica = labels[indx_replica]
+            else:
+                images_replica = np.concatenate((images_replica, images[indx_replica]), axis=0)
+                labels_replica = np.concatenate((labels_replica, labels[indx_replica]))
+            num_labels_replicated+=1
+    return np.concatenate((images, images_replica), axis=0), np.concatenate((labels, labels_replica))
+
+def legacy_load_train_data(data_name, images_all, labels_all, min_label, max_label, max_num_img_per_label, num_img_per_label_after_replica):
+    if data_name == "UTKFace":
+        images, labels = legacy_select(images_all, labels_all, np.arange(min_label, max_label+1))
+        images, labels = legacy_cap(images, labels, max_num_img_per_label)
+        images, labels = legacy_replicate(images, labels, min(num_img_per_label_after_replica, max_num_img_per_label))
+    elif data_name == "Cell200":
+        images, labels = legacy_select(images_all, labels_all, np.arange(min_label, max_label+1))
+        images_subset, labels_subset = [], []
+        for curr_label in np.arange(min_label, max_label+1, 2):
+            index_curr_label = np.where(labels==curr_label)[0]
+            images_subset.append(images[index_curr_label[0:min(max_num_img_per_label, len(index_curr_label))]])
+            labels_subset.append(labels[index_curr_label[0:min(max_num_img_per_label, len(index_curr_label))]])
+        images, labels = np.concatenate(images_subset, axis=0), np.concatenate(labels_subset)
+    else:
+        indx = np.where((labels_all>min_label)*(labels_all<max_label)==True)[0]
+        images, labels = legacy_replicate(images_all[indx], labels_all[indx], min(num_img_per_label_after_replica, max_num_img_per_label))
+    return images, labels
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--n_images', type=int, default=200000)
+    parser.add_argument('--img_size', type=int, default=4)
+    parser.add_argument('--seed', type=int, default=2025)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    n = args.n_images
+    settings = {
+        ## name: (image key, label key, channels, labels, min_label, max_label, max_num_img_per_label, num_img_per_label_after_replica)
+        "UTKFace": ("images", "labels", 3, np.minimum(rng.geometric(0.03, n), 200).astype(float), 1, 200, 1500, 400),
+        "Cell200": ("IMGs_grey", "CellCounts", 1, rng.integers(1, 201, n).astype(float), 1, 200, 500, 0),
+        "SteeringAngle": ("images", "labels", 3, np.round(rng.normal(0, 25, n), 2), -80, 80, 2**20, 20),
+    }
+
+    print("{:>14} {:>10} {:>12} {:>12} {:>9}".format("dataset", "N", "loop (s)", "grouped (s)", "speedup"))
+    with tempfile.TemporaryDirectory() as data_path:
+        for data_name, (key_img, key_label, nc, labels, min_label, max_label, max_num, num_replica) in settings.items():
+            images = rng.integers(0, 256, (n, nc, args.img_size, args.img_size), dtype=np.uint8)
+            with h5py.File(os.path.join(data_path, "{}_{}x{}.h5".format(data_name, args.img_size, args.img_size)), "w") as hf:
+                hf.create_dataset(key_img, data=images)
+                hf.create_dataset(key_label, data=labels)
+
+            np.random.seed(args.seed)
+            start = timeit.default_timer()
+            images_ref, labels_ref = legacy_load_train_data(data_name, images, labels, min_label, max_label, max_num, num_replica)
+            time_loop = timeit.default_timer() - start
+            state_ref = np.random.get_state()[1].copy()
+
+            clear_data_cache()
+            sys.stdout = open(os.devnull, "w")
+            dataset = LoadDataSet(data_name, data_path, min_label, max_label, img_size=args.img_size, max_num_img_per_label=max_num, num_img_per_label_after_replica=num_replica)
+            np.random.seed(args.seed)
+            start = timeit.default_timer()
+            images_new, labels_new, _ = dataset.load_train_data()
+            time_grouped = timeit.default_timer() - start
+            sys.stdout = sys.__stdout__
+
+            ## identical selection, order and random state for the same seed
+            assert np.array_equal(images_ref, images_new) and np.array_equal(labels_ref, labels_new)
+            assert np.array_equal(state_ref, np.random.get_state()[1])
+            print("{:>14} {:>10} {:>12.3f} {:>12.3f} {:>8.1f}x".format(data_name, n, time_loop, time_grouped, time_loop/time_grouped))
+
+
+if __name__ == "__main__":
+    main()
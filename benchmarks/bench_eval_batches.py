@@ -0,0 +1,123 @@
+"""
+Benchmark for the batch path of the evaluation metrics.
+
+It runs the label score, the class predictions and the inception score on synthetic uint8 images with small convolutional networks, once through the former IMGs_dataset + DataLoader loops (per-item __getitem__, collate, float64 normalization, per-batch gc/empty_cache) and once through the functions in evaluation/eval_metrics.py (contiguous slices, on-device normalization, shared prefetch thread), checks that both give the same results, and reports images/s per metric.
+
+Usage: python benchmarks/bench_eval_batches.py [--n_images 20000] [--img_size 64] [--device cuda]
+"""
+
+import os
+import sys
+import gc
+import argparse
+import timeit
+import contextlib
+import io
+import numpy as np
+import torch
+import torch.nn as nn
+from torch.nn import functional as F
+from scipy.stats import entropy
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from utils import IMGs_dataset
+from evaluation.eval_metrics import cal_labelscore, predict_class_labels, inception_score, normalize_images
+
+
+class TinyNet(nn.Module):
+    def __init__(self, num_outputs):
+        super().__init__()
+        self.conv = nn.Sequential(nn.Conv2d(3, 8, 4, 4), nn.ReLU(), nn.AdaptiveAvgPool2d(1))
+        self.linear = nn.Linear(8, num_outputs)
+    def forward(self, x):
+        features = self.conv(x).flatten(1)
+        return self.linear(features), features
+
+
+## the former DataLoader-based loops
+def legacy_labelscore(PreNet, images, labels_assi, batch_size, device):
+    PreNet.eval()
+    n = len(images)
+    dataloader = torch.utils.data.DataLoader(IMGs_dataset(images, labels_assi, normalize=False), batch_size=batch_size, shuffle=False)
+    labels_pred = np.zeros(n+batch_size)
+    nimgs_got = 0
+    for batch_images, batch_labels in dataloader:
+        batch_images = normalize_images(batch_images.type(torch.float).to(device))
+        batch_labels_pred, _ = PreNet(batch_images)
+        labels_pred[nimgs_got:(nimgs_got+len(batch_labels))] = batch_labels_pred.detach().cpu().numpy().reshape(-1)
+        nimgs_got += len(batch_labels)
+        del batch_images; gc.collect()
+        torch.cuda.empty_cache()
+    labels_pred = labels_pred[0:n]
+    return np.mean(np.abs(labels_pred-labels_assi)), np.std(np.abs(labels_pred-labels_assi))
+
+def legacy_predict_class_labels(net, images, batch_size, device):
+    net.eval()
+    n = len(images)
+    dataloader = torch.utils.data.DataLoader(IMGs_dataset(images, normalize=False), batch_size=batch_size, shuffle=False)
+    class_labels_pred = np.zeros(n+batch_size)
+    with torch.no_grad():
+        nimgs_got = 0
+        for batch_images in dataloader:
+            outputs, _ = net(batch_images.type(torch.float).to(device))
+            class_labels_pred[nimgs_got:(nimgs_got+len(batch_images))] = torch.max(outputs.data, 1)[1].cpu().numpy()
+            nimgs_got += len(batch_images)
+    return class_labels_pred[0:n]
+
+def legacy_inception_score(imgs, num_classes, net, batch_size, splits, device):
+    N = len(imgs)
+    dataloader = torch.utils.data.DataLoader(IMGs_dataset(imgs, labels=None, normalize=True), batch_size=batch_size)
+    net.eval()
+    preds = np.zeros((N, num_classes))
+    for i, batch in enumerate(dataloader):
+        x, _ = net(batch.float().to(device))
+        preds[i*batch_size:i*batch_size + len(batch)] = F.softmax(x, dim=1).data.cpu().numpy()
+    split_scores = []
+    for k in range(splits):
+        part = preds[k * (N // splits): (k+1) * (N // splits), :]
+        py = np.mean(part, axis=0)
+        split_scores.append(np.exp(np.mean([entropy(part[i, :], py) for i in range(part.shape[0])])))
+    return np.mean(split_scores), np.std(split_scores)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--n_images', type=int, default=20000)
+    parser.add_argument('--img_size', type=int, default=64)
+    parser.add_argument('--batch_size', type=int, default=200)
+    parser.add_argument('--device', type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument('--seed', type=int, default=2025)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    torch.manual_seed(args.seed)
+    images = rng.integers(0, 256, (args.n_images, 3, args.img_size, args.img_size), dtype=np.uint8)
+    images_norm = ((images/255.0-0.5)/0.5).astype(np.float32) #the class predictions take normalized images
+    labels = rng.uniform(0, 1, args.n_images)
+    net_ls, net_class = TinyNet(1).to(args.device), TinyNet(5).to(args.device)
+
+    def timed(fn):
+        start = timeit.default_timer()
+        with contextlib.redirect_stdout(io.StringIO()):
+            out = fn()
+        return out, args.n_images/(timeit.default_timer()-start)
+
+    print("{:>16} {:>14} {:>14} {:>9}".format("metric", "before (img/s)", "after (img/s)", "speedup"))
+    with torch.no_grad():
+        runs = {
+            "label score": (lambda: legacy_labelscore(net_ls, images, labels, args.batch_size, args.device),
+                            lambda: cal_labelscore(net_ls, images, labels, 0, 1, batch_size=args.batch_size, norm_img=True, device=args.device)),
+            "class labels": (lambda: legacy_predict_class_labels(net_class, images_norm, args.batch_size, args.device),
+                             lambda: predict_class_labels(net_class, images_norm, batch_size=args.batch_size, device=args.device)),
+            "inception score": (lambda: legacy_inception_score(images, 5, net_class, args.batch_size, 10, args.device),
+                                lambda: inception_score(images, 5, net_class, batch_size=args.batch_size, splits=10, normalize_img=True, device=args.device)),
+        }
+        for name, (fn_before, fn_after) in runs.items():
+            out_before, speed_before = timed(fn_before)
+            out_after, speed_after = timed(fn_after)
+            assert np.allclose(np.asarray(out_before, dtype=float), np.asarray(out_after, dtype=float), rtol=1e-4, atol=1e-5), name
+            print("{:>16} {:>14.0f} {:>14.0f} {:>8.1f}x".format(name, speed_before, speed_after, speed_after/speed_before))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+"""
+Benchmark for the NIQE pipeline of evaluation/niqe.py.
+
+It fits a NIQE model to synthetic uint8 images once block by block and image by image (as the reference implementation loops over blocks) and once with all blocks of a batch of images at a time, optionally over --num_workers processes, checks that both give the same model, and reports images/s for fitting and for scoring.
+
+Usage: python benchmarks/bench_niqe.py [--n_images 1000] [--img_size 64] [--block_size 8] [--num_workers 0]
+"""
+
+import os
+import sys
+import argparse
+import timeit
+import numpy as np
+from scipy import ndimage
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from evaluation.niqe import rgb2gray, mscn, imresize, block_features, fit_niqe_model, niqe_scores
+
+
+## features of the sharp blocks of one image, one block at a time
+def loop_features(image, bs, sharpness_threshold):
+    gray = rgb2gray(image[None])[0]
+    feats, sharpness = [], []
+    for scale in [1, 2]:
+        structdis, sigma = mscn(gray[None])
+        b = bs//scale
+        feats_scale = []
+        for i in range(0, structdis.shape[1], b):
+            for j in range(0, structdis.shape[2], b):
+                feats_scale.append(block_features(structdis[0, i:(i+b), j:(j+b)]))
+                if scale == 1:
+                    sharpness.append(sigma[0, i:(i+b), j:(j+b)].mean())
+        feats.append(np.array(feats_scale))
+        gray = imresize(gray[None], 0.5)[0]
+    sharpness = np.array(sharpness)
+    return np.hstack(feats)[sharpness > sharpness_threshold*sharpness.max()]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--n_images', type=int, default=1000)
+    parser.add_argument('--img_size', type=int, default=64)
+    parser.add_argument('--block_size', type=int, default=8)
+    parser.add_argument('--num_workers', type=int, default=0)
+    parser.add_argument('--seed', type=int, default=2025)
+    args = parser.parse_args()
+
+    ## smooth images with noise, so that the blocks differ in sharpness
+    rng = np.random.default_rng(args.seed)
+    coarse = rng.uniform(0, 255, (args.n_images, 3, args.img_size//4, args.img_size//4))
+    images = np.clip(ndimage.zoom(coarse, (1, 1, 4, 4), order=3) + rng.normal(0, 8, (args.n_images, 3, args.img_size, args.img_size)), 0, 255).astype(np.uint8)
+
+    start = timeit.default_timer()
+    feats = np.vstack([loop_features(image, args.block_size, 0.1) for image in images])
+    mu_ref = np.nanmean(feats, axis=0)
+    cov_ref = np.cov(feats[~np.isnan(feats).any(axis=1)], rowvar=False)
+    time_ref = timeit.default_timer() - start
+
+    start = timeit.default_timer()
+    model = fit_niqe_model(images, args.block_size, 0.1, num_workers=args.num_workers, verbose=False)
+    time_new = timeit.default_timer() - start
+
+    assert np.allclose(model["Mean"], mu_ref, rtol=1e-9, atol=1e-12)
+    assert np.allclose(model["Covariance"], cov_ref, rtol=1e-7, atol=1e-10*np.abs(cov_ref).max())
+    print("fit: {:.0f} img/s block by block; {:.0f} img/s batched; speedup {:.1f}x".format(args.n_images/time_ref, args.n_images/time_new, time_ref/time_new))
+
+    start = timeit.default_timer()
+    scores = niqe_scores(images, model, num_workers=args.num_workers)
+    print("score: {:.0f} img/s; NIQE of the training images {:.3f} ({:.3f})".format(args.n_images/(timeit.default_timer()-start), np.nanmean(scores), np.nanstd(scores)))
+
+
+if __name__ == "__main__":
+    main()
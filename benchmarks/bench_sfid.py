@@ -0,0 +1,82 @@
+"""
+Benchmark for the sliding FID (SFID) over label windows.
+
+It draws SteeringAngle-like labels and synthetic features, evaluates the Frechet distance of 1000 overlapping windows (radius 2.0) once with `FID` on the rows of each window and once with the running sufficient statistics of `sliding_window_stats`, checks that both give the same distances, and reports both run times.
+
+With --num_workers, the batched path of compute_metrics (real_window_stats + sliding_FID) is timed in one process and sharded over worker processes.
+
+Usage: python benchmarks/bench_sfid.py [--n_real 12000] [--n_fake 100000] [--dim 64] [--num_workers 0]
+"""
+
+import os
+import sys
+import argparse
+import timeit
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from evaluation.eval_metrics import FID, frechet_distance, sliding_window_stats, real_window_stats, sliding_FID
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--n_real', type=int, default=12000)
+    parser.add_argument('--n_fake', type=int, default=100000)
+    parser.add_argument('--dim', type=int, default=64)
+    parser.add_argument('--num_centers', type=int, default=1000)
+    parser.add_argument('--radius', type=float, default=2.0)
+    parser.add_argument('--num_workers', type=int, default=0, help='if > 1, also time the batched sliding FID with centers sharded over this many processes')
+    parser.add_argument('--seed', type=int, default=2025)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    real_labels = np.round(np.clip(rng.normal(0, 25, args.n_real), -80, 80), 2)
+    fake_labels = np.repeat(np.linspace(-80, 80, args.n_fake//50), 50)
+    ## features drift with the label so that the windows differ
+    mixing = rng.normal(size=(args.dim, args.dim))/np.sqrt(args.dim)
+    real_features = (rng.normal(size=(args.n_real, args.dim)) + np.outer(real_labels/80, np.ones(args.dim))).dot(mixing).astype(np.float32) + 5
+    fake_features = (rng.normal(size=(len(fake_labels), args.dim)) + np.outer(fake_labels/80, np.ones(args.dim))*1.1).dot(mixing).astype(np.float32) + 5
+    centers = np.linspace(real_labels.min()+args.radius, real_labels.max()-args.radius, args.num_centers)
+
+    ## per-window FID, as compute_metrics did before
+    start = timeit.default_timer()
+    fids_ref = np.zeros(len(centers))
+    for i, center in enumerate(centers):
+        indx_real = np.where((real_labels>=center-args.radius)*(real_labels<=center+args.radius)==True)[0]
+        indx_fake = np.where((fake_labels>=center-args.radius)*(fake_labels<=center+args.radius)==True)[0]
+        fids_ref[i] = FID(real_features[indx_real].astype(np.float64), fake_features[indx_fake].astype(np.float64), eps=1e-6)
+    time_ref = timeit.default_timer() - start
+
+    ## running sufficient statistics over label-sorted features
+    start = timeit.default_timer()
+    order_real = np.argsort(real_labels, kind="stable")
+    order_fake = np.argsort(fake_labels, kind="stable")
+    stats_real = sliding_window_stats(real_features, np.searchsorted(real_labels[order_real], centers-args.radius, side="left"), np.searchsorted(real_labels[order_real], centers+args.radius, side="right"), order=order_real)
+    stats_fake = sliding_window_stats(fake_features, np.searchsorted(fake_labels[order_fake], centers-args.radius, side="left"), np.searchsorted(fake_labels[order_fake], centers+args.radius, side="right"), order=order_fake)
+    fids_new = np.zeros(len(centers))
+    for i in range(len(centers)):
+        _, MUr, SIGMAr = next(stats_real)
+        _, MUg, SIGMAg = next(stats_fake)
+        fids_new[i] = frechet_distance(MUr, SIGMAr, MUg, SIGMAg, eps=1e-6)
+    time_new = timeit.default_timer() - start
+
+    max_rel_err = np.max(np.abs(fids_new-fids_ref)/np.maximum(np.abs(fids_ref), 1e-12))
+    assert np.allclose(fids_new, fids_ref, rtol=1e-6, atol=1e-8), max_rel_err
+    print("SFID: {:.6f} (windows) vs {:.6f} (running statistics); max relative error {:.2e}".format(fids_ref.mean(), fids_new.mean(), max_rel_err))
+    print("per-window FID: {:.3f} s; running statistics: {:.3f} s; speedup {:.1f}x".format(time_ref, time_new, time_ref/time_new))
+
+    if args.num_workers>1:
+        lo_real, hi_real = np.searchsorted(real_labels[order_real], centers-args.radius, side="left"), np.searchsorted(real_labels[order_real], centers+args.radius, side="right")
+        lo_fake, hi_fake = np.searchsorted(fake_labels[order_fake], centers-args.radius, side="left"), np.searchsorted(fake_labels[order_fake], centers+args.radius, side="right")
+        times = []
+        for num_workers in [0, args.num_workers]:
+            start = timeit.default_timer()
+            real_stats = real_window_stats(real_features, lo_real, hi_real, order=order_real, num_workers=num_workers)
+            fids = sliding_FID(real_stats, fake_features, lo_fake, hi_fake, order=order_fake, num_workers=num_workers)
+            times.append(timeit.default_timer() - start)
+            assert np.allclose(fids, fids_ref, rtol=1e-5, atol=1e-8)
+        print("batched sliding FID: {:.3f} s in one process; {:.3f} s with {} workers; speedup {:.1f}x".format(times[0], times[1], args.num_workers, times[0]/times[1]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,259 @@
+"""
+Benchmark for the training step of Trainer.
+
+It trains a small SNGAN on synthetic images and labels with DiffAugment, the auxiliary regression and DRE branches and the L_perturb/L_interp regularizers, and reports the steady-state time per step and the number of host reads of device values per step (Tensor.item, bool(), .cpu(), .tolist(), .numpy(); each one waits for the device on accelerators), counted over the timed steps (reads inside torch, such as the host-side step counters of the optimizers, are not counted).
+
+It also reports the time of the G step alone (from the end of the D step to optG.step, with the device synchronized at both ends); both L_perturb and L_interp are on.
+
+With --fuse_g_reg_passes, the steps are also timed with the G step and its regularizers in one stacked netG forward, and the images and regularizer losses of both forms are checked against each other: exactly for the SNGAN generator, and for the SAGAN generator, whose spectral norm runs one power iteration in the fused forward instead of three, once its spectral norm estimates have converged.
+
+With --compile, the steps are also timed with netG and netD compiled by torch.compile; the compile warm-up is timed separately, and the benchmark checks that the warm-up leaves the weights, optimizer states, step and random states unchanged, that the compiled nets give the outputs of the eager ones, and that no graph is compiled during the timed steps.
+
+With --d_concat_forward, the steps are also timed with one discriminator forward on the concatenated real and fake batches in the D step, and the outputs of both forms are checked against each other.
+
+Usage: python benchmarks/bench_train_step.py [--niters 40] [--batch_size 64] [--img_size 64] [--device cuda] [--compile] [--fuse_g_reg_passes] [--d_concat_forward]
+"""
+
+import os
+import sys
+import argparse
+import contextlib
+import copy
+import io
+import math
+import shutil
+import tempfile
+import timeit
+import numpy as np
+import torch
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from models import sngan_generator, sngan_discriminator, sagan_generator
+from trainer import Trainer
+
+
+## count the calls of the Tensor methods that copy a device value to the host, made outside of torch itself (the optimizers read their step counters, which stay on the host)
+@contextlib.contextmanager
+def count_host_reads():
+    counter = {"n": 0}
+    names = ["item", "__bool__", "cpu", "tolist", "numpy", "__float__", "__int__"]
+    originals = {name: getattr(torch.Tensor, name) for name in names}
+    torch_dir = os.path.dirname(torch.__file__)
+    def wrap(fn):
+        def wrapped(self, *args, **kwargs):
+            if not sys._getframe(1).f_code.co_filename.startswith(torch_dir):
+                counter["n"] += 1
+            return fn(self, *args, **kwargs)
+        return wrapped
+    for name in names:
+        setattr(torch.Tensor, name, wrap(originals[name]))
+    try:
+        yield counter
+    finally:
+        for name in names:
+            setattr(torch.Tensor, name, originals[name])
+
+
+def fn_y2h(labels, dim=128):
+    labels = labels.view(len(labels))
+    half = dim//2
+    freqs = torch.exp(-math.log(10000)*torch.arange(half, dtype=torch.float32)/half).to(labels.device)
+    args = labels[:, None].float()*freqs[None]
+    return (torch.cat([torch.cos(args), torch.sin(args)], -1)+1)/2
+
+
+def make_trainer(args, results_folder, **kwargs):
+    rng = np.random.default_rng(args.seed)
+    torch.manual_seed(args.seed)
+    n = 2000
+    labels = rng.choice(np.linspace(0.02, 0.98, 100), n)
+    images = rng.integers(0, 256, (n, 3, args.img_size, args.img_size), dtype=np.uint8)
+    vicinal_params = {"kernel_sigma": 0.02, "kappa": 1/0.05**2, "threshold_type": "soft", "nonzero_soft_weight_threshold": 1e-3, "use_ada_vic": False, "ada_vic_type": "hybrid", "min_n_per_vic": 30, "ada_eps": 1e-5, "use_symm_vic": True}
+    aux_loss_params = {"use_aux_reg_branch": True, "use_aux_reg_model": False, "aux_reg_loss_type": "ei_hinge", "aux_reg_loss_ei_hinge_factor": 1.0, "aux_reg_loss_huber_delta": -1, "aux_reg_loss_huber_quantile": 0.9, "weight_d_aux_reg_loss": 1.0, "weight_g_aux_reg_loss": 1.0, "aux_reg_net": None, "use_dre_reg": True, "dre_lambda": 1e-2, "weight_d_aux_dre_loss": 1.0, "weight_g_aux_dre_loss": 0.5, "do_dre_ft": False}
+    netG = sngan_generator(dim_z=args.dim_z, dim_y=128, img_size=args.img_size, gene_ch=args.ch)
+    netD = sngan_discriminator(dim_y=128, img_size=args.img_size, disc_ch=args.ch, use_aux_reg=True, use_aux_dre=True)
+    return Trainer(data_name="UTKFace", train_images=images, train_labels=labels, eval_labels=np.linspace(0, 1, 5), net_name="SNGAN", netG=netG, netD=netD, fn_y2h=fn_y2h, vicinal_params=vicinal_params, aux_loss_params=aux_loss_params, img_size=args.img_size, img_ch=3, results_folder=results_folder, dim_z=args.dim_z, niters=0, batch_size_disc=args.batch_size, batch_size_gene=args.batch_size, sample_freq=10**9, save_freq=10**9, use_diffaug=True, use_ema=True, ema_update_after_step=0, lambda_perturb=0.1, lambda_interp=0.1, **kwargs)
+
+
+def sync(device):
+    if device.startswith("cuda"):
+        torch.cuda.synchronize()
+
+## run niters more steps; returns the wall time per step, the host reads per step and the wall time of the G step per step
+def timed_steps(trainer, niters, device):
+    trainer.niters = trainer.step + niters
+    ## the G step runs between the last optD.zero_grad and optG.step of an iteration
+    g_time = {"start": 0.0, "total": 0.0}
+    zero_grad_d, step_g = trainer.optD.zero_grad, trainer.optG.step
+    def timed_zero_grad_d(*args, **kwargs):
+        zero_grad_d(*args, **kwargs)
+        sync(device)
+        g_time["start"] = timeit.default_timer()
+    def timed_step_g(*args, **kwargs):
+        sync(device)
+        g_time["total"] += timeit.default_timer() - g_time["start"]
+        return step_g(*args, **kwargs)
+    trainer.optD.zero_grad, trainer.optG.step = timed_zero_grad_d, timed_step_g
+    try:
+        with contextlib.redirect_stdout(io.StringIO()), count_host_reads() as counter:
+            sync(device)
+            start = timeit.default_timer()
+            trainer.train()
+            sync(device)
+            elapsed = timeit.default_timer() - start
+    finally:
+        del trainer.optD.zero_grad, trainer.optG.step
+    return elapsed/niters*1e3, counter["n"]/niters, g_time["total"]/niters*1e3
+
+
+## the fused netG forward gives the images of the separate forwards on the target, shifted and mixed labels, and so the same L_perturb and L_interp and BatchNorm running statistics
+## for a generator with spectral norm, the images are compared with the tolerance atol and the buffers (which include the spectral norm estimates) are not compared
+def check_fused_g_forward(trainer, args, atol=1e-5, check_buffers=True):
+    torch.manual_seed(args.seed)
+    labels = torch.rand(args.batch_size, device=args.device)
+    z = torch.randn(args.batch_size, args.dim_z, device=args.device)
+    g_reg_labels = trainer._draw_g_reg_labels(labels)
+    netG_ref = copy.deepcopy(trainer.netG)
+    with torch.no_grad():
+        fake_images, _, g_reg_images = trainer._fused_g_forward(z, labels, g_reg_labels)
+        fake_images_ref = netG_ref(z, trainer.fn_y2h(labels))
+        x_shifted_ref = netG_ref(z, trainer.fn_y2h(g_reg_labels["shifted"]))
+        x_mix_ref = netG_ref(z, trainer.fn_y2h(g_reg_labels["mix"]))
+        x2 = copy.deepcopy(netG_ref)(z, trainer.fn_y2h(labels)[g_reg_labels["perm_idx"]])
+    lam_4d = g_reg_labels["lam"].view(-1, 1, 1, 1)
+    L_perturb, L_perturb_ref = torch.mean(torch.abs(fake_images - g_reg_images["shifted"])), torch.mean(torch.abs(fake_images_ref - x_shifted_ref))
+    L_interp, L_interp_ref = torch.mean((g_reg_images["mix"] - (lam_4d*fake_images + (1-lam_4d)*x2))**2), torch.mean((x_mix_ref - (lam_4d*fake_images_ref + (1-lam_4d)*x2))**2)
+    for out, ref in [(fake_images, fake_images_ref), (g_reg_images["shifted"], x_shifted_ref), (g_reg_images["mix"], x_mix_ref)]:
+        assert torch.allclose(out, ref, rtol=1e-4, atol=atol), (out-ref).abs().max().item()
+    if check_buffers:
+        for buffer, buffer_ref in zip(trainer.netG.buffers(), netG_ref.buffers()):
+            assert torch.allclose(buffer.float(), buffer_ref.float(), rtol=1e-4, atol=1e-6)
+    print("L_perturb: {:.6f} (fused) vs {:.6f}; L_interp: {:.6f} (fused) vs {:.6f}".format(L_perturb.item(), L_perturb_ref.item(), L_interp.item(), L_interp_ref.item()))
+
+
+## the same check on a SAGAN generator, whose spectral norm makes the fused forward differ from the separate ones until its power iterations have converged; they are run on small batches first
+def check_fused_g_forward_spectral_norm(trainer, args, num_power_iterations=300):
+    netG = trainer.netG
+    trainer.netG = sagan_generator(dim_z=args.dim_z, dim_y=128, img_size=args.img_size, gene_ch=args.ch).to(args.device)
+    try:
+        with torch.no_grad():
+            for _ in range(num_power_iterations):
+                trainer.netG(torch.randn(2, args.dim_z, device=args.device), trainer.fn_y2h(torch.rand(2, device=args.device)))
+        check_fused_g_forward(trainer, args, atol=1e-3, check_buffers=False)
+    finally:
+        trainer.netG = netG
+
+
+## the outputs of netD on the concatenated batches, split, equal those of the two separate forwards (in eval mode, so that the power iteration of the spectral norm does not advance between the calls)
+def check_concat_forward(trainer, args):
+    netD = trainer.netD
+    netD.eval()
+    with torch.no_grad():
+        real_images = torch.randn(args.batch_size, 3, args.img_size, args.img_size, device=args.device)
+        fake_images = torch.randn(args.batch_size, 3, args.img_size, args.img_size, device=args.device)
+        embed = trainer.fn_y2h(torch.rand(args.batch_size, device=args.device))
+        real_out, fake_out = trainer._split_disc_out(netD(torch.cat([real_images, fake_images]), embed.repeat(2, 1)), args.batch_size)
+        for out, ref in [(real_out, netD(real_images, embed)), (fake_out, netD(fake_images, embed))]:
+            for k in ref:
+                if ref[k] is not None:
+                    assert torch.allclose(out[k], ref[k], rtol=1e-4, atol=1e-5), k
+    netD.train()
+
+
+## compiled netG and netD give the outputs of eager copies, and the warm-up iteration leaves the trainer as it was
+def check_compile_warmup(trainer, args):
+    def snapshot():
+        return copy.deepcopy({"netG": trainer.netG.state_dict(), "netD": trainer.netD.state_dict(), "optG": trainer.optG.state_dict(), "optD": trainer.optD.state_dict(), "step": trainer.step, "rng": torch.get_rng_state(), "np_rng": np.random.get_state()[1]})
+    def assert_equal(a, b, name):
+        if isinstance(a, dict):
+            for k in a:
+                assert_equal(a[k], b[k], "{}/{}".format(name, k))
+        elif torch.is_tensor(a):
+            assert torch.equal(a, b), name
+        elif isinstance(a, np.ndarray):
+            assert np.array_equal(a, b), name
+        else:
+            assert a == b, name
+    before = snapshot()
+    with contextlib.redirect_stdout(io.StringIO()):
+        trainer._compile_warmup()
+    assert_equal(before, snapshot(), "state")
+    assert all(p.grad is None for p in list(trainer.netG.parameters())+list(trainer.netD.parameters()))
+
+    netG_ref = sngan_generator(dim_z=args.dim_z, dim_y=128, img_size=args.img_size, gene_ch=args.ch).to(args.device)
+    netD_ref = sngan_discriminator(dim_y=128, img_size=args.img_size, disc_ch=args.ch, use_aux_reg=True, use_aux_dre=True).to(args.device)
+    netG_ref.load_state_dict(trainer.netG.state_dict())
+    netD_ref.load_state_dict(trainer.netD.state_dict())
+    netG_ref.eval()
+    netD_ref.eval()
+    trainer.netG.eval()
+    trainer.netD.eval()
+    with torch.no_grad():
+        z = torch.randn(args.batch_size, args.dim_z, device=args.device)
+        embed = trainer.fn_y2h(torch.rand(args.batch_size, device=args.device))
+        images, images_ref = trainer.netG(z, embed), netG_ref(z, embed)
+        assert torch.allclose(images, images_ref, rtol=1e-4, atol=1e-4)
+        ## the outputs of a barely trained netD can be large (its spectral norm estimates have not converged yet), so the tolerance scales with them
+        out, out_ref = trainer.netD(images_ref, embed), netD_ref(images_ref, embed)
+        for k in out_ref:
+            if out_ref[k] is not None:
+                assert torch.allclose(out[k], out_ref[k], rtol=1e-4, atol=1e-4*max(1.0, out_ref[k].abs().max().item())), k
+    trainer.netG.train()
+    trainer.netD.train()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--niters', type=int, default=40)
+    parser.add_argument('--warmup', type=int, default=5)
+    parser.add_argument('--batch_size', type=int, default=64)
+    parser.add_argument('--img_size', type=int, default=64)
+    parser.add_argument('--ch', type=int, default=8, help='channel width of G and D')
+    parser.add_argument('--dim_z', type=int, default=128)
+    parser.add_argument('--device', type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument('--compile', action='store_true', default=False, help='also time the steps with netG and netD compiled by torch.compile')
+    parser.add_argument('--fuse_g_reg_passes', action='store_true', default=False, help='also time the G step with the regularizer passes fused into one netG forward')
+    parser.add_argument('--d_concat_forward', action='store_true', default=False, help='also time the D step with one forward on the concatenated real and fake batches')
+    parser.add_argument('--seed', type=int, default=2025)
+    args = parser.parse_args()
+
+    results_folder = tempfile.mkdtemp()
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            trainer = make_trainer(args, results_folder)
+        timed_steps(trainer, args.warmup, args.device)
+        step_ms, host_reads, g_step_ms = timed_steps(trainer, args.niters, args.device)
+        print("{} steps at batch size {} on {}: {:.1f} ms/step (G step: {:.1f} ms); {:.2f} host reads/step".format(args.niters, args.batch_size, args.device, step_ms, g_step_ms, host_reads))
+
+        if args.compile:
+            with contextlib.redirect_stdout(io.StringIO()):
+                trainer = make_trainer(args, results_folder, use_compile=True)
+            check_compile_warmup(trainer, args)
+            timed_steps(trainer, args.warmup, args.device)
+            num_graphs = torch._dynamo.utils.counters["stats"]["unique_graphs"]
+            step_ms_compiled, _, g_step_ms_compiled = timed_steps(trainer, args.niters, args.device)
+            num_graphs = torch._dynamo.utils.counters["stats"]["unique_graphs"] - num_graphs
+            print("torch.compile: {:.1f} s compile warm-up; {:.1f} ms/step (G step: {:.1f} ms) vs {:.1f} ms/step eager, speedup {:.2f}x; {} graphs compiled during the timed steps".format(trainer.compile_time, step_ms_compiled, g_step_ms_compiled, step_ms, step_ms/step_ms_compiled, num_graphs))
+
+        if args.fuse_g_reg_passes:
+            with contextlib.redirect_stdout(io.StringIO()):
+                trainer = make_trainer(args, results_folder, fuse_g_reg_passes=True)
+            check_fused_g_forward(trainer, args)
+            check_fused_g_forward_spectral_norm(trainer, args)
+            timed_steps(trainer, args.warmup, args.device)
+            step_ms_fused, _, g_step_ms_fused = timed_steps(trainer, args.niters, args.device)
+            print("fused G regularizer passes: G step {:.1f} ms (vs {:.1f} ms), speedup {:.2f}x; {:.1f} ms/step (vs {:.1f} ms/step)".format(g_step_ms_fused, g_step_ms, g_step_ms/g_step_ms_fused, step_ms_fused, step_ms))
+
+        if args.d_concat_forward:
+            check_concat_forward(trainer, args)
+            with contextlib.redirect_stdout(io.StringIO()):
+                trainer = make_trainer(args, results_folder, d_concat_forward=True)
+            timed_steps(trainer, args.warmup, args.device)
+            step_ms_concat, _, _ = timed_steps(trainer, args.niters, args.device)
+            print("concatenated D forward: {:.1f} ms/step (vs {:.1f} ms/step); speedup {:.2f}x".format(step_ms_concat, step_ms, step_ms/step_ms_concat))
+    finally:
+        shutil.rmtree(results_folder, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
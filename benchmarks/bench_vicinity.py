@@ -0,0 +1,171 @@
+"""
+Micro-benchmark for the batched vicinity engine used by Trainer.make_vicinity.
+
+It compares the per-sample `np.where` scans that make_vicinity used to run with the vectorized engine in vicinity.py, checks that both see the same set of real images in every vicinity, and reports the time per D step versus the training set size.
+It also checks the precomputed adaptive radius table against the per-target expansion loop it replaced, and times both.
+
+Usage: python benchmarks/bench_vicinity.py [--batch_size 256] [--sizes 10000,100000,1000000]
+"""
+
+import os
+import sys
+import argparse
+import timeit
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from vicinity import VicinityEngine
+
+
+## the images in the vicinity of one target label, computed the way the old per-sample loop did it
+def legacy_vicinity(train_labels, target_y, vicinal_params, kappa_l=None, kappa_r=None):
+    log_nonzero_threshold = -np.log(vicinal_params["nonzero_soft_weight_threshold"])
+    if not vicinal_params["use_ada_vic"]:
+        if vicinal_params["threshold_type"] == "hard":
+            return np.where(np.abs(train_labels-target_y)<= vicinal_params["kappa"])[0]
+        return np.where((train_labels-target_y)**2 <= log_nonzero_threshold/vicinal_params["kappa"])[0]
+    nu_l, nu_r = 1/kappa_l**2, 1/kappa_r**2
+    indx_hard = np.where((train_labels>=(target_y-kappa_l)) & (train_labels<=(target_y+kappa_r)))[0]
+    indx_left = np.where(train_labels<=target_y)[0]
+    indx_right = np.where(train_labels>target_y)[0]
+    indx_soft_left = np.intersect1d(np.where((train_labels-target_y)**2 <= log_nonzero_threshold/nu_l)[0], indx_left)
+    indx_soft_right = np.intersect1d(np.where((train_labels-target_y)**2 <= log_nonzero_threshold/nu_r)[0], indx_right)
+    indx_soft = np.concatenate([indx_soft_left, indx_soft_right])
+    if vicinal_params["ada_vic_type"] == "vanilla":
+        return indx_hard if vicinal_params["threshold_type"] == "hard" else indx_soft
+    return np.intersect1d(indx_hard, indx_soft)
+
+
+## the radii of the adaptive vicinity of one target label, computed by the expansion loop that the radius table replaced
+def legacy_ada_radius(unique_train_labels, counts_train_elements, target_y, vicinal_params):
+    idx_y = np.searchsorted(unique_train_labels, target_y, side='left')
+    kappa_l, kappa_r = vicinal_params["ada_eps"], vicinal_params["ada_eps"]
+    if idx_y <= 0:
+        idx_r = 0
+        n_got = counts_train_elements[idx_r]
+        kappa_r = np.abs(target_y-unique_train_labels[idx_r]) + vicinal_params["ada_eps"]
+        while n_got<vicinal_params["min_n_per_vic"]:
+            idx_r += 1
+            n_got += counts_train_elements[idx_r]
+            kappa_r = np.abs(target_y-unique_train_labels[idx_r])
+            if idx_r==(len(counts_train_elements)-1):
+                break
+    elif idx_y >= (len(unique_train_labels)-1):
+        idx_l = len(unique_train_labels)-1
+        n_got = counts_train_elements[idx_l]
+        kappa_l = np.abs(target_y-unique_train_labels[idx_l]) + vicinal_params["ada_eps"]
+        while n_got<vicinal_params["min_n_per_vic"]:
+            idx_l -= 1
+            n_got += counts_train_elements[idx_l]
+            kappa_l = np.abs(target_y-unique_train_labels[idx_l])
+            if idx_l==0:
+                break
+    else:
+        if target_y in unique_train_labels:
+            idx_l, idx_r = idx_y-1, idx_y+1
+            n_got = counts_train_elements[idx_y]
+        else:
+            idx_l, idx_r = idx_y-1, idx_y
+            n_got = 0
+        dist2left = np.abs(target_y-unique_train_labels[idx_l])
+        dist2right = np.abs(target_y-unique_train_labels[idx_r])
+        while n_got<vicinal_params["min_n_per_vic"]:
+            if dist2left < dist2right:
+                kappa_l = dist2left
+                n_got += counts_train_elements[idx_l]
+                idx_l -= 1
+            elif dist2left > dist2right:
+                kappa_r = dist2right
+                n_got += counts_train_elements[idx_r]
+                idx_r += 1
+            else:
+                kappa_l = dist2left
+                kappa_r = dist2right
+                n_got += (counts_train_elements[idx_l] + counts_train_elements[idx_r])
+                idx_l -= 1
+                idx_r += 1
+            dist2left = 1e30 if idx_l < 0 else np.abs(target_y-unique_train_labels[idx_l])
+            dist2right = 1e30 if idx_r > len(unique_train_labels)-1 else np.abs(target_y-unique_train_labels[idx_r])
+            if dist2left > 1e10 and dist2right > 1e10:
+                break
+    if vicinal_params["use_symm_vic"]:
+        kappa_l, kappa_r = max(kappa_l, kappa_r), max(kappa_l, kappa_r)
+    return kappa_l, kappa_r
+
+
+def make_labels(n, n_unique, rng):
+    ## imbalanced labels, similar to SteeringAngle/UTKFace
+    unique_labels = np.sort(rng.uniform(0, 1, n_unique))
+    probs = np.exp(-((unique_labels-0.3)/0.15)**2) + 0.02
+    labels = rng.choice(unique_labels, size=n, p=probs/probs.sum())
+    return labels
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch_size', type=int, default=256)
+    parser.add_argument('--sizes', type=str, default="10000,100000,1000000")
+    parser.add_argument('--n_unique', type=int, default=1000)
+    parser.add_argument('--repeats', type=int, default=3)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(2025)
+    settings = {
+        "hard": {"threshold_type": "hard", "use_ada_vic": False, "ada_vic_type": "vanilla"},
+        "soft": {"threshold_type": "soft", "use_ada_vic": False, "ada_vic_type": "vanilla"},
+        "ada_vanilla_soft": {"threshold_type": "soft", "use_ada_vic": True, "ada_vic_type": "vanilla"},
+        "ada_hybrid": {"threshold_type": "soft", "use_ada_vic": True, "ada_vic_type": "hybrid"},
+    }
+
+    print("{:>10} {:>18} {:>14} {:>14} {:>9}".format("N", "setting", "loop (ms)", "engine (ms)", "speedup"))
+    for n in [int(s) for s in args.sizes.split(",")]:
+        train_labels = make_labels(n, args.n_unique, rng)
+        unique_labels = np.unique(train_labels)
+        kernel_sigma = 1.06*np.std(train_labels)*n**(-1/5)
+        kappa_base = 2*np.max(np.diff(unique_labels))
+        for name, setting in settings.items():
+            vicinal_params = {
+                "kernel_sigma": kernel_sigma,
+                "kappa": kappa_base if setting["threshold_type"]=="hard" else 1/kappa_base**2,
+                "nonzero_soft_weight_threshold": 1e-3,
+                "min_n_per_vic": 50,
+                "ada_eps": 1e-5,
+                "use_symm_vic": True,
+                **setting,
+            }
+            engine = VicinityEngine(train_labels, vicinal_params)
+            targets_in_dataset = rng.choice(unique_labels, size=args.batch_size, replace=True)
+            targets = np.clip(targets_in_dataset + rng.normal(0, kernel_sigma, args.batch_size), 0, 1)
+
+            ## both implementations must see the same real images in each vicinity
+            if setting["use_ada_vic"]:
+                kappa_l_all, kappa_r_all = engine.ada_radii(targets)
+            else:
+                kappa_l_all = kappa_r_all = np.zeros(args.batch_size)
+            for j in range(min(args.batch_size, 32)):
+                indx_ref = legacy_vicinity(train_labels, targets[j], vicinal_params, kappa_l_all[j], kappa_r_all[j])
+                if len(indx_ref)==0:
+                    continue
+                batch_real_indx, _, _, _ = engine.sample(targets[j:j+1].copy(), targets_in_dataset[j:j+1])
+                assert batch_real_indx[0] in indx_ref
+
+            time_loop = timeit.timeit(lambda: [legacy_vicinity(train_labels, targets[j], vicinal_params, kappa_l_all[j], kappa_r_all[j]) for j in range(args.batch_size)], number=args.repeats)/args.repeats
+            time_engine = timeit.timeit(lambda: engine.sample(targets.copy(), targets_in_dataset), number=args.repeats)/args.repeats
+            print("{:>10} {:>18} {:>14.2f} {:>14.2f} {:>8.1f}x".format(n, name, time_loop*1e3, time_engine*1e3, time_loop/time_engine))
+
+            ## the radius table must reproduce the expansion loop exactly, including targets outside [min, max] and targets equal to a training label
+            if setting["use_ada_vic"]:
+                targets_radii = np.concatenate([targets, targets_in_dataset, [unique_labels[0]-0.01, unique_labels[0], unique_labels[-1], unique_labels[-1]+0.01]])
+                for use_symm_vic in [True, False]:
+                    engine.vicinal_params = {**vicinal_params, "use_symm_vic": use_symm_vic}
+                    radii_ref = np.array([legacy_ada_radius(engine.unique_labels, engine.counts, y, engine.vicinal_params) for y in targets_radii])
+                    kappa_l_all, kappa_r_all = engine.ada_radii(targets_radii)
+                    assert np.array_equal(radii_ref[:,0], kappa_l_all) and np.array_equal(radii_ref[:,1], kappa_r_all)
+                engine.vicinal_params = vicinal_params
+                time_loop = timeit.timeit(lambda: [legacy_ada_radius(engine.unique_labels, engine.counts, y, vicinal_params) for y in targets], number=args.repeats)/args.repeats
+                time_engine = timeit.timeit(lambda: engine.ada_radii(targets), number=args.repeats)/args.repeats
+                print("{:>10} {:>18} {:>14.2f} {:>14.2f} {:>8.1f}x".format(n, name+"_radii", time_loop*1e3, time_engine*1e3, time_loop/time_engine))
+
+
+if __name__ == "__main__":
+    main()
@@ -7,8 +7,96 @@ import copy
 import torch
 from tqdm import tqdm, trange
 
+
+## per-process registry of loaded data: arrays read from h5 files, and the results of load_train_data/load_evaluation_data keyed by the dataset settings
+## every LoadDataSet with the same settings shares one copy, so main.py, LabelEmbed and Evaluator load each dataset once
+_DATA_CACHE = {}
+
+def clear_data_cache():
+    _DATA_CACHE.clear()
+
+## a read-only view, so that a cached array cannot be modified by one of its consumers
+def _read_only(x):
+    if isinstance(x, np.ndarray):
+        x = x.view()
+        x.setflags(write=False)
+    return x
+
+
+## group positions by label: positions sorted by label (stable, so ascending within a label), unique labels, counts, and where each label starts in the sorted positions
+def _group_by_label(labels):
+    order = np.argsort(labels, kind="stable")
+    unique_labels, counts = np.unique(labels, return_counts=True)
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1])).astype(int)
+    return order, unique_labels, counts, starts
+
+## positions of the labels in selected_labels, grouped by label in ascending order
+def _select_labels(labels, selected_labels):
+    indx = np.where(np.isin(labels, selected_labels))[0]
+    return indx[np.argsort(labels[indx], kind="stable")]
+
+## for each distinct label, keep no more than max_num positions; with shuffle, a label with too many images keeps a random subset
+## np.random is only used for the labels exceeding max_num, in ascending label order, as the former per-label loop did
+def _cap_per_label(labels, max_num, shuffle=True):
+    order, _, counts, starts = _group_by_label(labels)
+    keep = np.ones(len(order), dtype=bool)
+    for i in np.where(counts>max_num)[0]:
+        if shuffle:
+            np.random.shuffle(order[starts[i]:(starts[i]+counts[i])])
+        keep[(starts[i]+int(max_num)):(starts[i]+counts[i])] = False
+    return order[keep]
+
+
+## a read-only view base[indx] of an image array, an HDF5 dataset or a memmap, without copying the images
+class IndexedImages:
+    def __init__(self, base, indx=None, chunk_size=2048):
+        self.base = base
+        self.indx = np.arange(len(base)) if indx is None else np.asarray(indx, dtype=np.int64)
+        self.chunk_size = chunk_size
+        self.dtype = base.dtype
+        self.shape = (len(self.indx),) + tuple(base.shape[1:])
+        self.ndim = len(self.shape)
+        self.nbytes = int(np.prod(self.shape))*np.dtype(self.dtype).itemsize
+    
+    def __len__(self):
+        return len(self.indx)
+    
+    ## read base[indx]; HDF5 datasets only accept increasing indices, so unique indices are read and then reordered
+    def _read(self, indx):
+        if isinstance(self.base, np.ndarray):
+            return np.asarray(self.base[indx])
+        indx_unique, indx_inverse = np.unique(indx, return_inverse=True)
+        return self.base[indx_unique][indx_inverse]
+    
+    def __getitem__(self, key):
+        if isinstance(key, (int, np.integer)):
+            return np.asarray(self.base[int(self.indx[key])])
+        if not isinstance(key, slice):
+            key = np.asarray(key)
+            if key.dtype == bool:
+                key = np.where(key)[0]
+        return self._read(self.indx[key])
+    
+    ## a sub-view; no image is read
+    def view(self, indx):
+        return IndexedImages(self.base, self.indx[indx], self.chunk_size)
+    
+    def __array__(self, dtype=None, copy=None):
+        output = np.empty(self.shape, dtype=self.dtype if dtype is None else dtype)
+        for i in range(0, len(self), self.chunk_size):
+            output[i:(i+self.chunk_size)] = self._read(self.indx[i:(i+self.chunk_size)])
+        return output
+    
+    def max(self):
+        return max(self._read(self.indx[i:(i+self.chunk_size)]).max() for i in range(0, len(self), self.chunk_size))
+    
+    def min(self):
+        return min(self._read(self.indx[i:(i+self.chunk_size)]).min() for i in range(0, len(self), self.chunk_size))
+
+
+
 class LoadDataSet:
-    def __init__(self, data_name, data_path, min_label, max_label, img_size=64, max_num_img_per_label=1e30, num_img_per_label_after_replica=0, imbalance_type="unimodal"):
+    def __init__(self, data_name, data_path, min_label, max_label, img_size=64, max_num_img_per_label=1e30, num_img_per_label_after_replica=0, imbalance_type="unimodal", backend="ram"):
         """
         data_name: the name of the dataset; must be one of ['RC-49', 'Cell200', 'UTKFace', 'SteeringAngle']
         data_path: the path to the h5 file
@@ -18,6 +106,8 @@ class LoadDataSet:
         max_num_img_per_label: the maximum number of images for each distinct label that will be used for training
         num_img_per_label_after_replica: the number of images for each distinct label that will be used for training
         imbalance_type: imbalance type for RC-49
+        backend: how images are accessed; 'ram' reads the whole image array into memory, 'h5' keeps the HDF5 file open and reads images on demand, 'memmap' converts the images once to an uncompressed .npy file next to the h5 file and memory-maps it
+                 with 'h5' and 'memmap', load_train_data and load_evaluation_data return IndexedImages views instead of arrays
         """
         
         self.data_name = data_name
@@ -28,25 +118,28 @@ class LoadDataSet:
         self.max_num_img_per_label = max_num_img_per_label
         self.num_img_per_label_after_replica = num_img_per_label_after_replica
         self.imbalance_type = imbalance_type
+        self.backend = backend.lower()
+        assert self.backend in ["ram", "h5", "memmap"]
         
         ## load the entire dataset from h5 file
-        with h5py.File(self.data_path+'/{}_{}x{}.h5'.format(self.data_name, self.img_size, self.img_size), 'r') as hf:
+        self.h5_path = self.data_path+'/{}_{}x{}.h5'.format(self.data_name, self.img_size, self.img_size)
+        with h5py.File(self.h5_path, 'r') as hf:
             if self.data_name == "RC-49":
                 ## load h5 file
-                self.labels_all = hf['labels'][:].astype(float)
-                self.images_all = hf['images'][:]
-                self.indx_train = hf['indx_train'][:]
+                self.labels_all = self._read_array(hf, 'labels').astype(float)
+                self.images_all = self._open_images(hf, 'images')
+                self.indx_train = self._read_array(hf, 'indx_train')
                 hf.close()
                 print("\n Loaded entire RC-49 dataset: {}x{}x{}x{}".format(self.images_all.shape[0], self.images_all.shape[1], self.images_all.shape[2], self.images_all.shape[3]))
                 self.num_classes = 49
 
             elif self.data_name == "RC-49_imb": #imbalanced RC-49 dataset
-                self.labels_all = hf['labels'][:].astype(float)
-                self.images_all = hf['images'][:]
-                self.indx_train_unimodal = hf['indx_train_unimodal'][:]
-                self.indx_train_dualmodal = hf['indx_train_dualmodal'][:]
-                self.indx_train_trimodal = hf['indx_train_trimodal'][:]
-                self.indx_train_standard = hf['indx_train_standard'][:]
+                self.labels_all = self._read_array(hf, 'labels').astype(float)
+                self.images_all = self._open_images(hf, 'images')
+                self.indx_train_unimodal = self._read_array(hf, 'indx_train_unimodal')
+                self.indx_train_dualmodal = self._read_array(hf, 'indx_train_dualmodal')
+                self.indx_train_trimodal = self._read_array(hf, 'indx_train_trimodal')
+                self.indx_train_standard = self._read_array(hf, 'indx_train_standard')
                 if self.imbalance_type.lower()[0:8] == "unimodal":
                     print("We use `unimodal` index for training...\r")
                     self.indx_train = self.indx_train_unimodal
@@ -65,24 +158,24 @@ class LoadDataSet:
 
             elif self.data_name == "UTKFace":
                 ## load h5 file
-                self.labels_all = hf['labels'][:].astype(float)
-                self.images_all = hf['images'][:]
+                self.labels_all = self._read_array(hf, 'labels').astype(float)
+                self.images_all = self._open_images(hf, 'images')
                 hf.close()
                 print("\n Loaded entire UTKFace dataset: {}x{}x{}x{}".format(self.images_all.shape[0], self.images_all.shape[1], self.images_all.shape[2], self.images_all.shape[3]))
                 self.num_classes = 5
                 
             elif self.data_name == "Cell200":
                 ## load h5 file
-                self.labels_all = hf['CellCounts'][:].astype(float)
-                self.images_all = hf['IMGs_grey'][:]
+                self.labels_all = self._read_array(hf, 'CellCounts').astype(float)
+                self.images_all = self._open_images(hf, 'IMGs_grey')
                 hf.close()        
                 print("\n Loaded entire Cell200 dataset: {}x{}x{}x{}".format(self.images_all.shape[0], self.images_all.shape[1], self.images_all.shape[2], self.images_all.shape[3]))
                 self.num_classes = 0
             
             elif self.data_name == "SteeringAngle":
                 ## load h5 file
-                self.labels_all = hf['labels'][:].astype(float)
-                self.images_all = hf['images'][:]
+                self.labels_all = self._read_array(hf, 'labels').astype(float)
+                self.images_all = self._open_images(hf, 'images')
                 hf.close()
                 print("\n Loaded entire SteeringAngle dataset: {}x{}x{}x{}".format(self.images_all.shape[0], self.images_all.shape[1], self.images_all.shape[2], self.images_all.shape[3]))
                 self.num_classes = 5
@@ -98,163 +191,144 @@ class LoadDataSet:
             self.min_label_before_shift = 0
             self.max_label_after_shift = self.max_label
     
-    ## load training data
+    ## an array in the h5 file, read once per process
+    def _read_array(self, hf, key):
+        cache_key = ("array", os.path.abspath(self.h5_path), key)
+        if cache_key not in _DATA_CACHE:
+            _DATA_CACHE[cache_key] = _read_only(hf[key][:])
+        return _DATA_CACHE[cache_key]
+    
+    ## the image array of the whole dataset, according to the backend; opened once per process
+    def _open_images(self, hf, key):
+        cache_key = ("images", os.path.abspath(self.h5_path), key, self.backend)
+        if cache_key not in _DATA_CACHE:
+            _DATA_CACHE[cache_key] = _read_only(self._open_images_uncached(hf, key))
+        return _DATA_CACHE[cache_key]
+    
+    def _open_images_uncached(self, hf, key):
+        if self.backend == "ram":
+            return hf[key][:]
+        if self.backend == "h5":
+            self.h5_file = h5py.File(self.h5_path, 'r') #kept open for on-demand reads
+            return self.h5_file[key]
+        ## memmap: convert once to an uncompressed .npy cache
+        path_to_npy = os.path.splitext(self.h5_path)[0] + "_{}.npy".format(key)
+        if not os.path.isfile(path_to_npy):
+            print("\n Converting {} to {} >>>".format(self.h5_path, path_to_npy))
+            dset = hf[key]
+            path_to_tmp = path_to_npy + ".tmp"
+            images = np.lib.format.open_memmap(path_to_tmp, mode="w+", dtype=dset.dtype, shape=dset.shape)
+            chunk_size = 2048
+            for i in trange(0, len(dset), chunk_size):
+                images[i:(i+chunk_size)] = dset[i:(i+chunk_size)]
+            images.flush()
+            del images
+            os.replace(path_to_tmp, path_to_npy)
+        return np.load(path_to_npy, mmap_mode="r")
+    
+    ## gather images by their indices in the entire dataset; lazy backends get a view instead of a copy
+    ## replicated images are kept as an index multiset over the images, so every image is stored once whatever the backend
+    def _gather_images(self, indx=None):
+        if self.backend == "ram":
+            if indx is None:
+                return self.images_all
+            if len(np.unique(indx)) == len(indx):
+                return self.images_all[indx]
+        return IndexedImages(self.images_all, indx)
+    
+    ## memoize the outputs of a loading function by the settings they depend on
+    def _memoize(self, kind, fn_load, settings):
+        cache_key = (kind, os.path.abspath(self.h5_path), self.backend, self.data_name) + settings
+        if cache_key in _DATA_CACHE:
+            print("\n Reuse the {} data of {} loaded before.".format(kind, self.data_name))
+        else:
+            _DATA_CACHE[cache_key] = tuple(_read_only(x) for x in fn_load())
+        return tuple(_read_only(x) for x in _DATA_CACHE[cache_key])
+    
+    ## load training data; the outputs are read-only and shared by all LoadDataSet objects with the same settings
     def load_train_data(self):
+        return self._memoize("training", self._load_train_data, (self.min_label, self.max_label, self.max_num_img_per_label, self.num_img_per_label_after_replica, self.imbalance_type))
+    
+    ## load the evaluation data; the outputs are read-only and shared by all LoadDataSet objects with the same settings
+    def load_evaluation_data(self):
+        return self._memoize("evaluation", self._load_evaluation_data, (self.min_label, self.max_label, self.imbalance_type))
+    
+    def _load_train_data(self):
+        ## the training set is selected as indices into the entire dataset; images are only gathered at the end
         
         if self.data_name == "RC-49":
-            images = self.images_all[self.indx_train]
-            labels = self.labels_all[self.indx_train]
+            indx_all = self.indx_train
+            labels = self.labels_all[indx_all]
 
             ## Extract a subset from the entire dataset.
             indx = np.where((labels>self.min_label)*(labels<self.max_label)==True)[0]
             labels = labels[indx]
-            images = images[indx]
+            indx_all = indx_all[indx]
             
             ## for each distinct label, take no more than max_num_img_per_label images
-            print("\n The original training set contains {} images with labels in [{},{}]; for each label, select no more than {} images.>>>".format(len(images), self.min_label, self.max_label, self.max_num_img_per_label))
-            sel_indx = []
-            unique_labels = np.sort(np.array(list(set(labels))))
-            for i in range(len(unique_labels)):
-                indx_i = np.where(labels == unique_labels[i])[0]
-                if len(indx_i)>self.max_num_img_per_label:
-                    np.random.shuffle(indx_i)
-                    indx_i = indx_i[0:self.max_num_img_per_label]
-                sel_indx.append(indx_i)
-            sel_indx = np.concatenate(sel_indx)
+            print("\n The original training set contains {} images with labels in [{},{}]; for each label, select no more than {} images.>>>".format(len(indx_all), self.min_label, self.max_label, self.max_num_img_per_label))
+            sel_indx = _cap_per_label(labels, self.max_num_img_per_label)
             
-            images = images[sel_indx]
+            indx_all = indx_all[sel_indx]
             labels = labels[sel_indx]
             
-            print("\r {} images left and there are {} unique labels".format(len(images), len(set(labels))))
+            print("\r {} images left and there are {} unique labels".format(len(indx_all), len(np.unique(labels))))
         
         elif self.data_name == "RC-49_imb": #imbalanced RC-49 dataset
             
-            images = self.images_all[self.indx_train]
-            labels = self.labels_all[self.indx_train]
+            indx_all = self.indx_train
+            labels = self.labels_all[indx_all]
             
-            print("\r {} images left and there are {} unique labels".format(len(images), len(set(labels))))
+            print("\r {} images left and there are {} unique labels".format(len(indx_all), len(np.unique(labels))))
             
         elif self.data_name == "UTKFace":
             ## Extract a subset from the entire dataset.
-            images = []
-            labels = []
             selected_labels = np.arange(self.min_label, self.max_label+1)
-            for i in range(len(selected_labels)):
-                curr_label = selected_labels[i]
-                index_curr_label = np.where(self.labels_all==curr_label)[0]
-                images.append(self.images_all[index_curr_label])
-                labels.append(self.labels_all[index_curr_label])
-            # for i
-            images = np.concatenate(images, axis=0)
-            labels = np.concatenate(labels)
+            indx_all = _select_labels(self.labels_all, selected_labels)
+            labels = self.labels_all[indx_all]
             
             ## for each distinct label, take no more than max_num_img_per_label images
-            print("\n The original training set contains {} images with labels in [{},{}]; for each label, select no more than {} images.>>>".format(len(images), self.min_label, self.max_label, self.max_num_img_per_label))
-            sel_indx = []
-            unique_labels = np.sort(np.array(list(set(labels))))
-            for i in range(len(unique_labels)):
-                indx_i = np.where(labels == unique_labels[i])[0]
-                if len(indx_i)>self.max_num_img_per_label:
-                    np.random.shuffle(indx_i)
-                    indx_i = indx_i[0:self.max_num_img_per_label]
-                sel_indx.append(indx_i)
-            sel_indx = np.concatenate(sel_indx)
+            print("\n The original training set contains {} images with labels in [{},{}]; for each label, select no more than {} images.>>>".format(len(indx_all), self.min_label, self.max_label, self.max_num_img_per_label))
+            sel_indx = _cap_per_label(labels, self.max_num_img_per_label)
             
-            images = images[sel_indx]
+            indx_all = indx_all[sel_indx]
             labels = labels[sel_indx]
             
-            print("\r {} images left and there are {} unique labels".format(len(images), len(set(labels))))
+            print("\r {} images left and there are {} unique labels".format(len(indx_all), len(np.unique(labels))))
             
             ## replicate minority samples to alleviate the data imbalance issue
-            max_num_img_per_label_after_replica = np.min([self.num_img_per_label_after_replica, self.max_num_img_per_label])
-            if max_num_img_per_label_after_replica>1:
-                unique_labels_replica = np.sort(np.array(list(set(labels))))
-                num_labels_replicated = 0
-                print("\n Start replicating minority samples >>>")
-                for i in trange(len(unique_labels_replica)):
-                    curr_label = unique_labels_replica[i]
-                    indx_i = np.where(labels == curr_label)[0]
-                    if len(indx_i) < max_num_img_per_label_after_replica:
-                        num_img_less = int(max_num_img_per_label_after_replica - len(indx_i))
-                        indx_replica = np.random.choice(indx_i, size = num_img_less, replace=True)
-                        if num_labels_replicated == 0:
-                            images_replica = images[indx_replica]
-                            labels_replica = labels[indx_replica]
-                        else:
-                            images_replica = np.concatenate((images_replica, images[indx_replica]), axis=0)
-                            labels_replica = np.concatenate((labels_replica, labels[indx_replica]))
-                        num_labels_replicated+=1
-                #end for i
-                images = np.concatenate((images, images_replica), axis=0)
-                labels = np.concatenate((labels, labels_replica))
-                print("\r We replicate {} images and labels.".format(len(images_replica)))
+            indx_all, labels = self._replicate_minority(indx_all, labels)
         
         elif self.data_name == "Cell200":
             ## Extract a subset from the entire dataset.
-            images = []
-            labels = []
             selected_labels = np.arange(self.min_label, self.max_label+1)
-            for i in range(len(selected_labels)):
-                curr_label = selected_labels[i]
-                index_curr_label = np.where(self.labels_all==curr_label)[0]
-                images.append(self.images_all[index_curr_label])
-                labels.append(self.labels_all[index_curr_label])
-            # for i
-            images = np.concatenate(images, axis=0)
-            labels = np.concatenate(labels)       
+            indx_all = _select_labels(self.labels_all, selected_labels)
+            labels = self.labels_all[indx_all]
             
             # for each distinct label, take no more than max_num_img_per_label images
-            print("\n The original training set contains {} images with labels in [{},{}]; for each label, select no more than {} images.>>>".format(len(images), self.min_label, self.max_label, self.max_num_img_per_label))
+            print("\n The original training set contains {} images with labels in [{},{}]; for each label, select no more than {} images.>>>".format(len(indx_all), self.min_label, self.max_label, self.max_num_img_per_label))
             step_size = 2
             selected_labels = np.arange(self.min_label, self.max_label+1, step_size) # only take images with odd labels for training
-            n_unique_labels = len(selected_labels)
-            images_subset = []
-            labels_subset = []
-            for i in range(n_unique_labels):
-                curr_label = selected_labels[i]
-                index_curr_label = np.where(labels==curr_label)[0]
-                images_subset.append(images[index_curr_label[0:min(self.max_num_img_per_label, len(index_curr_label))]])
-                labels_subset.append(labels[index_curr_label[0:min(self.max_num_img_per_label, len(index_curr_label))]])
-            # for i
-            images = np.concatenate(images_subset, axis=0)
-            labels = np.concatenate(labels_subset)
+            sel_indx = _select_labels(labels, selected_labels)
+            sel_indx = sel_indx[_cap_per_label(labels[sel_indx], self.max_num_img_per_label, shuffle=False)]
+            indx_all = indx_all[sel_indx]
+            labels = labels[sel_indx]
             
-            print("\r {} images left and there are {} unique labels".format(len(images), len(set(labels))))
+            print("\r {} images left and there are {} unique labels".format(len(indx_all), len(np.unique(labels))))
         
         elif self.data_name == "SteeringAngle":
-            indx = np.where((self.labels_all>self.min_label)*(self.labels_all<self.max_label)==True)[0]
-            labels = self.labels_all[indx]
-            images = self.images_all[indx]
+            indx_all = np.where((self.labels_all>self.min_label)*(self.labels_all<self.max_label)==True)[0]
+            labels = self.labels_all[indx_all]
             
             ## replicate minority samples to alleviate the data imbalance issue
-            max_num_img_per_label_after_replica = np.min([self.num_img_per_label_after_replica, self.max_num_img_per_label])
-            if max_num_img_per_label_after_replica>1:
-                unique_labels_replica = np.sort(np.array(list(set(labels))))
-                num_labels_replicated = 0
-                print("\n Start replicating monority samples >>>")
-                for i in trange(len(unique_labels_replica)):
-                    curr_label = unique_labels_replica[i]
-                    indx_i = np.where(labels == curr_label)[0]
-                    if len(indx_i) < max_num_img_per_label_after_replica:
-                        num_img_less = int(max_num_img_per_label_after_replica - len(indx_i))
-                        indx_replica = np.random.choice(indx_i, size = num_img_less, replace=True)
-                        if num_labels_replicated == 0:
-                            images_replica = images[indx_replica]
-                            labels_replica = labels[indx_replica]
-                        else:
-                            images_replica = np.concatenate((images_replica, images[indx_replica]), axis=0)
-                            labels_replica = np.concatenate((labels_replica, labels[indx_replica]))
-                        num_labels_replicated+=1
-                #end for i
-                images = np.concatenate((images, images_replica), axis=0)
-                labels = np.concatenate((labels, labels_replica))
-                print("\r We replicate {} images and labels.".format(len(images_replica)))
+            indx_all, labels = self._replicate_minority(indx_all, labels)
             
-            print("\r {} images left and there are {} unique labels".format(len(images), len(set(labels))))
+            print("\r {} images left and there are {} unique labels".format(len(indx_all), len(np.unique(labels))))
         
         else:
             raise ValueError("Not Supported Dataset!")
         
+        images = self._gather_images(indx_all)
         assert len(labels)==len(images)
         
         print("\n The training set's dimension: {}x{}x{}x{}".format(images.shape[0], images.shape[1], images.shape[2], images.shape[3]))
@@ -267,44 +341,54 @@ class LoadDataSet:
         
         return images, labels, labels_norm
     
-    ## load the evaluation data
-    def load_evaluation_data(self):
+    ## replicate minority samples to alleviate the data imbalance issue; indx_all are indices into the entire dataset
+    def _replicate_minority(self, indx_all, labels):
+        max_num_img_per_label_after_replica = np.min([self.num_img_per_label_after_replica, self.max_num_img_per_label])
+        if max_num_img_per_label_after_replica>1:
+            order, _, counts, starts = _group_by_label(labels)
+            indx_replica_all = []
+            print("\n Start replicating minority samples >>>")
+            ## only labels with too few images draw replicas, in ascending label order
+            for i in np.where(counts < max_num_img_per_label_after_replica)[0]:
+                num_img_less = int(max_num_img_per_label_after_replica - counts[i])
+                indx_replica = np.random.choice(order[starts[i]:(starts[i]+counts[i])], size = num_img_less, replace=True)
+                indx_replica_all.append(indx_replica)
+            #end for i
+            indx_replica_all = np.concatenate(indx_replica_all) if len(indx_replica_all)>0 else np.zeros(0, dtype=int)
+            indx_all = np.concatenate((indx_all, indx_all[indx_replica_all]))
+            labels = np.concatenate((labels, labels[indx_replica_all]))
+            print("\r We replicate {} images and labels (by index; no image is copied).".format(len(indx_replica_all)))
+        return indx_all, labels
+    
+    def _load_evaluation_data(self):
         if self.data_name == "RC-49":
-            images = self.images_all
             labels = self.labels_all
             ## Extract a subset from the entire dataset.
             indx = np.where((labels>self.min_label)*(labels<self.max_label)==True)[0]
             labels = labels[indx]
-            images = images[indx]
+            images = self._gather_images(indx)
             
-            eval_labels = np.sort(np.array(list(set(labels))))
+            eval_labels = np.unique(labels)
         
         elif self.data_name == "RC-49_imb":
-            images = self.images_all
+            images = self._gather_images()
             labels = self.labels_all
 
-            eval_labels = np.sort(np.array(list(set(labels))))
+            eval_labels = np.unique(labels)
         
         elif self.data_name in ["UTKFace", "Cell200"]:
             ## Extract a subset from the entire dataset.
-            images = []
-            labels = []
             selected_labels = np.arange(self.min_label, self.max_label+1)
-            for i in range(len(selected_labels)):
-                curr_label = selected_labels[i]
-                index_curr_label = np.where(self.labels_all==curr_label)[0]
-                images.append(self.images_all[index_curr_label])
-                labels.append(self.labels_all[index_curr_label])
-            # for i
-            images = np.concatenate(images, axis=0)
-            labels = np.concatenate(labels)
+            indx = _select_labels(self.labels_all, selected_labels)
+            labels = self.labels_all[indx]
+            images = self._gather_images(indx)
             
             eval_labels = np.arange(self.min_label, self.max_label+1)
         
         elif self.data_name == "SteeringAngle":
             indx = np.where((self.labels_all>self.min_label)*(self.labels_all<self.max_label)==True)[0]
             labels = self.labels_all[indx]
-            images = self.images_all[indx]
+            images = self._gather_images(indx)
              
             num_eval_labels = 2000
             eval_labels = np.linspace(np.min(labels), np.max(labels), num_eval_labels)
@@ -17,6 +17,8 @@ IMGSg: fake images
 
 import os
 import gc
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 import numpy as np
 # from numpy import linalg as LA
 from scipy import linalg
@@ -28,7 +30,7 @@ from torchvision.utils import save_image
 import torch.utils.data
 from torch.autograd import Variable
 
-from utils import SimpleProgressBar, IMGs_dataset
+from utils import SimpleProgressBar
 
 
 def normalize_images(batch_images):
@@ -36,6 +38,88 @@ def normalize_images(batch_images):
     batch_images = (batch_images - 0.5)/0.5
     return batch_images
 
+##############################################################################
+# Batches of images
+##############################################################################
+_PREFETCH_POOL = None #one background thread shared by all metrics
+
+def _prefetch_pool():
+    global _PREFETCH_POOL
+    if _PREFETCH_POOL is None:
+        _PREFETCH_POOL = ThreadPoolExecutor(max_workers=1, thread_name_prefix="eval_prefetch")
+    return _PREFETCH_POOL
+
+def model_dtype(net):
+    return next(net.parameters()).dtype
+
+# iterate over contiguous slices of images as tensors on the device; the next slice is read (and pinned for CUDA) by the shared prefetch thread while the current one is processed
+def iterate_batches(images, batch_size, device="cuda", norm_img=False, dtype=torch.float):
+    n = len(images)
+    pin = torch.cuda.is_available() and torch.device(device).type=="cuda"
+    def load(start):
+        batch = np.asarray(images[start:(start+batch_size)])
+        if not (batch.flags.writeable and batch.flags.c_contiguous):
+            batch = np.array(batch)
+        batch = torch.from_numpy(batch)
+        return batch.pin_memory() if pin else batch
+    pool = _prefetch_pool()
+    future = pool.submit(load, 0)
+    for start in range(0, n, batch_size):
+        batch = future.result()
+        if start+batch_size < n:
+            future = pool.submit(load, start+batch_size)
+        batch = batch.to(device, non_blocking=True).type(dtype)
+        if norm_img:
+            batch = normalize_images(batch)
+        yield batch
+
+##############################################################################
+# Feature extraction
+##############################################################################
+# push every image through each network exactly once; all metrics are then computed by slicing the returned arrays
+def extract_features(images, nets, batch_size=500, norm_img=True, device="cuda", memmap_folder=None, max_ram_bytes=2**31, verbose=True, n=None):
+    '''
+    images: unnormalized n x nc x img_size x img_size images (numpy array or any array supporting slicing); if n is given, an iterable of such chunks with n images in total
+    nets: dict of name -> network; for networks returning (outputs, features) the outputs are kept
+    memmap_folder: outputs larger than max_ram_bytes are written to memory-mapped '<name>.npy' files in this folder
+    returns a dict of name -> n x d float32 array
+    '''
+    if n is None:
+        n = len(images)
+        images = [images]
+    batch_size = min(batch_size, n)
+    for net in nets.values():
+        net.eval()
+
+    def forward(net, x):
+        out = net(x)
+        if isinstance(out, (tuple, list)):
+            out = out[0]
+        return out.reshape(len(x), -1)
+
+    outputs = {}
+    with torch.no_grad():
+        if verbose:
+            pb = SimpleProgressBar()
+        dtype = model_dtype(next(iter(nets.values())))
+        start = 0
+        for batch_images in (batch for chunk in images for batch in iterate_batches(chunk, batch_size, device=device, norm_img=norm_img, dtype=dtype)):
+            for name, net in nets.items():
+                batch_out = forward(net, batch_images).float().cpu().numpy()
+                if name not in outputs:
+                    shape = (n, batch_out.shape[1])
+                    if memmap_folder is not None and n*batch_out.shape[1]*4>max_ram_bytes:
+                        os.makedirs(memmap_folder, exist_ok=True)
+                        outputs[name] = np.lib.format.open_memmap(os.path.join(memmap_folder, "{}.npy".format(name)), mode="w+", dtype=np.float32, shape=shape)
+                    else:
+                        outputs[name] = np.zeros(shape, dtype=np.float32)
+                outputs[name][start:(start+len(batch_out))] = batch_out
+            start += len(batch_images)
+            if verbose:
+                pb.update(start*100.0/n)
+    assert start==n
+    return outputs
+
 ##############################################################################
 # FID scores
 ##############################################################################
@@ -49,11 +133,16 @@ def FID(Xr, Xg, eps=1e-10):
     #sample mean
     MUr = np.mean(Xr, axis = 0)
     MUg = np.mean(Xg, axis = 0)
-    mean_diff = MUr - MUg
     #sample covariance
     SIGMAr = np.cov(Xr.transpose())
     SIGMAg = np.cov(Xg.transpose())
 
+    return frechet_distance(MUr, SIGMAr, MUg, SIGMAg, eps=eps)
+
+# Frechet distance between N(MUr, SIGMAr) and N(MUg, SIGMAg)
+def frechet_distance(MUr, SIGMAr, MUg, SIGMAg, eps=1e-10):
+    mean_diff = MUr - MUg
+
     # Product might be almost singular
     covmean, _ = linalg.sqrtm(SIGMAr.dot(SIGMAg), disp=False)#square root of a matrix
     covmean = covmean.real
@@ -69,6 +158,105 @@ def FID(Xr, Xg, eps=1e-10):
 
     return fid_score
 
+# sample mean and covariance of the rows X[order[lo[i]:hi[i]]] for each window i
+# running sums of x and x*x^T are updated with the rows entering and leaving the window, so overlapping windows (non-decreasing lo and hi) only pay for the rows that change
+# the linear algebra of the sliding FID runs in torch (float64 on the CPU), so torch.set_num_threads controls its threads
+def sliding_window_stats(X, lo, hi, order=None):
+    if order is None:
+        order = np.arange(len(X))
+    shift = torch.from_numpy(np.asarray(X[order[lo[0]:hi[0]]] if hi[0]>lo[0] else X[order[:1]], dtype=np.float64).mean(axis=0)) #sums of shifted rows keep the covariance well conditioned
+    def rows(a, b):
+        return torch.from_numpy(np.asarray(X[order[a:b]], dtype=np.float64)) - shift
+    cur_lo, cur_hi = 0, 0
+    sum_x, sum_xx = torch.zeros(len(shift), dtype=torch.float64), torch.zeros(len(shift), len(shift), dtype=torch.float64)
+    for a, b in zip(lo, hi):
+        if a>=cur_lo and b>=cur_hi and (a-cur_lo)+(b-cur_hi)<b-a: #slide
+            x_in, x_out = rows(cur_hi, b), rows(cur_lo, a)
+            sum_x += x_in.sum(dim=0) - x_out.sum(dim=0)
+            sum_xx += x_in.T @ x_in - x_out.T @ x_out
+        else: #restart
+            x_in = rows(a, b)
+            sum_x, sum_xx = x_in.sum(dim=0), x_in.T @ x_in
+        cur_lo, cur_hi = a, b
+        n = b - a
+        mu = sum_x/n
+        yield n, (mu+shift).numpy(), ((sum_xx - n*torch.outer(mu, mu))/(n-1)).numpy()
+
+# matrix square roots of a stack of symmetric positive semi-definite k x d x d matrices
+def sqrtm_psd(SIGMA):
+    eigvals, eigvecs = torch.linalg.eigh(torch.from_numpy(np.asarray(SIGMA, dtype=np.float64)))
+    return ((eigvecs*eigvals.clamp(min=0).sqrt().unsqueeze(-2)) @ eigvecs.transpose(-1, -2)).numpy()
+
+# Frechet distances of k pairs at once with the symmetric form Tr(sqrt(C_1*C_2)) = Tr(sqrt(sqrt(C_1)*C_2*sqrt(C_1)))
+# sqrt(C_1) and Tr(C_1) only depend on the real data and can be cached; no diagonal offset is needed since the eigenvalues are clipped at zero
+def frechet_distance_batch(MUr, SQRT_SIGMAr, TRACEr, MUg, SIGMAg):
+    mean_diff = MUr - MUg
+    SQRT_SIGMAr = torch.from_numpy(np.asarray(SQRT_SIGMAr, dtype=np.float64))
+    M = SQRT_SIGMAr @ torch.from_numpy(SIGMAg) @ SQRT_SIGMAr
+    eigvals = torch.linalg.eigvalsh((M + M.transpose(-1, -2))/2)
+    tr_covmean = eigvals.clamp(min=0).sqrt().sum(dim=-1).numpy()
+    return (mean_diff*mean_diff).sum(axis=-1) + TRACEr + np.trace(SIGMAg, axis1=-2, axis2=-1) - 2*tr_covmean
+
+# statistics of the real windows needed by sliding_FID: means, traces and square roots (float32) of the covariances
+def real_window_stats(Xr, lo, hi, order=None, batch_size=50, num_workers=0):
+    if num_workers>1:
+        return merge_center_shards(map_center_shards(real_window_stats, Xr, lo, hi, order, batch_size, num_workers))
+    stats = {"num": hi-lo, "mu": [], "trace": [], "sqrt_sigma": []}
+    windows = sliding_window_stats(Xr, lo, hi, order=order)
+    for start in range(0, len(lo), batch_size):
+        batch = [next(windows) for _ in range(min(batch_size, len(lo)-start))]
+        SIGMAr = np.stack([SIGMA for _, _, SIGMA in batch])
+        stats["mu"].append(np.stack([MU for _, MU, _ in batch]))
+        stats["trace"].append(np.trace(SIGMAr, axis1=-2, axis2=-1))
+        stats["sqrt_sigma"].append(sqrtm_psd(SIGMAr).astype(np.float32))
+    for key in ["mu", "trace", "sqrt_sigma"]:
+        stats[key] = np.concatenate(stats[key])
+    return stats
+
+# FID of every window of the fake features against the cached real window statistics, batch_size windows at a time
+def sliding_FID(real_stats, Xg, lo, hi, order=None, batch_size=50, num_workers=0):
+    if num_workers>1:
+        return np.concatenate(map_center_shards(sliding_FID, Xg, lo, hi, order, batch_size, num_workers, real_stats=real_stats))
+    fids = np.zeros(len(lo))
+    windows = sliding_window_stats(Xg, lo, hi, order=order)
+    for start in range(0, len(lo), batch_size):
+        batch = [next(windows) for _ in range(min(batch_size, len(lo)-start))]
+        stop = start+len(batch)
+        fids[start:stop] = frechet_distance_batch(real_stats["mu"][start:stop], real_stats["sqrt_sigma"][start:stop], real_stats["trace"][start:stop], np.stack([MU for _, MU, _ in batch]), np.stack([SIGMA for _, _, SIGMA in batch]))
+    return fids
+
+##############################################################################
+# Centers sharded over worker processes
+##############################################################################
+# Workers are forked, so they inherit the features (and the real statistics) without copying them; memory-mapped features are shared through the page cache.
+# Each worker gets a contiguous block of centers, so its windows still slide, and 1/num_workers of the torch threads.
+_SHARED = {}
+
+def _init_center_worker(num_threads):
+    torch.set_num_threads(num_threads)
+
+def _run_center_shard(fn, indx, batch_size):
+    X, lo, hi, order = _SHARED["X"], _SHARED["lo"][indx], _SHARED["hi"][indx], _SHARED["order"]
+    if "real_stats" in _SHARED:
+        real_stats = {key: _SHARED["real_stats"][key][indx] for key in ["num", "mu", "trace", "sqrt_sigma"]}
+        return fn(real_stats, X, lo, hi, order=order, batch_size=batch_size)
+    return fn(X, lo, hi, order=order, batch_size=batch_size)
+
+def map_center_shards(fn, X, lo, hi, order, batch_size, num_workers, real_stats=None):
+    shards = [indx for indx in np.array_split(np.arange(len(lo)), num_workers) if len(indx)>0]
+    _SHARED.update({"X": X, "lo": np.asarray(lo), "hi": np.asarray(hi), "order": np.arange(len(X)) if order is None else order})
+    if real_stats is not None:
+        _SHARED["real_stats"] = real_stats
+    try:
+        num_threads = max(1, torch.get_num_threads()//num_workers)
+        with ProcessPoolExecutor(max_workers=len(shards), mp_context=multiprocessing.get_context("fork"), initializer=_init_center_worker, initargs=(num_threads,)) as pool:
+            return list(pool.map(_run_center_shard, [fn]*len(shards), shards, [batch_size]*len(shards)))
+    finally:
+        _SHARED.clear()
+
+def merge_center_shards(shards):
+    return {key: np.concatenate([shard[key] for shard in shards]) for key in shards[0]}
+
 ##test
 #Xr = np.random.rand(10000,1000)
 #Xg = np.random.rand(10000,1000)
@@ -160,6 +348,7 @@ def cal_labelscore(PreNet, images, labels_assi, min_label_before_shift, max_labe
     images: fake images
     labels_assi: assigned labels
     resize: if None, do not resize; if resize = (H,W), resize images to 3 x H x W
+    num_workers: not used; batches are sliced from images and prefetched by a background thread
     '''
 
     PreNet.eval()
@@ -170,36 +359,28 @@ def cal_labelscore(PreNet, images, labels_assi, min_label_before_shift, max_labe
     img_size = images.shape[2]
     labels_assi = labels_assi.reshape(-1)
 
-    eval_trainset = IMGs_dataset(images, labels_assi, normalize=False)
-    eval_dataloader = torch.utils.data.DataLoader(eval_trainset, batch_size=batch_size, shuffle=False, num_workers=num_workers)
-
-    labels_pred = np.zeros(n+batch_size)
+    labels_pred = np.zeros(n)
 
     nimgs_got = 0
     pb = SimpleProgressBar()
-    for batch_idx, (batch_images, batch_labels) in enumerate(eval_dataloader):
-        batch_images = batch_images.type(torch.float).to(device)
-        batch_labels = batch_labels.type(torch.float).to(device)
-        batch_size_curr = len(batch_labels)
-
-        if norm_img:
-            batch_images = normalize_images(batch_images)
-
-        batch_labels_pred, _ = PreNet(batch_images)
-        labels_pred[nimgs_got:(nimgs_got+batch_size_curr)] = batch_labels_pred.detach().cpu().numpy().reshape(-1)
-
-        nimgs_got += batch_size_curr
-        pb.update((float(nimgs_got)/n)*100)
+    with torch.no_grad():
+        for batch_images in iterate_batches(images, batch_size, device=device, norm_img=norm_img, dtype=model_dtype(PreNet)):
+            batch_size_curr = len(batch_images)
+            batch_labels_pred, _ = PreNet(batch_images)
+            labels_pred[nimgs_got:(nimgs_got+batch_size_curr)] = batch_labels_pred.float().cpu().numpy().reshape(-1)
 
-        del batch_images; gc.collect()
-        torch.cuda.empty_cache()
-    #end for batch_idx
+            nimgs_got += batch_size_curr
+            pb.update((float(nimgs_got)/n)*100)
+    #end for batch_images
 
     labels_pred = labels_pred[0:n]
 
+    return labelscore_from_preds(labels_pred, labels_assi, min_label_before_shift, max_label_after_shift)
 
-    labels_pred = (labels_pred*max_label_after_shift)-np.abs(min_label_before_shift)
-    labels_assi = (labels_assi*max_label_after_shift)-np.abs(min_label_before_shift)
+# label score from predicted and assigned labels (both normalized)
+def labelscore_from_preds(labels_pred, labels_assi, min_label_before_shift, max_label_after_shift):
+    labels_pred = (labels_pred.reshape(-1)*max_label_after_shift)-np.abs(min_label_before_shift)
+    labels_assi = (labels_assi.reshape(-1)*max_label_after_shift)-np.abs(min_label_before_shift)
 
     ls_mean = np.mean(np.abs(labels_pred-labels_assi))
     ls_std = np.std(np.abs(labels_pred-labels_assi))
@@ -225,40 +406,53 @@ def inception_score(imgs, num_classes, net, batch_size=32, splits=1, normalize_i
     assert batch_size > 0
     assert N > batch_size
 
-    # Set up dataloader
-    dataset = IMGs_dataset(imgs, labels=None, normalize=normalize_img)
-    dataloader = torch.utils.data.DataLoader(dataset, batch_size=batch_size)
-
     # Load inception model
     net = net.to(device)
     net.eval();
-    def get_pred(x):
-        x,_ = net(x)
-        return F.softmax(x, dim=1).data.cpu().numpy()
-
-    # Get predictions
-    preds = np.zeros((N, num_classes))
-
-    for i, batch in enumerate(dataloader, 0):
-        batch = batch.float().to(device)
-        batchv = Variable(batch)
-        batch_size_i = batch.size()[0]
 
-        preds[i*batch_size:i*batch_size + batch_size_i] = get_pred(batchv)
-
-    # Now compute the mean kl-div
-    split_scores = []
-
-    for k in range(splits):
-        part = preds[k * (N // splits): (k+1) * (N // splits), :]
-        py = np.mean(part, axis=0)
-        scores = []
-        for i in range(part.shape[0]):
-            pyx = part[i, :]
-            scores.append(entropy(pyx, py))
-        split_scores.append(np.exp(np.mean(scores)))
-
-    return np.mean(split_scores), np.std(split_scores)
+    # Accumulate the split statistics batch by batch
+    score = StreamingInceptionScore(N, num_classes, splits=splits, device=device)
+    with torch.no_grad():
+        for batch in iterate_batches(imgs, batch_size, device=device, norm_img=normalize_img, dtype=model_dtype(net)):
+            x, _ = net(batch)
+            score.update(x)
+
+    return score.compute()
+
+# inception score from N x num_classes class probabilities
+def inception_score_from_preds(preds, splits=1, batch_size=10000, device="cpu"):
+    N, num_classes = preds.shape
+    score = StreamingInceptionScore(N, num_classes, splits=splits, device=device)
+    for start in range(0, N, batch_size):
+        score.update(torch.log(torch.as_tensor(np.asarray(preds[start:(start+batch_size)]), device=device)))
+    return score.compute()
+
+# The mean KL divergence of split k is mean_i sum_c p_ic*log(p_ic) - sum_c py_c*log(py_c) with py = mean_i p_i,
+# so only the per-split sums of p and of p*log(p) are kept, on the device and in float64, while batches of logits stream in.
+# Split k holds images k*(N//splits) to (k+1)*(N//splits)-1 in the order they are passed to update.
+class StreamingInceptionScore:
+    def __init__(self, N, num_classes, splits=1, device="cuda"):
+        self.splits = splits
+        self.split_size = N // splits
+        self.sum_p = torch.zeros(splits, num_classes, dtype=torch.float64, device=device)
+        self.sum_plogp = torch.zeros(splits, dtype=torch.float64, device=device)
+        self.num_seen = 0
+
+    def update(self, logits):
+        logp = F.log_softmax(logits.to(self.sum_p.device, torch.float64), dim=1)
+        p = logp.exp()
+        plogp = torch.where(p>0, p*logp, torch.zeros_like(p)).sum(dim=1)
+        split_indx = torch.arange(self.num_seen, self.num_seen+len(logits), device=p.device) // self.split_size
+        keep = split_indx < self.splits
+        self.sum_p.index_add_(0, split_indx[keep], p[keep])
+        self.sum_plogp.index_add_(0, split_indx[keep], plogp[keep])
+        self.num_seen += len(logits)
+
+    def compute(self):
+        py = self.sum_p/self.split_size
+        kl = self.sum_plogp/self.split_size - torch.xlogy(py, py).sum(dim=1)
+        split_scores = torch.exp(kl).cpu().numpy()
+        return np.mean(split_scores), np.std(split_scores)
 
 
 ##############################################################################
@@ -279,25 +473,21 @@ def predict_class_labels(net, images, batch_size=500, verbose=False, num_workers
     n = len(images)
     if batch_size>n:
         batch_size=n
-    dataset_pred = IMGs_dataset(images, normalize=False)
-    dataloader_pred = torch.utils.data.DataLoader(dataset_pred, batch_size=batch_size, shuffle=False, num_workers=num_workers)
-
-    class_labels_pred = np.zeros(n+batch_size)
+    class_labels_pred = np.zeros(n)
     with torch.no_grad():
         nimgs_got = 0
         if verbose:
             pb = SimpleProgressBar()
-        for batch_idx, batch_images in enumerate(dataloader_pred):
-            batch_images = batch_images.type(torch.float).to(device)
+        for batch_images in iterate_batches(images, batch_size, device=device, norm_img=False, dtype=model_dtype(net)):
             batch_size_curr = len(batch_images)
 
             outputs,_ = net(batch_images)
             _, batch_class_labels_pred = torch.max(outputs.data, 1)
-            class_labels_pred[nimgs_got:(nimgs_got+batch_size_curr)] = batch_class_labels_pred.detach().cpu().numpy().reshape(-1)
+            class_labels_pred[nimgs_got:(nimgs_got+batch_size_curr)] = batch_class_labels_pred.cpu().numpy().reshape(-1)
 
             nimgs_got += batch_size_curr
             if verbose:
                 pb.update((float(nimgs_got)/n)*100)
-        #end for batch_idx
+        #end for batch_images
     class_labels_pred = class_labels_pred[0:n]
     return class_labels_pred
\ No newline at end of file
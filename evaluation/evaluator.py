@@ -18,16 +18,21 @@ import timeit
 from datetime import datetime 
 import os
 
-from .eval_metrics import cal_FID, cal_labelscore, inception_score, predict_class_labels, compute_entropy
+from .export import group_by_label, make_pool, submit_tasks, wait_tasks, write_label_h5, write_pngs, dump_consolidated_h5
+from .niqe import load_niqe_model, niqe_scores
+from .ref_stats import ref_fingerprint, load_ref_stats, save_ref_stats
+from .eval_metrics import extract_features, frechet_distance, real_window_stats, sliding_FID, labelscore_from_preds, StreamingInceptionScore, compute_entropy
 
 class Evaluator:
-    def __init__(self, dataset, trainer, args, device):
+    def __init__(self, dataset, trainer, args, device, path_to_spill=None):
         self.dataset = dataset
         self.trainer = trainer
         self.data_name = args.data_name
         self.img_size = args.img_size
         self.args = args
         self.device = device
+        self.real_stats_cache = {} #statistics of the real images, see load_real_stats
+        self.path_to_ref_stats = os.path.join(args.root_path, 'output/{}_{}'.format(args.data_name, args.img_size), 'eval_ref')
         
         print("\n ====================================================================================")
         print("\r Start evaluation...")
@@ -88,8 +93,6 @@ class Evaluator:
         
 
         ## generating fake data
-        print("\n Start generating fake image-label pairs for evaluation...")
-        start = timeit.default_timer()
         self.fake_labels = []
         for i in range(self.num_eval_labels):
             curr_label = self.eval_labels[i]
@@ -97,15 +100,64 @@ class Evaluator:
             self.fake_labels.append(fake_labels_i)
         ##end for i
         self.fake_labels = np.concatenate(self.fake_labels)
-        if args.do_subsampling and args.use_dre_reg:
-            self.fake_images, _ = self.trainer.rejection_sampling_given_labels(dataset.fn_normalize_labels(self.fake_labels), self.nburnin_per_label, batch_size=args.samp_batch_size, verbose=True)
+        self.fake_images = None
+        self.sampling_time = 0.0
+        ## in streaming mode, fake images are generated label chunk by label chunk whenever they are needed (see iterate_fake_chunks) and only their features are kept
+        ## with path_to_spill, the generated images are also written to a chunked h5 file, so that later passes (dumps and metrics) read the same images back
+        self.streaming = args.eval_streaming
+        self.path_to_spill = path_to_spill
+        if path_to_spill is not None and os.path.isfile(path_to_spill): #images of an earlier run
+            os.remove(path_to_spill)
+        if not self.streaming:
+            print("\n Start generating fake image-label pairs for evaluation...")
+            self.fake_images, _ = self.generate_fake_images(self.eval_labels)
+            assert self.fake_images.max()>1.0
+            print("\r Got {} fake images. Time spent {:.2f} sec.".format(len(self.fake_images), self.sampling_time))
+            print("\r Fake images shape:", self.fake_images.shape)
+        
+    
+    ## generate fake images for the given evaluation labels
+    def generate_fake_images(self, eval_labels):
+        start = timeit.default_timer()
+        fake_labels = np.repeat(eval_labels, self.nfake_per_label)
+        if self.args.do_subsampling and self.args.use_dre_reg:
+            fake_images, _ = self.trainer.rejection_sampling_given_labels(self.dataset.fn_normalize_labels(fake_labels), self.nburnin_per_label, batch_size=self.args.samp_batch_size, verbose=True)
+        else:
+            fake_images, _ = self.trainer.sample_given_labels(self.dataset.fn_normalize_labels(fake_labels), batch_size=self.args.samp_batch_size, denorm=True, to_numpy=True, verbose=True)
+        self.sampling_time += timeit.default_timer()-start
+        return fake_images, fake_labels
+    
+    ## iterate over the fake images in chunks of whole labels: slices of self.fake_images, chunks read back from the spill file, or freshly generated chunks in streaming mode
+    def iterate_fake_chunks(self):
+        num_labels_per_chunk = max(1, self.args.eval_stream_chunk_size//self.nfake_per_label)
+        chunk_size = num_labels_per_chunk*self.nfake_per_label
+        if self.fake_images is not None:
+            for start in range(0, len(self.fake_labels), chunk_size):
+                yield self.fake_images[start:(start+chunk_size)], self.fake_labels[start:(start+chunk_size)]
+        elif self.path_to_spill is not None and os.path.isfile(self.path_to_spill):
+            with h5py.File(self.path_to_spill, "r") as hf:
+                for start in range(0, len(self.fake_labels), chunk_size):
+                    yield hf["fake_images"][start:(start+chunk_size)], hf["fake_labels"][start:(start+chunk_size)]
         else:
-            self.fake_images, _ = self.trainer.sample_given_labels(dataset.fn_normalize_labels(self.fake_labels), batch_size=args.samp_batch_size, denorm=True, to_numpy=True, verbose=True)
-        stop = timeit.default_timer()
-        assert self.fake_images.max()>1.0
-        print("\r {}/{}: Got {} fake images. Time spent {:.2f} sec.".format(i+1, self.num_eval_labels, len(self.fake_images), stop-start))
-        print("\r Fake images shape:", self.fake_images.shape)
-        self.sampling_time = stop-start
+            print("\n Start generating fake image-label pairs for evaluation in chunks of {} labels...".format(num_labels_per_chunk))
+            hf = None
+            if self.path_to_spill is not None:
+                os.makedirs(os.path.dirname(self.path_to_spill), exist_ok=True)
+                hf = h5py.File(self.path_to_spill + ".tmp", "w")
+            n_got = 0
+            for i in range(0, self.num_eval_labels, num_labels_per_chunk):
+                fake_images_i, fake_labels_i = self.generate_fake_images(self.eval_labels[i:(i+num_labels_per_chunk)])
+                if hf is not None:
+                    if "fake_images" not in hf:
+                        hf.create_dataset("fake_images", shape=(len(self.fake_labels),)+fake_images_i.shape[1:], dtype='uint8', chunks=(min(self.nfake_per_label, len(self.fake_labels)),)+fake_images_i.shape[1:])
+                        hf.create_dataset("fake_labels", data=self.fake_labels, dtype='float')
+                    hf["fake_images"][n_got:(n_got+len(fake_images_i))] = fake_images_i
+                n_got += len(fake_images_i)
+                print("\r {}/{}: Got {} fake images. Time spent {:.2f} sec.".format(min(i+num_labels_per_chunk, self.num_eval_labels), self.num_eval_labels, n_got, self.sampling_time))
+                yield fake_images_i, fake_labels_i
+            if hf is not None:
+                hf.close()
+                os.replace(self.path_to_spill + ".tmp", self.path_to_spill)
         
     
     ## method for computing evaluation metrics: SFID, Diversity, LS, FID, IS
@@ -129,7 +181,7 @@ class Evaluator:
         PreNetLS.load_state_dict(checkpoint_PreNet['net_state_dict'])
         
         # normalize labels
-        nfake_all = len(self.fake_images)
+        nfake_all = len(self.fake_labels)
         nreal_all = len(self.real_images)
         
         FID_radius = 0.0
@@ -146,37 +198,47 @@ class Evaluator:
             centers_loc = np.arange(1, 201) #not normalized
         print(centers_loc)
         
-        FID_over_centers = np.zeros(len(centers_loc))
         entropies_over_centers = np.zeros(len(centers_loc)) # entropy at each center
         labelscores_over_centers = np.zeros(len(centers_loc)) #label score at each center
         num_realimgs_over_centers = np.zeros(len(centers_loc))
         
         start_time = timeit.default_timer()
         
+        ## extract features, class logits and regression outputs of every image exactly once
+        use_diversity = self.data_name in ["UTKFace", "RC-49", "RC-49_imb", "SteeringAngle"]
+        fake_nets = {"fid": PreNetFID, "ls": PreNetLS}
+        if use_diversity:
+            fake_nets["class"] = PreNetDiversity
+        print("\n Extracting features of {} fake images...".format(nfake_all))
+        fake_outputs = extract_features((fake_images_i for fake_images_i, _ in self.iterate_fake_chunks()), fake_nets, batch_size=self.args.eval_batch_size, norm_img=True, device=self.device, memmap_folder=os.path.join(output_path, "features_fake"), n=nfake_all)
+        fake_labels_pred = fake_outputs["ls"].reshape(-1).astype(np.float64)
+        if use_diversity:
+            fake_class_labels = np.argmax(fake_outputs["class"], axis=1)
+        print("\n Feature extraction takes {:.3f} sec.".format(timeit.default_timer()-start_time))
+        
+        ## windows over label-sorted images; sliding FID uses running sufficient statistics of the sorted features
+        order_real = np.argsort(self.real_labels, kind="stable")
+        order_fake = np.argsort(self.fake_labels, kind="stable")
+        lo_real = np.searchsorted(self.real_labels[order_real], centers_loc-FID_radius, side="left")
+        hi_real = np.searchsorted(self.real_labels[order_real], centers_loc+FID_radius, side="right")
+        lo_fake = np.searchsorted(self.fake_labels[order_fake], centers_loc-FID_radius, side="left")
+        hi_fake = np.searchsorted(self.fake_labels[order_fake], centers_loc+FID_radius, side="right")
+        real_stats = self.load_real_stats(PreNetFID, FID_radius, centers_loc, lo_real, hi_real, order_real, output_path)
+        FID_over_centers = sliding_FID(real_stats, fake_outputs["fid"], lo_fake, hi_fake, order=order_fake, num_workers=self.args.eval_num_workers)
+        print("\n SFID over {} centers takes {:.3f} sec.".format(len(centers_loc), timeit.default_timer()-start_time))
+        
         for i in range(len(centers_loc)):
             center = centers_loc[i]
-            interval_start = center - FID_radius
-            interval_stop = center + FID_radius
-            indx_real = np.where((self.real_labels>=interval_start)*(self.real_labels<=interval_stop)==True)[0]
-            np.random.shuffle(indx_real)
-            real_images_i = self.real_images[indx_real]
-            real_images_i = (real_images_i/255.0-0.5)/0.5
-            num_realimgs_over_centers[i] = len(real_images_i)
-            indx_fake = np.where((self.fake_labels>=interval_start)*(self.fake_labels<=interval_stop)==True)[0]
-            np.random.shuffle(indx_fake)
-            fake_images_i = self.fake_images[indx_fake]
-            fake_images_i = (fake_images_i/255.0-0.5)/0.5
+            num_realimgs_over_centers[i] = real_stats["num"][i]
+            indx_fake = order_fake[lo_fake[i]:hi_fake[i]]
             fake_labels_assigned_i = self.fake_labels[indx_fake]
-            # FID
-            FID_over_centers[i] = cal_FID(PreNetFID, real_images_i, fake_images_i, batch_size=self.args.eval_batch_size, resize = None, device=self.device)
             # Entropy of predicted class labels
-            if self.data_name in ["UTKFace", "RC-49", "RC-49_imb", "SteeringAngle"]:
-                predicted_class_labels = predict_class_labels(PreNetDiversity, fake_images_i, batch_size=self.args.eval_batch_size, num_workers=self.args.num_workers, device=self.device)
-                entropies_over_centers[i] = compute_entropy(predicted_class_labels)
+            if use_diversity:
+                entropies_over_centers[i] = compute_entropy(fake_class_labels[indx_fake])
             # Label score
-            labelscores_over_centers[i], _ = cal_labelscore(PreNetLS, fake_images_i, self.dataset.fn_normalize_labels(fake_labels_assigned_i), min_label_before_shift=self.min_label_before_shift, max_label_after_shift=self.max_label_after_shift, batch_size = self.args.eval_batch_size, resize = None, num_workers=self.args.num_workers, device=self.device)
+            labelscores_over_centers[i], _ = labelscore_from_preds(fake_labels_pred[indx_fake], self.dataset.fn_normalize_labels(fake_labels_assigned_i), min_label_before_shift=self.min_label_before_shift, max_label_after_shift=self.max_label_after_shift)
 
-            print("\n Center:{}; Real:{}; Fake:{}; FID:{:.3f}; LS:{:.3f}; ET:{:.3f}; Time:{:.3f}.".format(center, len(real_images_i), len(fake_images_i), FID_over_centers[i], labelscores_over_centers[i], entropies_over_centers[i], timeit.default_timer()-start_time))
+            print("\n Center:{}; Real:{}; Fake:{}; FID:{:.3f}; LS:{:.3f}; ET:{:.3f}; Time:{:.3f}.".format(center, int(num_realimgs_over_centers[i]), len(indx_fake), FID_over_centers[i], labelscores_over_centers[i], entropies_over_centers[i], timeit.default_timer()-start_time))
         ##end for i
         
         # average over all centers
@@ -190,20 +252,24 @@ class Evaluator:
         
         #####################
         # Overall LS: abs(y_assigned - y_predicted)
-        ls_mean_overall, ls_std_overall = cal_labelscore(PreNetLS, self.fake_images, self.dataset.fn_normalize_labels(self.fake_labels), min_label_before_shift=self.min_label_before_shift, max_label_after_shift=self.max_label_after_shift, batch_size=self.args.eval_batch_size, resize = None, norm_img = True, num_workers=self.args.num_workers, device=self.device)
+        ls_mean_overall, ls_std_overall = labelscore_from_preds(fake_labels_pred, self.dataset.fn_normalize_labels(self.fake_labels), min_label_before_shift=self.min_label_before_shift, max_label_after_shift=self.max_label_after_shift)
         print("Overall LS of {} fake images: {:.3f} ({:.3f}). \n".format(nfake_all, ls_mean_overall, ls_std_overall))
         
         #####################
         # FID: Evaluate FID on all fake images
-        indx_shuffle_real = np.arange(nreal_all); np.random.shuffle(indx_shuffle_real)
-        indx_shuffle_fake = np.arange(nfake_all); np.random.shuffle(indx_shuffle_fake)
-        FID = cal_FID(PreNetFID, self.real_images[indx_shuffle_real], self.fake_images[indx_shuffle_fake], batch_size=self.args.eval_batch_size, resize = None, norm_img = True, device=self.device)
-        print("FID of {} fake images: {:.3f}.\n".format(nfake_all, FID))
+        fake_features = np.asarray(fake_outputs["fid"], dtype=np.float64)
+        FID_all = frechet_distance(real_stats["mu_all"], real_stats["sigma_all"], np.mean(fake_features, axis=0), np.cov(fake_features.transpose()), eps=1e-6)
+        del fake_features
+        print("FID of {} fake images: {:.3f}.\n".format(nfake_all, FID_all))
 
         #####################
         # Compute IS
         if self.data_name != "Cell200":
-            IS, IS_std = inception_score(imgs=self.fake_images[indx_shuffle_fake], num_classes=self.num_classes, net=PreNetDiversity, batch_size=self.args.eval_batch_size, splits=10, normalize_img=True, device=self.device)
+            indx_shuffle_fake = np.arange(nfake_all); np.random.shuffle(indx_shuffle_fake)
+            IS_acc = StreamingInceptionScore(nfake_all, fake_outputs["class"].shape[1], splits=10, device=self.device)
+            for start in range(0, nfake_all, self.args.eval_batch_size):
+                IS_acc.update(torch.from_numpy(np.asarray(fake_outputs["class"][indx_shuffle_fake[start:(start+self.args.eval_batch_size)]])))
+            IS, IS_std = IS_acc.compute()
             print("IS of {} fake images: {:.3f} ({:.3f}).\n".format(nfake_all, IS, IS_std))
         
         #####################
@@ -222,56 +288,115 @@ class Evaluator:
             eval_results_logging_file.write("\n SFID: {:.3f} ({:.3f})".format(np.mean(FID_over_centers), np.std(FID_over_centers)))
             eval_results_logging_file.write("\n LS: {:.3f} ({:.3f})".format(ls_mean_overall, ls_std_overall))
             eval_results_logging_file.write("\n Diversity: {:.3f} ({:.3f})".format(np.mean(entropies_over_centers), np.std(entropies_over_centers)))
-            eval_results_logging_file.write("\n FID: {:.3f}".format(FID))
+            eval_results_logging_file.write("\n FID: {:.3f}".format(FID_all))
             if self.data_name in ["UTKFace", "RC-49", "RC-49_imb", "SteeringAngle"]:
                 eval_results_logging_file.write("\n IS (STD): {:.3f} ({:.3f})".format(IS, IS_std)) 
         
 
     ##end def compute_metrics
+    
+    
+    ## method for computing NIQE of the fake images with a model of pretrain_niqe.py, directly from the image arrays (no png files)
+    def compute_niqe(self, path_to_model, output_path):
+        model = load_niqe_model(path_to_model)
+        print("\n Computing NIQE of fake images with {} >>>".format(path_to_model))
+        start_time = timeit.default_timer()
+        niqe_all = []
+        for fake_images_chunk, _ in self.iterate_fake_chunks():
+            niqe_all.append(niqe_scores(fake_images_chunk, model, batch_size=self.args.eval_batch_size, num_workers=self.args.niqe_num_workers))
+        niqe_all = np.concatenate(niqe_all)
+        niqe_over_labels = np.array([np.nanmean(niqe_all[self.fake_labels==label]) for label in self.eval_labels]) #images without a complete block have no NIQE
+        print("\r NIQE of {} fake images: {:.3f} ({:.3f}). Time spent {:.2f} sec.".format(np.sum(~np.isnan(niqe_all)), np.nanmean(niqe_all), np.nanstd(niqe_all), timeit.default_timer()-start_time))
+        np.savez(os.path.join(output_path, 'niqe_over_labels.npz'), niqe=niqe_all, fake_labels=self.fake_labels, niqe_over_labels=niqe_over_labels, eval_labels=self.eval_labels)
+        with open(os.path.join(output_path, 'niqe_results.txt'), 'a') as niqe_results_file:
+            niqe_results_file.write("\n NIQE model: {}".format(path_to_model))
+            niqe_results_file.write("\n NIQE: {:.3f} ({:.3f})".format(np.nanmean(niqe_all), np.nanstd(niqe_all)))
+        return niqe_all
+    
+    
+    ## statistics of the real images: overall feature mean and covariance, and per-center window statistics for the sliding FID
+    ## they only depend on the dataset, the label filters, the centers and the FID encoder, so they are loaded from the reference store if possible
+    def load_real_stats(self, PreNetFID, FID_radius, centers_loc, lo_real, hi_real, order_real, output_path):
+        settings = (self.data_name, self.dataset.min_label, self.dataset.max_label, self.dataset.imbalance_type, FID_radius, centers_loc)
+        path_to_stats = os.path.join(self.path_to_ref_stats, "{}.npz".format(ref_fingerprint(self.dataset.h5_path, self.fid_net_path, settings)))
+        if path_to_stats in self.real_stats_cache:
+            return self.real_stats_cache[path_to_stats]
+        real_stats = load_ref_stats(path_to_stats)
+        if real_stats is not None:
+            print("\n Loaded reference statistics of real images from {}.".format(path_to_stats))
+        else:
+            print("\n Extracting features of {} real images...".format(len(self.real_images)))
+            real_features = extract_features(self.real_images, {"fid": PreNetFID}, batch_size=self.args.eval_batch_size, norm_img=True, device=self.device, memmap_folder=os.path.join(output_path, "features_real"))["fid"]
+            real_stats = real_window_stats(real_features, lo_real, hi_real, order=order_real, num_workers=self.args.eval_num_workers)
+            real_features = np.asarray(real_features, dtype=np.float64)
+            real_stats["mu_all"] = np.mean(real_features, axis=0)
+            real_stats["sigma_all"] = np.cov(real_features.transpose())
+            del real_features
+            save_ref_stats(path_to_stats, real_stats)
+            print("\n Saved reference statistics of real images to {}.".format(path_to_stats))
+        self.real_stats_cache[path_to_stats] = real_stats
+        return real_stats
         
         
-    ## method for dumping png images
+    ## method for dumping png images; the png files of a chunk are encoded by args.dump_num_workers worker processes while the next chunk is generated or read
     def dump_png_images(self, output_path):
         print("\n Dumping fake images for NIQE >>>")
         os.makedirs(output_path, exist_ok=True)
         
-        for i in tqdm(range(len(self.fake_images))):
-            label_i = self.fake_labels[i]
-            if self.data_name in ["RC-49","RC-49_imb"]:
-                filename_i = output_path + "/{}_{:.1f}.png".format(i, label_i)
-            elif self.data_name == "SteeringAngle":
-                filename_i = output_path + "/{}_{:.6f}.png".format(i, label_i)
-            else:
-                # filename_i = output_path + "/{}_{}.png".format(i, int(label_i))
-                filename_i = output_path + "/{}_{}.png".format(i, round(label_i))
-            os.makedirs(os.path.dirname(filename_i), exist_ok=True)
-            image_i = self.fake_images[i].astype(np.uint8)
-            image_i_pil = Image.fromarray(image_i.transpose(1,2,0))
-            image_i_pil.save(filename_i)
+        num_workers = self.args.dump_num_workers
+        pool = make_pool(num_workers)
+        pending = []
+        i = 0
+        for fake_images_chunk, fake_labels_chunk in self.iterate_fake_chunks():
+            filenames = []
+            for label_i in fake_labels_chunk:
+                if self.data_name in ["RC-49","RC-49_imb"]:
+                    filename_i = output_path + "/{}_{:.1f}.png".format(i, label_i)
+                elif self.data_name == "SteeringAngle":
+                    filename_i = output_path + "/{}_{:.6f}.png".format(i, label_i)
+                else:
+                    # filename_i = output_path + "/{}_{}.png".format(i, int(label_i))
+                    filename_i = output_path + "/{}_{}.png".format(i, round(label_i))
+                filenames.append(filename_i)
+                i += 1
+            pending = wait_tasks(pending)
+            step = -(-len(filenames)//max(1, num_workers))
+            pending = submit_tasks(pool, write_pngs, [(filenames[j:(j+step)], fake_images_chunk[j:(j+step)]) for j in range(0, len(filenames), step)])
+            print("\r Dumped {}/{} png images.".format(i, len(self.fake_labels)))
+        wait_tasks(pending)
+        if pool is not None:
+            pool.shutdown()
         #end for i
     
     
-    ## method for dumping h5 files
+    ## method for dumping h5 files; one h5 file (and a 6x6 sample grid) per label, written by args.dump_num_workers worker processes
     def dump_h5_files(self, output_path):
         print("\n Dumping h5 files...")
-        for i in range(self.num_eval_labels):
-            label_i = self.eval_labels[i]
-            indx_i = np.where(self.fake_labels==label_i)[0]
-            fake_images_i = self.fake_images[indx_i]
-            fake_labels_i = self.fake_labels[indx_i]
-            print('\r [{}/{}]: Got {} fake images for label {} >>>'.format(i+1, self.num_eval_labels, len(indx_i), label_i))
-            dump_fake_images_filename = os.path.join(output_path, '{}.h5'.format(label_i))
-            with h5py.File(dump_fake_images_filename, "w") as f:
-                f.create_dataset('fake_images_i', data = fake_images_i, dtype='uint8', compression="gzip", compression_opts=6)
-                f.create_dataset('fake_labels_i', data = fake_labels_i, dtype='float')
-                f.create_dataset('sample_time_i', data = np.array([0]), dtype='float') #to avoid error
-            ## dump some imgs for visualization
-            img_vis_i = fake_images_i[0:36]/255.0
-            img_vis_i = torch.from_numpy(img_vis_i)
-            img_filename = os.path.join(output_path, 'sample_{}.png'.format(label_i))
-            torchvision.utils.save_image(img_vis_i.data, img_filename, nrow=6, normalize=False)
-            del fake_images_i, fake_labels_i; gc.collect()
+        pool = make_pool(self.args.dump_num_workers)
+        pending = []
+        i = 0
+        for fake_images_chunk, fake_labels_chunk in self.iterate_fake_chunks():
+            tasks = []
+            for label_i, indx_i in zip(*group_by_label(fake_labels_chunk)):
+                print('\r [{}/{}]: Got {} fake images for label {} >>>'.format(i+1, self.num_eval_labels, len(indx_i), label_i))
+                dump_fake_images_filename = os.path.join(output_path, '{}.h5'.format(label_i))
+                img_filename = os.path.join(output_path, 'sample_{}.png'.format(label_i))
+                tasks.append((dump_fake_images_filename, img_filename, fake_images_chunk[indx_i], fake_labels_chunk[indx_i], self.args.dump_h5_compression))
+                i += 1
+            pending = wait_tasks(pending)
+            pending = submit_tasks(pool, write_label_h5, tasks)
+            del tasks; gc.collect()
+        wait_tasks(pending)
+        if pool is not None:
+            pool.shutdown()
         ##end for i
+    
+    
+    ## method for dumping all fake images into one h5 file with a label index (see export.dump_consolidated_h5)
+    def dump_consolidated_h5(self, path_to_h5):
+        print("\n Dumping fake images into {}...".format(path_to_h5))
+        os.makedirs(os.path.dirname(path_to_h5), exist_ok=True)
+        dump_consolidated_h5(path_to_h5, self.iterate_fake_chunks(), len(self.fake_labels), chunk_rows=self.nfake_per_label, compression=self.args.dump_h5_compression)
             
 
 
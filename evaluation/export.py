@@ -0,0 +1,113 @@
+"""
+Export of fake images for Evaluator.dump_h5_files, Evaluator.dump_consolidated_h5 and Evaluator.dump_png_images.
+
+Images are grouped by label once with a stable sort; per-label h5 files and png files are written by a pool of forked worker processes (h5py serializes all calls within a process, so threads would not help).
+As an alternative to one file per label, dump_consolidated_h5 writes all images into a single chunked h5 file with a label index.
+
+"""
+
+import os
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import h5py
+import torch
+import torchvision
+from PIL import Image
+
+
+## keyword arguments of h5py's create_dataset for a compression filter
+def h5_compression(name):
+    '''
+    name: 'gzip' (level 6, as before), 'lzf', 'blosc' (lz4 inside blosc, byte shuffle), 'lz4' or 'none'; blosc and lz4 need the hdf5plugin package
+    '''
+    if name == "gzip":
+        return {"compression": "gzip", "compression_opts": 6}
+    elif name == "lzf":
+        return {"compression": "lzf"}
+    elif name in ["blosc", "lz4"]:
+        try:
+            import hdf5plugin
+        except ImportError:
+            raise ImportError("The {} filter needs the hdf5plugin package (pip install hdf5plugin).".format(name))
+        if name == "blosc":
+            return dict(hdf5plugin.Blosc(cname="lz4", clevel=5, shuffle=hdf5plugin.Blosc.SHUFFLE))
+        return dict(hdf5plugin.LZ4())
+    elif name == "none":
+        return {}
+    else:
+        raise ValueError("Not Supported Compression: {}!".format(name))
+
+
+## group the indices of labels by label with one stable sort; returns the unique labels and the indices of each label
+def group_by_label(labels):
+    order = np.argsort(labels, kind="stable")
+    unique_labels, starts = np.unique(labels[order], return_index=True)
+    return unique_labels, np.split(order, starts[1:])
+
+
+## a pool of forked worker processes, or None for num_workers <= 1
+def make_pool(num_workers):
+    if num_workers <= 1:
+        return None
+    return ProcessPoolExecutor(max_workers=num_workers, mp_context=multiprocessing.get_context("fork"))
+
+## submit fn over the tasks to the pool and return the futures; without a pool, the tasks run here and nothing is pending
+def submit_tasks(pool, fn, tasks):
+    if pool is None:
+        for task in tasks:
+            fn(*task)
+        return []
+    return [pool.submit(fn, *task) for task in tasks]
+
+## wait for the futures of submit_tasks (raises the first error of a worker)
+def wait_tasks(futures):
+    for future in futures:
+        future.result()
+    return []
+
+
+## one h5 file per label, plus a 6x6 grid of its first images for visualization
+def write_label_h5(path_to_h5, path_to_grid, fake_images_i, fake_labels_i, compression="gzip"):
+    with h5py.File(path_to_h5, "w") as f:
+        f.create_dataset('fake_images_i', data = fake_images_i, dtype='uint8', chunks=(min(len(fake_images_i), 256),)+fake_images_i.shape[1:], **h5_compression(compression))
+        f.create_dataset('fake_labels_i', data = fake_labels_i, dtype='float')
+        f.create_dataset('sample_time_i', data = np.array([0]), dtype='float') #to avoid error
+    img_vis_i = torch.from_numpy(fake_images_i[0:36]/255.0)
+    torchvision.utils.save_image(img_vis_i.data, path_to_grid, nrow=6, normalize=False)
+
+
+## png files of n x nc x h x w uint8 images
+def write_pngs(filenames, images):
+    for filename_i, image_i in zip(filenames, images):
+        image_i = image_i.astype(np.uint8).transpose(1,2,0)
+        if image_i.shape[2] == 1:
+            image_i = image_i[:,:,0]
+        Image.fromarray(image_i).save(filename_i)
+
+
+## all fake images in a single h5 file: 'fake_images' and 'fake_labels' in label order, and a label index ('labels', 'label_start', 'label_count') so that the images of a label are fake_images[label_start[k]:label_start[k]+label_count[k]]
+def dump_consolidated_h5(path_to_h5, chunks, num_images, chunk_rows=1000, compression="gzip"):
+    '''
+    chunks: iterable of (fake_images, fake_labels) chunks with num_images images in total
+    '''
+    path_to_tmp = path_to_h5 + ".tmp"
+    all_labels = []
+    with h5py.File(path_to_tmp, "w") as f:
+        n_got = 0
+        for fake_images_chunk, fake_labels_chunk in chunks:
+            unique_labels, groups = group_by_label(fake_labels_chunk)
+            order = np.concatenate(groups)
+            if "fake_images" not in f:
+                f.create_dataset("fake_images", shape=(num_images,)+fake_images_chunk.shape[1:], dtype='uint8', chunks=(min(chunk_rows, num_images),)+fake_images_chunk.shape[1:], **h5_compression(compression))
+            f["fake_images"][n_got:(n_got+len(order))] = fake_images_chunk[order]
+            all_labels.append(fake_labels_chunk[order])
+            n_got += len(order)
+        assert n_got == num_images
+        all_labels = np.concatenate(all_labels)
+        labels, label_start, label_count = np.unique(all_labels, return_index=True, return_counts=True)
+        f.create_dataset("fake_labels", data=all_labels, dtype='float')
+        f.create_dataset("labels", data=labels, dtype='float')
+        f.create_dataset("label_start", data=label_start, dtype='int64')
+        f.create_dataset("label_count", data=label_count, dtype='int64')
+    os.replace(path_to_tmp, path_to_h5)
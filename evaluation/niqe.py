@@ -0,0 +1,204 @@
+"""
+NIQE (Mittal et al., "Making a completely blind image quality analyzer", 2013) in NumPy/SciPy, replacing MATLAB's fitniqe/niqe.
+
+It follows the reference implementation that MATLAB's functions are based on: images are converted to 8-bit gray (rgb2gray), cropped to a multiple of the block size, and for two scales (the second one by MATLAB-style bicubic imresize with antialiasing) the MSCN coefficients (7x7 Gaussian window, sigma 7/6, C=1) are split into non-overlapping blocks.
+Each block gives 18 features per scale: the GGD shape and scale of the coefficients, and the AGGD shape, mean, left and right scales of the products of horizontally, vertically and diagonally (circularly) adjacent coefficients.
+To fit a model, only blocks whose mean local deviation exceeds sharpness_threshold times the maximum of their image are kept; the model is the mean (ignoring NaNs) and the covariance (over complete rows) of their features.
+The NIQE of an image is the distance between the model and a Gaussian fitted to all blocks of the image.
+
+All blocks of a batch of images are processed at once; batches are spread over forked worker processes, and only per-batch sums are returned when fitting, so that memory does not grow with the number of training images.
+Models are saved as .mat files holding a struct 'model' with the fields of MATLAB's niqeModel (Mean, Covariance, BlockSize, SharpnessThreshold); in MATLAB, niqeModel(model.Mean, model.Covariance, model.BlockSize, model.SharpnessThreshold) rebuilds the model object.
+
+"""
+
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import scipy.io as sio
+from scipy import ndimage
+from scipy.special import gamma as gamma_fn
+
+
+## 7x7 Gaussian window of fspecial('gaussian', 7, 7/6)
+def _gaussian_window(size=7, sigma=7/6):
+    x = np.arange(size) - (size-1)/2
+    w = np.exp(-(x[:,None]**2 + x[None,:]**2)/(2*sigma**2))
+    return w/w.sum()
+
+_WINDOW = _gaussian_window()
+
+## grid of shape parameters and the corresponding ratios E[|x|]^2/E[x^2], which increase with the shape parameter
+_GAM = 0.2 + 0.001*np.arange(9801)
+_R_GAM = gamma_fn(2/_GAM)**2/(gamma_fn(1/_GAM)*gamma_fn(3/_GAM))
+
+
+## MATLAB rgb2gray of n x 3 x h x w (or n x h x w) uint8 images, rounded to 8 bits as MATLAB does for uint8 input
+def rgb2gray(images):
+    images = np.asarray(images)
+    if images.ndim == 3:
+        return images.astype(np.float64)
+    if images.shape[1] == 1:
+        return images[:,0].astype(np.float64)
+    coef = np.linalg.inv(np.array([[1.0, 0.956, 0.621], [1.0, -0.272, -0.647], [1.0, -1.106, 1.703]]))[0]
+    gray = np.einsum("c,nchw->nhw", coef, images.astype(np.float64))
+    if images.dtype == np.uint8:
+        gray = np.round(gray)
+    return gray
+
+## the out_length x in_length matrix of MATLAB's imresize (bicubic, with antialiasing) along one dimension
+def _imresize_matrix(in_length, scale):
+    out_length = int(np.ceil(in_length*scale))
+    kernel_width = 4.0/scale if scale<1 else 4.0
+    x = np.arange(1, out_length+1)
+    u = x/scale + 0.5*(1-1/scale)
+    left = np.floor(u - kernel_width/2)
+    indices = left[:,None] + np.arange(int(np.ceil(kernel_width))+2)[None,:]
+    t = u[:,None] - indices
+    if scale<1:
+        t = t*scale
+    absx = np.abs(t)
+    weights = (1.5*absx**3 - 2.5*absx**2 + 1)*(absx<=1) + (-0.5*absx**3 + 2.5*absx**2 - 4*absx + 2)*((absx>1)&(absx<=2))
+    weights = weights/weights.sum(axis=1, keepdims=True)
+    aux = np.concatenate([np.arange(in_length), np.arange(in_length)[::-1]]) #symmetric padding
+    indices = aux[np.mod(indices.astype(np.int64)-1, len(aux))]
+    W = np.zeros((out_length, in_length))
+    np.add.at(W, (np.repeat(np.arange(out_length), indices.shape[1]), indices.reshape(-1)), weights.reshape(-1))
+    return W
+
+## MATLAB imresize(im, scale) of n x h x w images
+def imresize(images, scale):
+    Wr = _imresize_matrix(images.shape[1], scale)
+    Wc = _imresize_matrix(images.shape[2], scale)
+    return np.einsum("ih,nhw,jw->nij", Wr, images, Wc, optimize=True)
+
+## MSCN coefficients and local deviations of n x h x w images; filter2(..., 'same') pads with zeros
+def mscn(images):
+    mu = ndimage.correlate(images, _WINDOW[None], mode="constant", cval=0.0)
+    sigma = np.sqrt(np.abs(ndimage.correlate(images*images, _WINDOW[None], mode="constant", cval=0.0) - mu*mu))
+    return (images-mu)/(sigma+1), sigma
+
+## n x h x w -> n x nblocks x bs x bs, blocks in row-major order
+def to_blocks(x, bs):
+    n, h, w = x.shape
+    return x.reshape(n, h//bs, bs, w//bs, bs).transpose(0, 1, 3, 2, 4).reshape(n, (h//bs)*(w//bs), bs, bs)
+
+
+## AGGD parameters (alpha, left scale, right scale) of the rows of x (... x m); a row without negative or positive values gives NaN scales, as in the reference implementation
+def estimate_aggd_params(x):
+    with np.errstate(divide="ignore", invalid="ignore"):
+        left_std = np.sqrt(np.sum(np.where(x<0, x*x, 0), axis=-1)/np.sum(x<0, axis=-1))
+        right_std = np.sqrt(np.sum(np.where(x>0, x*x, 0), axis=-1)/np.sum(x>0, axis=-1))
+        gammahat = left_std/right_std
+        rhat = np.mean(np.abs(x), axis=-1)**2/np.mean(x*x, axis=-1)
+        rhatnorm = rhat*(gammahat**3+1)*(gammahat+1)/((gammahat**2+1)**2)
+    ## the grid point closest to rhatnorm (the first one on ties); MATLAB's min over all-NaN differences returns the first point
+    pos = np.clip(np.searchsorted(_R_GAM, np.nan_to_num(rhatnorm, nan=-np.inf)), 1, len(_GAM)-1)
+    pos = np.where(np.abs(rhatnorm-_R_GAM[pos-1]) <= np.abs(_R_GAM[pos]-rhatnorm), pos-1, pos)
+    pos = np.where(np.isnan(rhatnorm), 0, pos)
+    alpha = _GAM[pos]
+    factor = np.sqrt(gamma_fn(1/alpha)/gamma_fn(3/alpha))
+    return alpha, left_std*factor, right_std*factor
+
+## 18 features of each bs x bs block of MSCN coefficients (... x bs x bs)
+def block_features(blocks):
+    x = blocks.reshape(blocks.shape[:-2]+(-1,))
+    alpha, betal, betar = estimate_aggd_params(x)
+    feats = [alpha, (betal+betar)/2]
+    for shift in [(0, 1), (1, 0), (1, 1), (1, -1)]:
+        pair = x*np.roll(blocks, shift, axis=(-2, -1)).reshape(x.shape)
+        alpha, betal, betar = estimate_aggd_params(pair)
+        meanparam = (betar-betal)*(gamma_fn(2/alpha)/gamma_fn(1/alpha))
+        feats += [alpha, meanparam, betal, betar]
+    return np.stack(feats, axis=-1)
+
+## n x nblocks x 36 features of n gray images (n x h x w), and n x nblocks sharpness of the blocks
+def niqe_features(gray, block_size):
+    bs_r, bs_c = block_size
+    assert bs_r == bs_c and bs_r % 2 == 0
+    bs = bs_r
+    h, w = gray.shape[1:]
+    gray = gray[:, :(h//bs)*bs, :(w//bs)*bs]
+    feats = []
+    for scale in [1, 2]:
+        structdis, sigma = mscn(gray)
+        if scale == 1:
+            sharpness = to_blocks(sigma, bs).mean(axis=(-2, -1))
+        feats.append(block_features(to_blocks(structdis, bs//scale)))
+        if scale == 1:
+            gray = imresize(gray, 0.5)
+    return np.concatenate(feats, axis=-1), sharpness
+
+
+## sums of the features of the sharp blocks of a batch: per-column sums and counts ignoring NaNs, and the sum and outer products of the complete rows
+def _fit_stats(images, block_size, sharpness_threshold):
+    feats, sharpness = niqe_features(rgb2gray(images), block_size)
+    feats = feats[sharpness > sharpness_threshold*sharpness.max(axis=1, keepdims=True)]
+    complete = feats[~np.isnan(feats).any(axis=1)]
+    return np.nansum(feats, axis=0), np.sum(~np.isnan(feats), axis=0), len(complete), complete.sum(axis=0), complete.T.dot(complete)
+
+## NIQE of each image of a batch
+def _scores(images, block_size, mu_pris, cov_pris):
+    feats, _ = niqe_features(rgb2gray(images), block_size)
+    scores = np.zeros(len(feats))
+    for i, feats_i in enumerate(feats):
+        complete = feats_i[~np.isnan(feats_i).any(axis=1)]
+        if len(complete) == 0:
+            scores[i] = np.nan
+            continue
+        mu_dist = np.nanmean(feats_i, axis=0)
+        cov_dist = np.cov(complete, rowvar=False) if len(complete)>1 else np.zeros_like(cov_pris) #MATLAB's cov of one observation is 0
+        diff = mu_pris - mu_dist
+        cov = (cov_pris + cov_dist)/2
+        scores[i] = np.sqrt(diff.dot(np.linalg.pinv(cov, rcond=max(cov.shape)*np.finfo(np.float64).eps)).dot(diff))
+    return scores
+
+## run fn over batches of images (arrays or IndexedImages, read in the main process) in forked worker processes; results in batch order
+def _map_batches(fn, images, args, batch_size, num_workers, verbose=False):
+    starts = range(0, len(images), batch_size)
+    if num_workers <= 1:
+        return [fn(np.asarray(images[start:(start+batch_size)]), *args) for start in starts]
+    results, pending = [], []
+    with ProcessPoolExecutor(max_workers=num_workers, mp_context=multiprocessing.get_context("fork")) as pool:
+        for start in starts:
+            if len(pending) >= 2*num_workers: #bound the batches in flight
+                results.append(pending.pop(0).result())
+            pending.append(pool.submit(fn, np.asarray(images[start:(start+batch_size)]), *args))
+            if verbose:
+                print("\r NIQE: {}/{} images submitted.".format(min(start+batch_size, len(images)), len(images)), end="")
+        results += [future.result() for future in pending]
+    if verbose:
+        print()
+    return results
+
+
+## fit a NIQE model to n x nc x h x w uint8 images; returns a dict with the fields of MATLAB's niqeModel
+def fit_niqe_model(images, block_size, sharpness_threshold=0.1, batch_size=500, num_workers=0, verbose=True):
+    block_size = tuple(np.broadcast_to(block_size, 2).tolist())
+    stats = _map_batches(_fit_stats, images, (block_size, sharpness_threshold), batch_size, num_workers, verbose)
+    col_sum, col_count, n, row_sum, outer = [sum(x) for x in zip(*stats)]
+    mu = col_sum/col_count
+    mu_complete = row_sum/n
+    cov = (outer - n*np.outer(mu_complete, mu_complete))/(n-1)
+    return {"Mean": mu, "Covariance": (cov+cov.T)/2, "BlockSize": np.array(block_size, dtype=np.float64), "SharpnessThreshold": float(sharpness_threshold)}
+
+## NIQE of each of n x nc x h x w uint8 images under a model of fit_niqe_model or load_niqe_model
+def niqe_scores(images, model, batch_size=500, num_workers=0, verbose=False):
+    block_size = tuple(int(b) for b in np.broadcast_to(model["BlockSize"], 2))
+    scores = _map_batches(_scores, images, (block_size, np.asarray(model["Mean"], dtype=np.float64).reshape(-1), np.asarray(model["Covariance"], dtype=np.float64)), batch_size, num_workers, verbose)
+    return np.concatenate(scores) if len(scores)>0 else np.zeros(0)
+
+
+def save_niqe_model(path, model):
+    sio.savemat(path, {"model": {"Mean": np.asarray(model["Mean"]).reshape(1, -1), "Covariance": model["Covariance"], "BlockSize": np.asarray(model["BlockSize"]).reshape(1, -1), "SharpnessThreshold": model["SharpnessThreshold"]}})
+
+## load a model of save_niqe_model, or of the reference implementation (mu_prisparam, cov_prisparam; block_size must then be given)
+def load_niqe_model(path, block_size=None):
+    mat = sio.loadmat(path, squeeze_me=True)
+    if "model" in mat and mat["model"].dtype.names is not None:
+        model = mat["model"]
+        return {"Mean": np.asarray(model["Mean"].item(), dtype=np.float64).reshape(-1), "Covariance": np.asarray(model["Covariance"].item(), dtype=np.float64), "BlockSize": np.asarray(model["BlockSize"].item(), dtype=np.float64).reshape(-1), "SharpnessThreshold": float(model["SharpnessThreshold"].item())}
+    elif "mu_prisparam" in mat:
+        assert block_size is not None, "the block size of the model is needed"
+        return {"Mean": np.asarray(mat["mu_prisparam"], dtype=np.float64).reshape(-1), "Covariance": np.asarray(mat["cov_prisparam"], dtype=np.float64), "BlockSize": np.array(np.broadcast_to(block_size, 2), dtype=np.float64), "SharpnessThreshold": 0.0}
+    else:
+        raise ValueError("{} does not hold a NIQE model; MATLAB niqeModel objects cannot be read outside MATLAB, save struct(model) fields instead.".format(path))
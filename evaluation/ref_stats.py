@@ -0,0 +1,39 @@
+"""
+On-disk store of the real-data reference statistics used by Evaluator.compute_metrics.
+
+The statistics of the real images (overall feature mean and covariance, per-center window statistics and real counts) only depend on the HDF5 file, the label filters, the centers and the FID encoder checkpoint.
+They are saved as '<fingerprint>.npz' under output/<data_name>_<img_size>/eval_ref/, where the fingerprint hashes the contents of the HDF5 file and of the checkpoint together with the label settings, so that later evaluations of other experiment settings only extract features of fake images.
+
+"""
+
+import os
+import hashlib
+import numpy as np
+
+from utils import file_hash
+
+
+## fingerprint of the reference statistics
+def ref_fingerprint(h5_path, fid_net_path, settings):
+    '''
+    h5_path: the HDF5 file of the dataset
+    fid_net_path: the checkpoint of the FID encoder
+    settings: label filters and window settings, e.g. (data_name, min_label, max_label, imbalance_type, FID_radius, centers)
+    '''
+    sha = hashlib.sha1()
+    sha.update(file_hash(h5_path).encode())
+    sha.update(file_hash(fid_net_path).encode())
+    sha.update(repr(tuple(np.asarray(x).tolist() if isinstance(x, np.ndarray) else x for x in settings)).encode())
+    return sha.hexdigest()[:16]
+
+def load_ref_stats(path_to_stats):
+    if not os.path.isfile(path_to_stats):
+        return None
+    with np.load(path_to_stats) as stats:
+        return {key: stats[key] for key in stats.files}
+
+def save_ref_stats(path_to_stats, stats):
+    os.makedirs(os.path.dirname(path_to_stats), exist_ok=True)
+    path_to_tmp = path_to_stats + ".tmp.npz" #write then rename, so that concurrent evaluations never read a partial file
+    np.savez(path_to_tmp, **stats)
+    os.replace(path_to_tmp, path_to_stats)
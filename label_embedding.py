@@ -12,7 +12,7 @@ import timeit
 from einops import rearrange, reduce, repeat, pack, unpack
 
 from models import ResNet34_embed_y2h, model_y2h, ResNet34_embed_y2cov, model_y2cov
-from utils import IMGs_dataset
+from utils import IMGs_dataset, compile_module, file_hash
 
 # Note that the ResNet34_embed_y2cov and model_y2cov modules were specifically designed for CCDM (Continuous Conditional Diffusion Models) and are not utilized in this repository. They are retained solely for completeness.
 
@@ -32,7 +32,10 @@ class GaussianFourierProjection(nn.Module):
 
 
 class LabelEmbed:
-    def __init__(self, dataset, path_y2h, path_y2cov, y2h_type="resnet", y2cov_type="sinusoidal", h_dim = 128, cov_dim = 64**2*3, batch_size=128, nc=3, device="cuda"):
+    def __init__(self, dataset, path_y2h, path_y2cov, y2h_type="resnet", y2cov_type="sinusoidal", h_dim = 128, cov_dim = 64**2*3, batch_size=128, nc=3, device="cuda", y2h_table_size=2**16, y2h_table_range=(-0.5, 1.5)):
+        '''
+        y2h_table_size: with y2h_type="resnet", the frozen mlp_y2h is evaluated once on this many evenly spaced normalized labels in y2h_table_range, and fn_y2h interpolates linearly between them; 0 runs mlp_y2h in every call
+        '''
         self.dataset = dataset
         self.data_name = dataset.data_name
         self.path_y2h = path_y2h 
@@ -43,6 +46,7 @@ class LabelEmbed:
         self.cov_dim = cov_dim
         self.batch_size = batch_size
         self.nc = nc
+        self.y2h_table = None
         
         assert y2h_type in ['resnet', 'sinusoidal', 'gaussian']
         assert y2cov_type in ['resnet', 'sinusoidal', 'gaussian']
@@ -107,6 +111,9 @@ class LabelEmbed:
                 model_mlp_y2h.load_state_dict(checkpoint['net_state_dict'])
             #end not os.path.isfile
             
+            ## mlp_y2h is frozen from now on
+            model_mlp_y2h.eval()
+            model_mlp_y2h.requires_grad_(False)
             self.model_mlp_y2h = model_mlp_y2h
             
             ##some simple test
@@ -137,6 +144,9 @@ class LabelEmbed:
             print("\n noisy labels vs reconstructed labels")
             print(results2)
             
+            if y2h_table_size>0:
+                self.y2h_table = self.make_y2h_table(mlp_y2h_filename_ckpt, y2h_table_size, y2h_table_range, device)
+            
         ##end if
 
         if y2cov_type == "resnet":
@@ -232,6 +242,38 @@ class LabelEmbed:
             
           
         
+    ## table of mlp_y2h over a grid of normalized labels, cached next to the mlp_y2h checkpoint; the cache is rebuilt when the checkpoint changes
+    def make_y2h_table(self, mlp_y2h_filename_ckpt, table_size, table_range, device):
+        path_to_table = os.path.join(self.path_y2h, 'y2h_table_{}_{}_{}.pth'.format(table_size, table_range[0], table_range[1]))
+        ckpt_hash = file_hash(mlp_y2h_filename_ckpt)
+        if os.path.isfile(path_to_table):
+            table = torch.load(path_to_table, weights_only=True)
+            if table["ckpt_hash"] == ckpt_hash:
+                print("\n Loaded y2h table of {} labels.".format(table_size))
+                return {"lo": table_range[0], "hi": table_range[1], "embedding": table["embedding"].to(device)}
+        print("\n Building y2h table of {} labels >>>".format(table_size))
+        grid = torch.linspace(table_range[0], table_range[1], table_size, dtype=torch.float64).type(torch.float).to(device)
+        with torch.no_grad():
+            embedding = torch.cat([self.model_mlp_y2h(grid[i:(i+8192)]) for i in range(0, table_size, 8192)])
+        torch.save({"ckpt_hash": ckpt_hash, "embedding": embedding.cpu()}, path_to_table + ".tmp")
+        os.replace(path_to_table + ".tmp", path_to_table)
+        return {"lo": table_range[0], "hi": table_range[1], "embedding": embedding}
+    
+    ## linear interpolation in the y2h table; labels outside the table range are clamped to it
+    def lookup_y2h_table(self, labels):
+        embedding = self.y2h_table["embedding"]
+        if embedding.device != labels.device:
+            embedding = self.y2h_table["embedding"] = embedding.to(labels.device)
+        lo, hi = self.y2h_table["lo"], self.y2h_table["hi"]
+        pos = (labels.view(-1).double().clamp(lo, hi) - lo) * ((len(embedding)-1)/(hi-lo))
+        indx = pos.floor().long().clamp(max=len(embedding)-2)
+        return torch.lerp(embedding[indx], embedding[indx+1], (pos-indx).float()[:,None])
+    
+    ## torch.compile of mlp_y2h where fn_y2h runs it in every call (y2h_table_size=0); the y2h table is a lookup and is not compiled
+    def compile_y2h(self):
+        if self.y2h_type == "resnet" and self.y2h_table is None:
+            compile_module(self.model_mlp_y2h.module)
+    
     ## function for y2h
     def fn_y2h(self, labels):
         embed_dim = self.h_dim
@@ -253,9 +295,10 @@ class LabelEmbed:
             embedding = (embedding + 1)/2 #make sure the embedding is not negative, and in [0,1]
         
         elif self.y2h_type=="resnet":
-            self.model_mlp_y2h.eval()
-            self.model_mlp_y2h = self.model_mlp_y2h.cuda()
-            embedding = self.model_mlp_y2h(labels)
+            if self.y2h_table is not None:
+                embedding = self.lookup_y2h_table(labels)
+            else:
+                embedding = self.model_mlp_y2h(labels)
         
         return embedding 
     
@@ -69,7 +69,7 @@ os.makedirs(path_to_fake_data, exist_ok=True)
 '''                                Make dataset                                     '''
 #######################################################################################
 
-dataset = LoadDataSet(data_name=args.data_name, data_path=args.data_path, min_label=args.min_label, max_label=args.max_label, img_size=args.img_size, max_num_img_per_label=args.max_num_img_per_label, num_img_per_label_after_replica=args.num_img_per_label_after_replica, imbalance_type=args.imb_type)
+dataset = LoadDataSet(data_name=args.data_name, data_path=args.data_path, min_label=args.min_label, max_label=args.max_label, img_size=args.img_size, max_num_img_per_label=args.max_num_img_per_label, num_img_per_label_after_replica=args.num_img_per_label_after_replica, imbalance_type=args.imb_type, backend=args.data_backend)
     
 train_images, train_labels, train_labels_norm = dataset.load_train_data()
 num_classes = dataset.num_classes
@@ -123,9 +123,11 @@ vicinal_params = {
 '''                             label embedding method                              '''
 #######################################################################################
 
-dataset_embed = LoadDataSet(data_name=args.data_name, data_path=args.data_path, min_label=args.min_label, max_label=args.max_label, img_size=args.img_size, max_num_img_per_label=args.max_num_img_per_label, num_img_per_label_after_replica=0, imbalance_type=args.imb_type)
+dataset_embed = LoadDataSet(data_name=args.data_name, data_path=args.data_path, min_label=args.min_label, max_label=args.max_label, img_size=args.img_size, max_num_img_per_label=args.max_num_img_per_label, num_img_per_label_after_replica=0, imbalance_type=args.imb_type, backend=args.data_backend)
 
-label_embedding = LabelEmbed(dataset=dataset_embed, path_y2h=path_to_output+'/model_y2h', path_y2cov=path_to_output+'/model_y2cov', y2h_type="resnet", y2cov_type="sinusoidal", h_dim = args.dim_y, cov_dim = args.img_size**2*args.num_channels, nc=args.num_channels)
+label_embedding = LabelEmbed(dataset=dataset_embed, path_y2h=path_to_output+'/model_y2h', path_y2cov=path_to_output+'/model_y2cov', y2h_type="resnet", y2cov_type="sinusoidal", h_dim = args.dim_y, cov_dim = args.img_size**2*args.num_channels, nc=args.num_channels, y2h_table_size=args.y2h_table_size)
+if args.compile:
+    label_embedding.compile_y2h()
 fn_y2h = label_embedding.fn_y2h
 
 
@@ -242,12 +244,17 @@ trainer = Trainer(
     ema_decay = args.ema_decay,
     use_diffaug = args.use_diffaug,
     diffaug_policy = args.diffaug_policy,
+    d_concat_forward = args.d_concat_forward,
     exp_seed = args.seed,
-    num_workers = None,
+    num_workers = args.num_workers,
+    data_on_device = args.data_on_device,
+    num_prefetch = args.num_prefetch,
     # === OOD-增强：条件扰动和插值一致性正则参数 ===
     sigma_y = args.sigma_y,
     lambda_perturb = args.lambda_perturb,
     lambda_interp = args.lambda_interp,
+    fuse_g_reg_passes = args.fuse_g_reg_passes,
+    use_compile = args.compile,
 )
 
 start = timeit.default_timer()
@@ -271,7 +278,10 @@ if args.do_dre_ft:
 print("\n Start sampling fake images from the model >>>")
 
 ## initialize evaluator
-evaluator = Evaluator(dataset=dataset, trainer=trainer, args=args, device=trainer.device) #, root_path=args.root_path
+path_to_spill = None
+if args.eval_streaming and (args.eval_spill_fake or args.dump_fake_for_h5 or args.dump_fake_consolidated or args.dump_fake_for_niqe or args.niqe_model_path!="None"):
+    path_to_spill = os.path.join(path_to_fake_data, 'fake_images_stream.h5')
+evaluator = Evaluator(dataset=dataset, trainer=trainer, args=args, device=trainer.device, path_to_spill=path_to_spill) #, root_path=args.root_path
 
 ## initialize evaluation models, prepare for evaluation
 if args.data_name in ["RC-49","RC-49_imb"]:
@@ -299,6 +309,10 @@ if args.dump_fake_for_h5:
     os.makedirs(path_to_h5files, exist_ok=True)
     evaluator.dump_h5_files(output_path=path_to_h5files)
 
+## dump fake data in one h5 file with a label index
+if args.dump_fake_consolidated:
+    evaluator.dump_consolidated_h5(os.path.join(path_to_fake_data, 'fake_images.h5'))
+
 ## dump for niqe computation
 if args.dump_fake_for_niqe:
     if args.niqe_dump_path=="None":
@@ -308,6 +322,12 @@ if args.dump_fake_for_niqe:
     os.makedirs(dump_fake_images_folder, exist_ok=True)
     evaluator.dump_png_images(output_path=dump_fake_images_folder)
 
+## niqe computation without png files
+if args.niqe_model_path!="None":
+    niqe_results_path = os.path.join(save_setting_folder, "niqe_{}".format(datetime.now().strftime("%Y-%m-%d_%H-%M-%S")))
+    os.makedirs(niqe_results_path, exist_ok=True)
+    evaluator.compute_niqe(args.niqe_model_path, niqe_results_path)
+
 
 ## start computing evaluation metrics
 if args.do_eval:
@@ -9,6 +9,9 @@ def parse_opts():
     parser.add_argument('--data_path', type=str, default='')
     parser.add_argument('--seed', type=int, default=2025, metavar='S', help='random seed (default: 2025)')
     parser.add_argument('--num_workers', type=int, default=0)
+    parser.add_argument('--num_prefetch', type=int, default=0, help='number of training iterations prepared ahead by --num_workers background threads; 0 disables the batch producer')
+    parser.add_argument('--data_on_device', type=str, default='off', choices=['auto', 'pinned', 'off'],
+                        help='keep the uint8 training set on the device (auto: on the device if it fits, otherwise in pinned memory) and augment/normalize it there')
 
     ''' Dataset '''
     parser.add_argument('--data_name', type=str, default='RC-49_imb', choices=["RC-49", "UTKFace", "Cell200", "SteeringAngle","RC-49_imb", "Cell200_imb"])
@@ -19,6 +22,8 @@ def parse_opts():
     parser.add_argument('--img_size', type=int, default=64)
     parser.add_argument('--max_num_img_per_label', type=int, default=2**20, metavar='N')
     parser.add_argument('--num_img_per_label_after_replica', type=int, default=0, metavar='N')
+    parser.add_argument('--data_backend', type=str, default='ram', choices=['ram', 'h5', 'memmap'],
+                        help='ram: read all images into memory; h5: read images on demand from the open h5 file; memmap: memory-map an uncompressed .npy copy of the images')
 
     ''' GAN settings '''
     # model config
@@ -35,6 +40,7 @@ def parse_opts():
     # label embedding config
     parser.add_argument('--embed_type', type=str, default='resnet', choices=['resnet', 'sinusoidal', 'gaussian']) 
     parser.add_argument('--dim_y', type=int, default=128) #dimension of the embedding space
+    parser.add_argument('--y2h_table_size', type=int, default=2**16, help='number of grid points of the precomputed y2h embedding table (linear interpolation in between); 0 evaluates the y2h network for every batch')
 
     # training config
     parser.add_argument('--niters', type=int, default=10000, help='number of iterations')
@@ -51,6 +57,7 @@ def parse_opts():
 
     parser.add_argument('--use_amp', action='store_true', default=False) #use mixed precision
     parser.add_argument('--mixed_precision_type', type=str, default='fp16', choices=['no', 'fp16', 'bf16'])
+    parser.add_argument('--compile', action='store_true', default=False, help='torch.compile netG, netD, the y2h MLP and the auxiliary regressor for the fixed batch sizes of the D and G steps; a warm-up iteration before training compiles them')
 
     # gradient accumulation
     parser.add_argument('--num_grad_acc_d', type=int, default=1)
@@ -68,6 +75,7 @@ def parse_opts():
     # DiffAugment setting
     parser.add_argument('--use_diffaug', action='store_true', default=False) #use DiffAugment
     parser.add_argument('--diffaug_policy', type=str, default='color,translation,cutout') #DiffAugment policy
+    parser.add_argument('--d_concat_forward', action='store_true', default=False, help='one discriminator forward on the concatenated real and fake batches in the D step (ignored for discriminators with BatchNorm, e.g., DCGAN)')
     
     # Exponential Moving Average
     parser.add_argument('--use_ema', action='store_true', default=False)
@@ -109,6 +117,7 @@ def parse_opts():
     parser.add_argument('--sigma_y', type=float, default=0.047, help='standard deviation for label perturbation (default: 0.04, 脚本参数会覆盖此值)')
     parser.add_argument('--lambda_perturb', type=float, default=0, help='weight for perturbation consistency loss (default: 0.01, 脚本参数会覆盖此值)')
     parser.add_argument('--lambda_interp', type=float, default=0, help='weight for interpolation consistency loss (default: 0.005, 脚本参数会覆盖此值)')
+    parser.add_argument('--fuse_g_reg_passes', action='store_true', default=False, help='one stacked generator forward for the G step and the L_perturb/L_interp images (BatchNorm statistics are kept per label batch; the loss values match the separate forwards for generators without spectral norm, e.g., SNGAN, and up to the drift of one spectral-norm power iteration per forward instead of three otherwise, e.g., SAGAN/BigGAN)')
         
     
     ''' Sampling and Evaluation ''' 
@@ -119,7 +128,16 @@ def parse_opts():
     parser.add_argument('--dump_fake_for_h5', action='store_true', default=False)
     parser.add_argument('--dump_fake_for_niqe', action='store_true', default=False)
     parser.add_argument('--niqe_dump_path', type=str, default='None') 
+    parser.add_argument('--niqe_model_path', type=str, default='None', help='a .mat model of pretrain_niqe.py; if given, NIQE of the fake images is computed without dumping png files')
+    parser.add_argument('--niqe_num_workers', type=int, default=0, help='number of worker processes computing NIQE')
+    parser.add_argument('--dump_fake_consolidated', action='store_true', default=False, help='dump all fake images into one h5 file (fake_data/fake_images.h5) with a label index instead of one file per label')
+    parser.add_argument('--dump_h5_compression', type=str, default='gzip', choices=['gzip','lzf','blosc','lz4','none'], help='compression filter of the dumped h5 files; blosc and lz4 need the hdf5plugin package')
+    parser.add_argument('--dump_num_workers', type=int, default=0, help='number of worker processes writing the h5 and png dumps; 0 or 1 writes them in the main process')
     parser.add_argument('--eval_batch_size', type=int, default=200)
+    parser.add_argument('--eval_streaming', action='store_true', default=False, help='generate fake images for evaluation in chunks of labels and keep only their features and predictions, so that peak memory does not grow with the number of fake images')
+    parser.add_argument('--eval_stream_chunk_size', type=int, default=10000, help='approximate number of fake images per chunk; chunks always hold whole labels')
+    parser.add_argument('--eval_spill_fake', action='store_true', default=False, help='with --eval_streaming, also write the fake images to a chunked h5 file under fake_data; implied by --dump_fake_for_h5, --dump_fake_consolidated, --dump_fake_for_niqe and --niqe_model_path')
+    parser.add_argument('--eval_num_workers', type=int, default=0, help='number of worker processes the sliding FID centers are sharded over; each worker gets 1/eval_num_workers of the torch threads; 0 or 1 computes all centers in the main process')
 
     args = parser.parse_args()
 
@@ -15,13 +15,12 @@ import timeit
 from PIL import Image
 import sys
 from datetime import datetime 
-import matlab.engine
 import scipy.io as sio
-import cv2
 import tempfile
 import concurrent.futures
 
 from dataset import LoadDataSet
+from evaluation.niqe import fit_niqe_model, save_niqe_model
 
 ## settings
 parser = argparse.ArgumentParser()
@@ -39,6 +38,9 @@ parser.add_argument('--num_channels', type=int, default=3, metavar='N')
 parser.add_argument('--img_size', type=int, default=64)
 parser.add_argument('--max_num_img_per_label', type=int, default=2**20, metavar='N')
 parser.add_argument('--num_img_per_label_after_replica', type=int, default=0, metavar='N')
+parser.add_argument('--data_backend', type=str, default='ram', choices=['ram', 'h5', 'memmap'])
+parser.add_argument('--niqe_backend', type=str, default='numpy', choices=['numpy', 'matlab'], help='numpy: evaluation/niqe.py, reading the training arrays directly; matlab: fitniqe through the MATLAB engine')
+parser.add_argument('--niqe_batch_size', type=int, default=500, help='number of images whose blocks are processed at once by the numpy backend')
 
 args = parser.parse_args()
 
@@ -80,7 +82,7 @@ path_to_output = os.path.join(args.root_path, 'niqe_models/{}'.format(args.data_
 os.makedirs(path_to_output, exist_ok=True)
 
 ## dataset
-dataset = LoadDataSet(data_name=args.data_name, data_path=args.data_path, min_label=args.min_label, max_label=args.max_label, img_size=args.img_size, max_num_img_per_label=args.max_num_img_per_label, num_img_per_label_after_replica=args.num_img_per_label_after_replica, imbalance_type=args.imb_type)
+dataset = LoadDataSet(data_name=args.data_name, data_path=args.data_path, min_label=args.min_label, max_label=args.max_label, img_size=args.img_size, max_num_img_per_label=args.max_num_img_per_label, num_img_per_label_after_replica=args.num_img_per_label_after_replica, imbalance_type=args.imb_type, backend=args.data_backend)
 train_images, train_labels, train_labels_norm = dataset.load_train_data()
 unique_train_labels, counts_train_elements = np.unique(train_labels, return_counts=True) 
 
@@ -92,6 +94,8 @@ else:
     path_to_model = os.path.join(path_to_output, "niqe_model_{}_{}.mat".format(args.data_name, args.img_size))
 
 def train_niqe_model(X, block_size, sharpness_threshold, output_mat):
+    import matlab.engine
+    import cv2
     eng = matlab.engine.start_matlab()
     
     with tempfile.TemporaryDirectory() as temp_dir:
@@ -117,7 +121,13 @@ def train_niqe_model(X, block_size, sharpness_threshold, output_mat):
 #     os.makedirs(path_to_model_dir, exist_ok=True)
     
 
-train_niqe_model(train_images, block_size=[block_size, block_size], sharpness_threshold=sharpness_threshold, output_mat = path_to_model)
+if args.niqe_backend == "matlab":
+    train_niqe_model(train_images, block_size=[block_size, block_size], sharpness_threshold=sharpness_threshold, output_mat = path_to_model)
+else:
+    start = timeit.default_timer()
+    model = fit_niqe_model(train_images, block_size=[block_size, block_size], sharpness_threshold=sharpness_threshold, batch_size=args.niqe_batch_size, num_workers=args.num_workers)
+    save_niqe_model(path_to_model, model)
+    print("\n NIQE model of {} images saved to {}. Time spent {:.2f} sec.".format(len(train_images), path_to_model, timeit.default_timer()-start))
 
 
 
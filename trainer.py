@@ -25,9 +25,12 @@ from collections import deque
 from PIL import Image
 import warnings
 
-from utils import SimpleProgressBar, normalize_images, random_hflip, random_rotate, random_vflip, exists, divisible_by, check_unnormalized_imgs
+from utils import SimpleProgressBar, DeviceMetrics, chunked_batch_norm, compile_module, normalize_images, random_hflip, random_rotate, random_vflip, random_flip_tensor, random_rotate_tensor, exists, divisible_by, check_unnormalized_imgs
 from DiffAugment_pytorch import DiffAugment
 from ema_pytorch import EMA
+from vicinity import VicinityEngine
+from dataset import IndexedImages
+from batch_producer import BatchProducer
 
 class Trainer(object):
     def __init__(
@@ -70,8 +73,13 @@ class Trainer(object):
         ema_decay = 0.999,
         use_diffaug = False,
         diffaug_policy = 'color,translation,cutout',
+        d_concat_forward = False,
+        fuse_g_reg_passes = False,
+        use_compile = False,
         exp_seed = 123,
         num_workers = None,
+        data_on_device = "off",
+        num_prefetch = 0,
         # === OOD-增强：条件扰动和插值一致性正则参数 ===
         # ⚠️ 注意：这些默认值会被 main.py 传递的 args 参数覆盖（命令行/脚本参数优先级最高）
         # 默认值设置为保守值，避免训练不稳定
@@ -109,6 +117,8 @@ class Trainer(object):
         self.img_ch = img_ch #number of channels
         
         self.num_workers = num_workers
+        self.num_prefetch = num_prefetch #number of training iterations prepared ahead by the batch producer; 0 means no background producer
+        self.exp_seed = exp_seed
         
         # model
         self.net_name = net_name
@@ -123,6 +133,9 @@ class Trainer(object):
         self.accelerator = Accelerator(mixed_precision = mixed_precision_type if use_amp else "no")
         set_seed(exp_seed)
         
+        # training data kept as uint8 tensors on the device (or in pinned memory), augmented and normalized there
+        self.setup_data_on_device(data_on_device)
+        
         # training
         self.niters = niters
         self.resume_iter = resume_iter
@@ -143,6 +156,9 @@ class Trainer(object):
         
         ## vicinal params
         self.vicinal_params = vicinal_params
+        self.vicinity_engine = VicinityEngine(train_labels, vicinal_params)
+        if vicinal_params["use_ada_vic"]:
+            self.vicinity_engine.build_radius_table(os.path.join(self.results_folder, "ada_vic_radius_table.npz"))
 
         ## auxiliary loss params
         self.aux_loss_params = aux_loss_params
@@ -178,10 +194,22 @@ class Trainer(object):
         ## diffaugment
         self.use_diffaug = use_diffaug
         self.diffaug_policy = diffaug_policy
+        
+        ## one netD forward on the concatenated real and fake batches in the D step; BatchNorm would mix the statistics of both halves, so it is only used for discriminators without BatchNorm
+        self.d_concat_forward = d_concat_forward
+        if self.d_concat_forward and any(isinstance(m, nn.modules.batchnorm._BatchNorm) for m in netD.modules()):
+            print("\n Warning: the discriminator of {} has BatchNorm layers; --d_concat_forward is ignored.".format(net_name))
+            self.d_concat_forward = False
+        
+        ## one netG forward on the stacked label batches of the G step and of L_perturb/L_interp (BatchNorm statistics are kept per label batch, see utils.chunked_batch_norm)
+        ## the images equal those of the separate forwards only for generators without spectral norm (SNGAN); with spectral norm (SAGAN, BigGAN, BigGAN-deep) the fused forward runs one power iteration instead of three, so they differ by the drift of the spectral norm estimates, large at init and small once they have converged
+        self.fuse_g_reg_passes = fuse_g_reg_passes
 
         ## optimizer
-        self.optG = torch.optim.Adam(netG.parameters(), lr=lr_g, betas=adam_betas)
-        self.optD = torch.optim.Adam(netD.parameters(), lr=lr_d, betas=adam_betas)
+        ## on CUDA the Adam step counts are kept on the device (capturable), so that _step_if_finite can restore them without a host sync
+        capturable = self.accelerator.device.type == "cuda"
+        self.optG = torch.optim.Adam(netG.parameters(), lr=lr_g, betas=adam_betas, capturable=capturable)
+        self.optD = torch.optim.Adam(netD.parameters(), lr=lr_d, betas=adam_betas, capturable=capturable)
 
         ## prepare model, dataloader, optimizer with accelerator
         self.netG, self.netD, self.optG, self.optD = self.accelerator.prepare(self.netG, self.netD, self.optG, self.optD)
@@ -206,6 +234,16 @@ class Trainer(object):
             self.load(self.resume_iter)
 
         self.ft_dre_flag = False #By default, the dre branch is not finetuned.
+        
+        ## torch.compile of netG, netD and the auxiliary regressor in place (the state dicts keep their keys); the EMA generator was copied from netG before and stays eager
+        ## the batch sizes of the D and G steps are fixed, so each graph is compiled for static shapes; a discarded warm-up iteration at the start of train() compiles all of them before the timed loop
+        self.use_compile = use_compile
+        self.compile_time = None
+        if self.use_compile:
+            compile_module(self.netG)
+            compile_module(self.netD)
+            if self.aux_loss_params["use_aux_reg_model"]:
+                compile_module(self.aux_reg_net)
     
     
     
@@ -259,279 +297,272 @@ class Trainer(object):
     ############################################################################################################################ 
     ######################################################################################## 
     ## random data augmentation for a batch of real images
-    def fn_transform(self, batch_real_images):
+    def fn_transform(self, batch_real_images, rng=None):
         assert isinstance(batch_real_images, np.ndarray)
+        np_rng = np.random if rng is None else rng
         if self.data_name == "UTKFace":
-            batch_real_images = random_hflip(batch_real_images)
+            batch_real_images = random_hflip(batch_real_images, rng=np_rng)
         if self.data_name[0:7] == "Cell200":
-            batch_real_images = random_rotate(batch_real_images)
-            batch_real_images = random_hflip(batch_real_images)
-            batch_real_images = random_vflip(batch_real_images)
+            batch_real_images = random_rotate(batch_real_images, rng=rng)
+            batch_real_images = random_hflip(batch_real_images, rng=np_rng)
+            batch_real_images = random_vflip(batch_real_images, rng=np_rng)
         return batch_real_images
     
     
     
     
     
+    ############################################################################################################################ 
+    ######################################################################################## 
+    ## place the uint8 training set on the device, or in pinned host memory if it does not fit
+    def setup_data_on_device(self, data_on_device="off", max_mem_fraction=0.5):
+        data_on_device = data_on_device.lower()
+        assert data_on_device in ["auto", "pinned", "off"]
+        device = self.accelerator.device
+        ## a replicated training set is an index multiset over its images; only the distinct images and the map from training positions to them are kept
+        train_images = self.train_images
+        self.train_images_map = None
+        if isinstance(train_images, IndexedImages):
+            indx_unique, indx_map = np.unique(train_images.indx, return_inverse=True)
+            train_images = IndexedImages(train_images.base, indx_unique, train_images.chunk_size)
+            self.train_images_map = indx_map.reshape(-1)
+        data_nbytes = train_images.nbytes + self.train_labels.nbytes
+        if data_on_device == "auto":
+            data_on_device = "device"
+            if device.type == "cuda":
+                free_mem, _ = torch.cuda.mem_get_info(device)
+                if data_nbytes > max_mem_fraction*free_mem:
+                    data_on_device = "pinned"
+        if data_on_device == "pinned" and device.type != "cuda":
+            data_on_device = "device" #pinned memory only helps host-to-GPU copies; on other devices keep the tensors where the model is
+        self.data_on_device = data_on_device
+        if data_on_device == "off":
+            return
+        
+        with warnings.catch_warnings(): #the training set may be a read-only view; it is only read and then copied to the device or pinned memory
+            warnings.simplefilter("ignore", UserWarning)
+            train_images = torch.from_numpy(np.ascontiguousarray(train_images))
+        if data_on_device == "device":
+            self.train_images_tensor = train_images.to(device)
+        else:
+            self.train_images_tensor = train_images.pin_memory()
+            self.pinned_buffers = [None, None] #double-buffered staging area for the batches gathered on the host
+            self.pinned_events = [None, None]
+            self.pinned_buffer_indx = 0
+        self.train_labels_tensor = torch.tensor(self.train_labels, dtype=torch.float, device=device)
+        if exists(self.train_images_map):
+            self.train_images_map_tensor = torch.from_numpy(self.train_images_map).to(device if data_on_device=="device" else "cpu")
+        print("\n Training data ({:.1f} MB) kept in {} memory.".format(data_nbytes/1024**2, "device" if data_on_device=="device" else "pinned host"))
+    
+    ## gather a batch of uint8 images from pinned memory and copy it to the device asynchronously
+    def _gather_pinned(self, batch_real_indx):
+        k = self.pinned_buffer_indx
+        self.pinned_buffer_indx = 1-k
+        if exists(self.pinned_events[k]):
+            self.pinned_events[k].synchronize() #the previous copy from this buffer must be done before overwriting it
+        n = len(batch_real_indx)
+        if self.pinned_buffers[k] is None or len(self.pinned_buffers[k]) < n:
+            self.pinned_buffers[k] = torch.empty((n,)+tuple(self.train_images_tensor.shape[1:]), dtype=self.train_images_tensor.dtype).pin_memory()
+        buffer = self.pinned_buffers[k][:n]
+        batch_real_indx = torch.from_numpy(np.asarray(batch_real_indx))
+        if exists(self.train_images_map):
+            batch_real_indx = self.train_images_map_tensor[batch_real_indx]
+        torch.index_select(self.train_images_tensor, 0, batch_real_indx, out=buffer)
+        batch_real_images = buffer.to(self.device, non_blocking=True)
+        self.pinned_events[k] = torch.cuda.Event()
+        self.pinned_events[k].record()
+        return batch_real_images
+    
+    ## random data augmentation for a batch of real images on the device; the counterpart of fn_transform
+    def fn_transform_tensor(self, batch_real_images):
+        if self.data_name == "UTKFace":
+            batch_real_images = random_flip_tensor(batch_real_images, dim=3)
+        if self.data_name[0:7] == "Cell200":
+            batch_real_images = random_rotate_tensor(batch_real_images)
+            batch_real_images = random_flip_tensor(batch_real_images, dim=3)
+            batch_real_images = random_flip_tensor(batch_real_images, dim=2)
+        return batch_real_images
+    
+    ## draw, augment and normalize real images given their indices in the training set
+    def _fetch_real_images(self, batch_real_indx):
+        if self.data_on_device == "off":
+            batch_real_images = self.fn_transform(self.train_images[batch_real_indx])
+            return torch.from_numpy(normalize_images(batch_real_images, to_neg_one_to_one=True)).type(torch.float).to(self.device)
+        if self.data_on_device == "device":
+            if isinstance(batch_real_indx, np.ndarray):
+                batch_real_indx = torch.from_numpy(batch_real_indx).to(self.device)
+            if exists(self.train_images_map):
+                batch_real_indx = self.train_images_map_tensor[batch_real_indx]
+            batch_real_images = self.train_images_tensor[batch_real_indx]
+        else:
+            batch_real_images = self._gather_pinned(batch_real_indx)
+        batch_real_images = self.fn_transform_tensor(batch_real_images)
+        ## normalize in the dtype of the model, without float64 intermediates
+        model_dtype = next(self.netD.parameters()).dtype
+        return normalize_images(batch_real_images.type(model_dtype), to_neg_one_to_one=True)
+    
+    
+    
     ############################################################################################################################ 
     ######################################################################################## 
     ## make vicinity for target labels
-    def make_vicinity(self, batch_target_labels, batch_target_labels_in_dataset):
+    def make_vicinity(self, batch_target_labels, batch_target_labels_in_dataset, rng=np.random):
+        batch = self.make_vicinity_host(batch_target_labels, batch_target_labels_in_dataset, rng)
+        return self._vicinity_to_device(batch)
+    
+    ## the host side of make_vicinity; everything is kept in numpy so it can run in the batch producer
+    def make_vicinity_host(self, batch_target_labels, batch_target_labels_in_dataset, rng=np.random):
+        ### Step 1: Retrieve the indices of real images in the dataset whose labels fall within a vicinity of the target labels. Additionally, generate random labels within the same vicinity for synthesizing fake images.
+        ## the whole batch is handled by the vicinity engine in one pass; for fixed vicinities, batch_target_labels with empty vicinities are redrawn in place
+        batch_real_indx, batch_fake_labels, kappa_l_all, kappa_r_all = self.vicinity_engine.sample(batch_target_labels, batch_target_labels_in_dataset, rng)
+        batch_real_labels = self.train_labels[batch_real_indx]
         
-        ###########################################
-        ## fixed vicinity, conventional hard/soft vicinity
-        if not self.vicinal_params["use_ada_vic"]: 
-            
-            ### Step 1: Retrieve the indices of real images in the dataset whose labels fall within a vicinity of the target labels. Additionally, generate random labels within the same vicinity for synthesizing fake images.
-            ## find index of real images with labels in the vicinity of batch_target_labels
-            ## generate labels for fake image generation; these labels are also in the vicinity of batch_target_labels
-            batch_real_indx = np.zeros(self.batch_size_disc, dtype=int) #the indices of selected real images in the training dataset; the labels of these images are in the vicinity
-            batch_fake_labels = np.zeros(self.batch_size_disc) # the fake labels used to genetated fake images
-            
-            for j in range(self.batch_size_disc):
-                ## index for real images
-                if self.vicinal_params["threshold_type"] == "hard":
-                    indx_real_in_vicinity = np.where(np.abs(self.train_labels-batch_target_labels[j])<= self.vicinal_params["kappa"])[0]
-                else:
-                    # reverse the weight function for SVDL
-                    indx_real_in_vicinity = np.where((self.train_labels-batch_target_labels[j])**2 <= -np.log(self.vicinal_params["nonzero_soft_weight_threshold"])/self.vicinal_params["kappa"])[0]
+        ### Step 2: compute the vicinal weights
+        real_weights, fake_weights = self.vicinity_engine.vicinal_weights(batch_target_labels, batch_real_labels, batch_fake_labels, kappa_l_all, kappa_r_all)
+        
+        return {
+            "target_labels": batch_target_labels,
+            "real_indx": batch_real_indx,
+            "fake_labels": batch_fake_labels,
+            "real_labels": batch_real_labels,
+            "real_weights": real_weights,
+            "fake_weights": fake_weights,
+            "kappa_l": kappa_l_all,
+            "kappa_r": kappa_r_all,
+        }
+    
+    def _vicinity_to_device(self, batch):
+        device = self.device
+        batch_real_labels = torch.from_numpy(batch["real_labels"]).type(torch.float).to(device)
+        batch_fake_labels = torch.from_numpy(batch["fake_labels"]).type(torch.float).to(device)
+        real_weights = torch.from_numpy(batch["real_weights"]).type(torch.float).to(device)
+        fake_weights = torch.from_numpy(batch["fake_weights"]).type(torch.float).to(device)
+        return batch["real_indx"], batch_fake_labels, batch_real_labels, real_weights, fake_weights, batch["kappa_l"], batch["kappa_r"]
+    
+    ## backward pass whose gradients are zeroed on the device if the 0-dim bool tensor finite is False, so that no NaN reaches clip_grad_norm_ or the netD gradients left by the G step
+    def _backward_if_finite(self, accelerator, loss, finite, params):
+        accelerator.backward(loss)
+        with torch.no_grad():
+            for p in params:
+                if p.grad is not None:
+                    p.grad.copy_(torch.where(finite, p.grad, 0.0))
 
-                ## if the max gap between two consecutive ordered unique labels is large, it is possible that len(indx_real_in_vicinity)<1
-                while len(indx_real_in_vicinity)<1:
-                    batch_epsilons_j = np.random.normal(0, self.vicinal_params["kernel_sigma"], 1)
-                    batch_target_labels[j] = batch_target_labels_in_dataset[j] + batch_epsilons_j
-                    ## index for real images
-                    if self.vicinal_params["threshold_type"] == "hard":
-                        indx_real_in_vicinity = np.where(np.abs(self.train_labels-batch_target_labels[j])<= self.vicinal_params["kappa"])[0]
-                    else:
-                        # reverse the weight function for SVDL
-                        indx_real_in_vicinity = np.where((self.train_labels-batch_target_labels[j])**2 <= -np.log(self.vicinal_params["nonzero_soft_weight_threshold"])/self.vicinal_params["kappa"])[0]
-                #end while len(indx_real_in_vicinity)<1
+    ## optimizer step that leaves the parameters and the optimizer state (Adam moments and step counts) unchanged if the 0-dim bool tensor finite is False, without a host sync
+    ## they are copied before the step and selected with torch.where after it; a state created by this step is reset to zeros, which is how Adam initializes it
+    def _step_if_finite(self, optimizer, finite):
+        params = [p for group in optimizer.param_groups for p in group["params"] if p.grad is not None]
+        params_before = [p.detach().clone() for p in params]
+        states_before = [{k: v.clone() for k, v in optimizer.state[p].items() if torch.is_tensor(v)} if p in optimizer.state else {} for p in params]
+        optimizer.step()
+        with torch.no_grad():
+            for p, p_before, state_before in zip(params, params_before, states_before):
+                p.copy_(torch.where(finite, p, p_before))
+                for k, v in optimizer.state[p].items():
+                    if torch.is_tensor(v):
+                        v.copy_(torch.where(finite, v, state_before[k] if k in state_before else torch.zeros_like(v)))
 
-                assert len(indx_real_in_vicinity)>=1
-                
-                # print(len(indx_real_in_vicinity))
-                
-                batch_real_indx[j] = np.random.choice(indx_real_in_vicinity, size=1)[0]
+    ## random labels of the consistency regularizers of the G step, drawn in the order of the unfused G step: the shifted labels of L_perturb, then lam, perm_idx and the mixed labels of L_interp
+    def _draw_g_reg_labels(self, batch_target_labels):
+        g_reg_labels = {}
+        if self.lambda_perturb > 0:
+            delta = torch.randn_like(batch_target_labels) * self.sigma_y
+            g_reg_labels["shifted"] = torch.clamp(batch_target_labels + delta, 0.0, 1.0)
+        if self.lambda_interp > 0:
+            batch_size = batch_target_labels.shape[0]
+            lam = torch.rand(batch_size, device=batch_target_labels.device, dtype=batch_target_labels.dtype)
+            perm_idx = torch.randperm(batch_size, device=batch_target_labels.device)
+            g_reg_labels["lam"] = lam
+            g_reg_labels["perm_idx"] = perm_idx
+            g_reg_labels["mix"] = torch.clamp(lam * batch_target_labels + (1 - lam) * batch_target_labels[perm_idx], 0.0, 1.0)
+        return g_reg_labels
 
-                ## labels for fake images generation
-                if self.vicinal_params["threshold_type"] == "hard":
-                    lb = batch_target_labels[j] - self.vicinal_params["kappa"]
-                    ub = batch_target_labels[j] + self.vicinal_params["kappa"]
-                else:
-                    lb = batch_target_labels[j] - np.sqrt(-np.log(self.vicinal_params["nonzero_soft_weight_threshold"])/self.vicinal_params["kappa"])
-                    ub = batch_target_labels[j] + np.sqrt(-np.log(self.vicinal_params["nonzero_soft_weight_threshold"])/self.vicinal_params["kappa"])
-                lb = max(0.0, lb); ub = min(ub, 1.0)
-                assert lb<=ub
-                assert lb>=0 and ub>=0
-                assert lb<=1 and ub<=1
-                batch_fake_labels[j] = np.random.uniform(lb, ub, size=1)[0]
-            #end for j
-            batch_real_labels = self.train_labels[batch_real_indx]
-            batch_real_labels = torch.from_numpy(batch_real_labels).type(torch.float).to(self.device)
-            batch_fake_labels = torch.from_numpy(batch_fake_labels).type(torch.float).to(self.device)
-                        
-            ### Step 2: compute the vicinal weights
-            if self.vicinal_params["threshold_type"]=="hard":
-                real_weights = torch.ones(self.batch_size_disc, dtype=torch.float).to(self.device)
-                fake_weights = torch.ones(self.batch_size_disc, dtype=torch.float).to(self.device)
-            else:
-                batch_target_labels = torch.from_numpy(batch_target_labels).type(torch.float).to(self.device)
-                real_weights = torch.exp(-self.vicinal_params["kappa"]*(batch_real_labels-batch_target_labels)**2).to(self.device)
-                fake_weights = torch.exp(-self.vicinal_params["kappa"]*(batch_fake_labels-batch_target_labels)**2).to(self.device)
-             
-            kappa_l_all = np.ones(self.batch_size_disc)*self.vicinal_params["kappa"] #the left radii of the vicinity for the target labels
-            kappa_r_all = np.ones(self.batch_size_disc)*self.vicinal_params["kappa"] #the right radii of the vicinity for the target labels
-            
-            return batch_real_indx, batch_fake_labels, batch_real_labels, real_weights, fake_weights, kappa_l_all, kappa_r_all
-        
-        ###########################################
-        ## adaptive vicinity
-        else: 
-            ## get the index of real images in the vicinity
-            ## determine the labels used to generate fake images
-            batch_real_indx = np.zeros(self.batch_size_disc, dtype=int)
-            batch_fake_labels = np.zeros(self.batch_size_disc)
-            kappa_l_all = np.zeros(self.batch_size_disc) #the left radii of the vicinity for the target labels
-            kappa_r_all = np.zeros(self.batch_size_disc) #the right radii of the vicinity for the target labels         
-            for j in range(self.batch_size_disc):
-                
-                target_y = batch_target_labels[j]
-                idx_y = np.searchsorted(self.unique_train_labels, target_y, side='left')
-                kappa_l, kappa_r = self.vicinal_params["ada_eps"], self.vicinal_params["ada_eps"]
-                n_got = 0
-                
-                ## case 1: target_y is either the first element of unique_train_labels or smaller than it. Only move toward right
-                if idx_y <= 0:     
-                    idx_l, idx_r = 0, 0
-                    n_got = self.counts_train_elements[idx_r]
-                    kappa_r = np.abs(target_y-self.unique_train_labels[idx_r]) + self.vicinal_params["ada_eps"]
-                    # while n_got<self.vicinal_params["min_n_per_vic"] or (kappa_l+kappa_r)<self.min_abs_diff: #do not have enough samples in the vicinity
-                    loop_counter_warning = 0
-                    while n_got<self.vicinal_params["min_n_per_vic"]: #do not have enough samples in the vicinity
-                        idx_r += 1
-                        n_got += self.counts_train_elements[idx_r]
-                        kappa_r = np.abs(target_y-self.unique_train_labels[idx_r])
-                        if idx_r==(len(self.counts_train_elements)-1):
-                            break
-                        loop_counter_warning+=1
-                        if loop_counter_warning>1e20:
-                            print("\n Detected an infinite loop")
+    ## netG on z and the stacked target, shifted (L_perturb) and mixed (L_interp) labels in one forward, with one fn_y2h call (one spectral-norm power iteration instead of one per label batch); returns the fake images and embedding of the target labels and the dict of the regularizer images
+    def _fused_g_forward(self, z, batch_target_labels, g_reg_labels):
+        names = [name for name in ["shifted", "mix"] if name in g_reg_labels]
+        n = len(batch_target_labels)
+        embed = self.fn_y2h(torch.cat([batch_target_labels]+[g_reg_labels[name] for name in names], dim=0))
+        with chunked_batch_norm(self.netG, 1+len(names)):
+            images = self.netG(z.repeat(1+len(names), 1), embed)
+        g_reg_images = {name: images[(i+1)*n:(i+2)*n] for i, name in enumerate(names)}
+        return images[:n], embed[:n], g_reg_images
 
-                ## case 2: target_y is either the last element of unique_train_labels or larger than it. Only move toward left
-                elif idx_y >= (len(self.unique_train_labels)-1): 
-                    idx_l, idx_r = len(self.unique_train_labels)-1, len(self.unique_train_labels)-1
-                    n_got = self.counts_train_elements[idx_l]
-                    kappa_l = np.abs(target_y-self.unique_train_labels[idx_l]) + self.vicinal_params["ada_eps"]
-                    # assert target_y+kappa_l > self.unique_train_labels[idx_l]
-                    # while n_got<self.vicinal_params["min_n_per_vic"] or (kappa_l+kappa_r)<self.min_abs_diff: #do not have enough samples in the vicinity
-                    loop_counter_warning = 0
-                    while n_got<self.vicinal_params["min_n_per_vic"]: #do not have enough samples in the vicinity
-                        idx_l -= 1
-                        n_got += self.counts_train_elements[idx_l]
-                        kappa_l = np.abs(target_y-self.unique_train_labels[idx_l])
-                        if idx_l==0:
-                            break
-                        loop_counter_warning+=1
-                        if loop_counter_warning>1e20:
-                            print("\n Detected an infinite loop")
-            
-                ## case 3: other cases
-                else:
-                    if target_y in self.unique_train_labels: #target_y appears in the training set
-                        idx_l, idx_r = idx_y-1, idx_y+1
-                        n_got = self.counts_train_elements[idx_y]  
-                        # if n_got>=self.vicinal_params["min_n_per_vic"]:
-                        #     kappa_l, kappa_r = 1e30, 1e30 #Terminate early
-                    else:
-                        idx_l, idx_r = idx_y-1, idx_y
-                        n_got = 0 
-                    
-                    dist2left = np.abs(target_y-self.unique_train_labels[idx_l]) #In unique_train_labels, the distance from target_y to its nearest left label.
-                    dist2right = np.abs(target_y-self.unique_train_labels[idx_r]) #In unique_train_labels, the distance from target_y to its nearest right label.
-                    # while n_got<self.vicinal_params["min_n_per_vic"] or (kappa_l+kappa_r)<self.min_abs_diff: 
-                    loop_counter_warning = 0
-                    while n_got<self.vicinal_params["min_n_per_vic"]: 
-                        if dist2left < dist2right: # If closer to the left label, expand to the left.
-                            kappa_l = dist2left #update kappa_l
-                            n_got += self.counts_train_elements[idx_l] #update n_got
-                            idx_l -= 1 #update idx_l
-                        elif dist2left > dist2right: #If closer to the right label, expand to the right.
-                            kappa_r = dist2right #update kappa_r
-                            n_got += self.counts_train_elements[idx_r] #update n_got
-                            idx_r += 1 #update idx_r
-                        else: #When the distances on both sides are equal, expand in both directions.
-                            kappa_l = dist2left #update kappa_l
-                            kappa_r = dist2right #update kappa_r
-                            n_got += (self.counts_train_elements[idx_l] + self.counts_train_elements[idx_r])
-                            idx_l -= 1 #update idx_l
-                            idx_r += 1 #update idx_r
-                        if idx_l < 0:
-                            dist2left = 1e30 #do not move toward left anymore
-                        else:
-                            dist2left = np.abs(target_y-self.unique_train_labels[idx_l]) #update
-                        if idx_r > len(self.unique_train_labels)-1:
-                            dist2right = 1e30 #do not move toward right anymore
-                        else:
-                            dist2right = np.abs(target_y-self.unique_train_labels[idx_r]) #update
-                        if dist2left > 1e10 and dist2right > 1e10:
-                            break
-                        loop_counter_warning+=1
-                        if loop_counter_warning>1e20:
-                            print("\n Detected an infinite loop")
-                    ##end while n_got          
-                        
-                ##end if idx_y == 0
-                
-                # symmetric adaptive vicinity
-                if self.vicinal_params["use_symm_vic"]:
-                    kappa_l, kappa_r = np.max([kappa_l, kappa_r]), np.max([kappa_l, kappa_r])  #larger
-                    # kappa_l, kappa_r = np.min([kappa_l, kappa_r]), np.min([kappa_l, kappa_r])  #smaller
+    ## compile the graphs of the training loop with one training iteration and undo all of its state changes (weights, buffers, optimizer and grad scaler states, gradients, step and random states); the generator of the visualization in train() is compiled here as well
+    def _compile_warmup(self):
+        device = self.device
+        start = timeit.default_timer()
+        state = copy.deepcopy({
+            "netG": self.netG.state_dict(),
+            "netD": self.netD.state_dict(),
+            "optG": self.optG.state_dict(),
+            "optD": self.optD.state_dict(),
+            "scaler": self.accelerator.scaler.state_dict() if exists(self.accelerator.scaler) else None,
+        })
+        step = self.step
+        rng_states = (torch.get_rng_state(), torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None, np.random.get_state())
+        
+        self.train(warmup=True)
+        if not self.use_ema:
+            self.netG.eval()
+            with torch.inference_mode():
+                self.netG(self.z_visual.to(device), self.fn_y2h(self.y_visual.to(device)))
+            self.netG.train()
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        
+        self.netG.load_state_dict(state["netG"])
+        self.netD.load_state_dict(state["netD"])
+        self.optG.load_state_dict(state["optG"])
+        self.optD.load_state_dict(state["optD"])
+        if exists(state["scaler"]):
+            self.accelerator.scaler.load_state_dict(state["scaler"])
+        self.optG.zero_grad(set_to_none=True)
+        self.optD.zero_grad(set_to_none=True)
+        self.step = step
+        torch.set_rng_state(rng_states[0])
+        if exists(rng_states[1]):
+            torch.cuda.set_rng_state_all(rng_states[1])
+        np.random.set_state(rng_states[2])
+        self.compile_time = timeit.default_timer() - start
 
-                kappa_l_all[j] = kappa_l #left radius for hard vicinity
-                kappa_r_all[j] = kappa_r #right radius for hard vicinity
-                nu_l = 1/kappa_l**2 #decay weight for the left soft vicinity
-                nu_r = 1/kappa_r**2 #decay weight for the right soft vicinity
+    ## split the output dict of a netD forward on concatenated real and fake batches into the dicts of the first n (real) and the remaining (fake) samples
+    def _split_disc_out(self, disc_out_dict, n):
+        real_disc_out_dict = {k: (v[:n] if v is not None else None) for k, v in disc_out_dict.items()}
+        fake_disc_out_dict = {k: (v[n:] if v is not None else None) for k, v in disc_out_dict.items()}
+        return real_disc_out_dict, fake_disc_out_dict
 
-                ## index for real images
-                ### index for HV
-                cond_hard = (self.train_labels>=(target_y-kappa_l)) & (self.train_labels<=(target_y+kappa_r))
-                indx_real_in_hard_vicinity = np.where(cond_hard)[0]         
-                ### index for SV
-                indx_left = np.where(self.train_labels<=target_y)[0]
-                indx_right = np.where(self.train_labels>target_y)[0]
-                indx_real_in_soft_vicinity_left = np.where((self.train_labels-target_y)**2 <= -np.log(self.vicinal_params["nonzero_soft_weight_threshold"])/nu_l)[0]
-                indx_real_in_soft_vicinity_left = np.intersect1d(indx_real_in_soft_vicinity_left, indx_left)
-                indx_real_in_soft_vicinity_right = np.where((self.train_labels-target_y)**2 <= -np.log(self.vicinal_params["nonzero_soft_weight_threshold"])/nu_r)[0]
-                indx_real_in_soft_vicinity_right = np.intersect1d(indx_real_in_soft_vicinity_right, indx_right)
-                indx_real_in_soft_vicinity = np.concatenate([indx_real_in_soft_vicinity_left, indx_real_in_soft_vicinity_right])
-                if self.vicinal_params["ada_vic_type"].lower()=="vanilla":
-                    if self.vicinal_params["threshold_type"] == "hard":
-                        indx_real_in_vicinity = indx_real_in_hard_vicinity               
-                    else:
-                        indx_real_in_vicinity = indx_real_in_soft_vicinity
-                elif self.vicinal_params["ada_vic_type"].lower()=="hybrid":
-                    # indx_real_in_vicinity = np.union1d(indx_real_in_hard_vicinity, indx_real_in_soft_vicinity) # hard in soft, not working
-                    # indx_real_in_vicinity = indx_real_in_hard_vicinity #soft in hard; if soft vicinity with nonzero weights is smaller than hard vicinity, then use hard vicinity and too small soft weights will be replaced by the nonzero_soft_weight_threshold
-                    indx_real_in_vicinity = np.intersect1d(indx_real_in_hard_vicinity, indx_real_in_soft_vicinity) #soft in hard, smaller vicinity
-                else:
-                    raise ValueError('Not supported vicinity type!!!')
-                assert len(indx_real_in_vicinity)>=1
-                batch_real_indx[j] = np.random.choice(indx_real_in_vicinity, size=1)[0]
-                
-                ## labels for fake images generation
-                lb_hard = batch_target_labels[j] - kappa_l
-                ub_hard = batch_target_labels[j] + kappa_r
-                lb_hard = max(0.0, lb_hard); ub_hard = min(ub_hard, 1.0)
-                assert lb_hard<=ub_hard and lb_hard>=0 and lb_hard<=1 and ub_hard>=0 and ub_hard<=1
-                lb_soft = batch_target_labels[j] - np.sqrt(-np.log(self.vicinal_params["nonzero_soft_weight_threshold"])/nu_l)
-                ub_soft = batch_target_labels[j] + np.sqrt(-np.log(self.vicinal_params["nonzero_soft_weight_threshold"])/nu_r)
-                lb_soft = max(0.0, lb_soft); ub_soft = min(ub_soft, 1.0)
-                assert lb_soft<=ub_soft and lb_soft>=0 and lb_soft<=1 and ub_soft>=0 and ub_soft<=1
-                if self.vicinal_params["ada_vic_type"].lower()=="vanilla":
-                    if self.vicinal_params["threshold_type"] == "hard":
-                        lb, ub = lb_hard, ub_hard
-                    else:
-                        lb, ub = lb_soft, ub_soft
-                elif self.vicinal_params["ada_vic_type"].lower()=="hybrid":
-                    # lb, ub = min(lb_hard, lb_soft), max(ub_hard, ub_soft) #hard in soft, not working
-                    # lb, ub = lb_hard, ub_hard #soft in hard
-                    lb, ub = max(lb_hard, lb_soft), min(ub_hard, ub_soft) #soft in hard, smaller vicinity
-                else:
-                    raise ValueError('Not supported vicinity type!!!') 
-                batch_fake_labels[j] = np.random.uniform(lb, ub, size=1)[0]
-            
-            ##end for j
-            batch_real_labels = self.train_labels[batch_real_indx]
-            batch_real_labels = torch.from_numpy(batch_real_labels).type(torch.float).to(self.device)
-            batch_fake_labels = torch.from_numpy(batch_fake_labels).type(torch.float).to(self.device)
-            
-            ## determine vicinal weights for real and fake images              
-            if self.vicinal_params["threshold_type"].lower()=="soft" or self.vicinal_params["ada_vic_type"].lower()=="hybrid":
-                nu_l_all = torch.from_numpy(1/(kappa_l_all)**2).type(torch.float).to(self.device)
-                nu_r_all = torch.from_numpy(1/(kappa_r_all)**2).type(torch.float).to(self.device)
-                batch_target_labels = torch.from_numpy(batch_target_labels).type(torch.float).to(self.device)
-                indx_left_real = torch.where((batch_real_labels-batch_target_labels)<=0)[0]
-                indx_right_real = torch.where((batch_real_labels-batch_target_labels)>0)[0]
-                indx_left_fake = torch.where((batch_fake_labels-batch_target_labels)<=0)[0]
-                indx_right_fake = torch.where((batch_fake_labels-batch_target_labels)>0)[0]
-                real_weights = torch.zeros_like(nu_l_all).type(torch.float).to(self.device)
-                real_weights[indx_left_real] = torch.exp(-nu_l_all[indx_left_real]*(batch_real_labels[indx_left_real]-batch_target_labels[indx_left_real])**2)
-                real_weights[indx_right_real] = torch.exp(-nu_r_all[indx_right_real]*(batch_real_labels[indx_right_real]-batch_target_labels[indx_right_real])**2)
-                fake_weights = torch.zeros_like(nu_r_all).type(torch.float).to(self.device)
-                fake_weights[indx_left_fake] = torch.exp(-nu_l_all[indx_left_fake]*(batch_fake_labels[indx_left_fake]-batch_target_labels[indx_left_fake])**2)
-                fake_weights[indx_right_fake] = torch.exp(-nu_r_all[indx_right_fake]*(batch_fake_labels[indx_right_fake]-batch_target_labels[indx_right_fake])**2)
-                # ## For those weights smaller than threshold, we replace them with the threshold.
-                # if self.vicinal_params["ada_vic_type"].lower()=="hybrid":
-                #     real_weights[real_weights<self.vicinal_params["nonzero_soft_weight_threshold"]] = self.vicinal_params["nonzero_soft_weight_threshold"]
-                #     fake_weights[fake_weights<self.vicinal_params["nonzero_soft_weight_threshold"]] = self.vicinal_params["nonzero_soft_weight_threshold"]
-            elif self.vicinal_params["threshold_type"]=="hard":
-                real_weights = torch.ones(self.batch_size_disc, dtype=torch.float).to(self.device)
-                fake_weights = torch.ones(self.batch_size_disc, dtype=torch.float).to(self.device)
-            else:
-                raise ValueError('Not supported vicinal weight type!!!') 
+    
+    
+    ############################################################################################################################ 
+    ######################################################################################## 
+    ## draw the host side of the batches of one training iteration; rng is np.random or a np.random.Generator
+    def draw_disc_batch(self, rng=np.random):
+        ## randomly draw batch_size_disc y's from unique_train_labels
+        batch_target_labels_in_dataset = rng.choice(self.unique_train_labels, size=self.batch_size_disc, replace=True)
+        ## add Gaussian noise; we estimate image distribution conditional on these labels
+        batch_epsilons = rng.normal(0, self.vicinal_params["kernel_sigma"], self.batch_size_disc)
+        batch_target_labels = batch_target_labels_in_dataset + batch_epsilons
         
-            return batch_real_indx, batch_fake_labels, batch_real_labels, real_weights, fake_weights, kappa_l_all, kappa_r_all
+        ## make vicinity
+        batch = self.make_vicinity_host(batch_target_labels, batch_target_labels_in_dataset, rng)
+        
+        ## draw real image batch from the training set; with data_on_device, images are gathered and augmented on the device instead
+        if self.data_on_device == "off":
+            batch_real_images = self.fn_transform(self.train_images[batch["real_indx"]], rng=None if rng is np.random else rng)
+            batch["real_images"] = normalize_images(batch_real_images, to_neg_one_to_one=True).astype(np.float32)
+        return batch
+    
+    def draw_gene_batch(self, rng=np.random):
+        ## randomly draw batch_size_gene y's from unique_train_labels
+        batch_target_labels_in_dataset = rng.choice(self.unique_train_labels, size=self.batch_size_gene, replace=True)
+        ## add Gaussian noise; we estimate image distribution conditional on these labels
+        batch_epsilons = rng.normal(0, self.vicinal_params["kernel_sigma"], self.batch_size_gene)
+        return batch_target_labels_in_dataset + batch_epsilons
+    
+    def draw_iter_batches(self, rng=np.random):
+        return {
+            "disc": [self.draw_disc_batch(rng) for _ in range(self.num_D_steps*self.num_grad_acc_d)],
+            "gene": [self.draw_gene_batch(rng) for _ in range(self.num_grad_acc_g)],
+        }
         
         
         
@@ -648,24 +679,48 @@ class Trainer(object):
     
     ############################################################################################################################ 
     ######################################################################################## 
-    def train(self):
+    def train(self, warmup=False):
+        '''
+        warmup: run a single iteration without logging, sampling, saving or EMA update (see _compile_warmup)
+        '''
         device = self.accelerator.device
         
+        if self.use_compile and not exists(self.compile_time) and not warmup:
+            self._compile_warmup()
+            print("\n Compile warm-up: {:.1f}s".format(self.compile_time))
+        
         log_filename = os.path.join(self.results_folder, 'log_loss_niters{}.txt'.format(self.niters))
-        if not os.path.isfile(log_filename):
-            logging_file = open(log_filename, "w")
-            logging_file.close()
-        with open(log_filename, 'a') as file:
-            file.write("\n===================================================================================================\n")
+        if not warmup:
+            if not os.path.isfile(log_filename):
+                logging_file = open(log_filename, "w")
+                logging_file.close()
+            with open(log_filename, 'a') as file:
+                file.write("\n===================================================================================================\n")
+                if exists(self.compile_time):
+                    file.write("Compile warm-up: {:.1f}s\n".format(self.compile_time))
 
         start_time = timeit.default_timer()
+        end_step = self.step + 1 if warmup else self.niters
+        
+        ## prepare the batches of the next iterations in the background; each resumed run gets its own seed stream
+        batch_producer = None
+        if self.num_prefetch > 0 and not warmup:
+            batch_producer = BatchProducer(self.draw_iter_batches, num_workers=self.num_workers or 1, num_prefetch=self.num_prefetch, seed=(self.exp_seed, self.step))
+        data_wait_time = 0.0
+        
+        ## losses are summed on the device and only read back when they are printed, so that a step does not wait for the device
+        metrics = DeviceMetrics(["d_adv", "d_reg", "d_dre", "g_adv", "g_reg", "g_dre", "L_perturb", "L_interp", "d_skipped", "g_skipped"], device)
+        log_start_time = timeit.default_timer()
 
-        while self.step < self.niters:
+        while self.step < end_step:
             
-            d_reg_loss_val = 0.0
-            d_dre_loss_val = 0.0
-            g_reg_loss_val = 0.0
-            g_dre_loss_val = 0.0
+            ## batches of this iteration; the time spent here is the data wait of the step
+            data_start_time = timeit.default_timer()
+            if exists(batch_producer):
+                iter_batches = next(batch_producer)
+            else:
+                iter_batches = self.draw_iter_batches()
+            data_wait_time += timeit.default_timer() - data_start_time
             
             ########################################################
             ### Train Discriminator
@@ -673,21 +728,21 @@ class Trainer(object):
             for _ in range(self.num_D_steps):
                 
                 self.netD.train()
+                ## the D step is skipped if any of its accumulated batches has a non-finite d_loss
+                d_step_finite = torch.ones((), dtype=torch.bool, device=device)
 
                 for accumulation_index in range(self.num_grad_acc_d):
                     
-                    ## randomly draw batch_size_disc y's from unique_train_labels
-                    batch_target_labels_in_dataset = np.random.choice(self.unique_train_labels, size=self.batch_size_disc, replace=True)
-                    ## add Gaussian noise; we estimate image distribution conditional on these labels
-                    batch_epsilons = np.random.normal(0, self.vicinal_params["kernel_sigma"], self.batch_size_disc)
-                    batch_target_labels = batch_target_labels_in_dataset + batch_epsilons
-
-                    ## make vicinity
-                    batch_real_indx, batch_fake_labels, batch_real_labels, real_weights, fake_weights, kappa_l_all, kappa_r_all = self.make_vicinity(batch_target_labels, batch_target_labels_in_dataset)
+                    ## target labels, vicinity, fake labels and vicinal weights
+                    batch = iter_batches["disc"].pop(0)
+                    batch_target_labels = batch["target_labels"]
+                    batch_real_indx, batch_fake_labels, batch_real_labels, real_weights, fake_weights, kappa_l_all, kappa_r_all = self._vicinity_to_device(batch)
                     
                     ## draw real image/label batch from the training set
-                    batch_real_images = self.fn_transform(self.train_images[batch_real_indx])
-                    batch_real_images = torch.from_numpy(normalize_images(batch_real_images, to_neg_one_to_one=True)).type(torch.float).to(device)
+                    if "real_images" in batch:
+                        batch_real_images = torch.from_numpy(batch["real_images"]).to(device)
+                    else:
+                        batch_real_images = self._fetch_real_images(batch_real_indx)
                     
                     ## generate the fake image batch
                     # batch_fake_labels = torch.from_numpy(batch_fake_labels).type(torch.float).to(device)
@@ -698,18 +753,27 @@ class Trainer(object):
                     batch_target_labels = torch.from_numpy(batch_target_labels).type(torch.float).to(device)
                 
                     with self.accelerator.autocast():
+                        ## the embedding of the target labels is shared by the real and fake passes
+                        batch_target_embed = self.fn_y2h(batch_target_labels)
+                        
                         # forward pass
-                        if self.use_diffaug:
-                            real_disc_out_dict = self.netD(DiffAugment(batch_real_images, policy=self.diffaug_policy), self.fn_y2h(batch_target_labels))
-                            fake_disc_out_dict = self.netD(DiffAugment(batch_fake_images.detach(), policy=self.diffaug_policy), self.fn_y2h(batch_target_labels))
+                        if self.d_concat_forward:
+                            batch_disc_images = torch.cat([batch_real_images, batch_fake_images.detach()], dim=0)
+                            if self.use_diffaug:
+                                batch_disc_images = DiffAugment(batch_disc_images, policy=self.diffaug_policy)
+                            disc_out_dict = self.netD(batch_disc_images, batch_target_embed.repeat(2, 1))
+                            real_disc_out_dict, fake_disc_out_dict = self._split_disc_out(disc_out_dict, len(batch_real_images))
+                        elif self.use_diffaug:
+                            real_disc_out_dict = self.netD(DiffAugment(batch_real_images, policy=self.diffaug_policy), batch_target_embed)
+                            fake_disc_out_dict = self.netD(DiffAugment(batch_fake_images.detach(), policy=self.diffaug_policy), batch_target_embed)
                         else:
-                            real_disc_out_dict = self.netD(batch_real_images, self.fn_y2h(batch_target_labels))
-                            fake_disc_out_dict = self.netD(batch_fake_images.detach(), self.fn_y2h(batch_target_labels))
+                            real_disc_out_dict = self.netD(batch_real_images, batch_target_embed)
+                            fake_disc_out_dict = self.netD(batch_fake_images.detach(), batch_target_embed)
                         
                         ## compute loss
                         ### adversarial loss
                         d_adv_loss = self.fn_disc_adv_loss(real_adv_out=real_disc_out_dict['adv_output'], fake_adv_out=fake_disc_out_dict['adv_output'], real_weights=real_weights, fake_weights=fake_weights)
-                        d_adv_loss_val = d_adv_loss.item()
+                        metrics.add("d_adv", d_adv_loss)
                         d_loss = d_adv_loss
                         
                         ### auxiliary regression loss
@@ -722,7 +786,7 @@ class Trainer(object):
                                 fake_gt_labels = batch_fake_labels
                             d_reg_loss = self.fn_disc_aux_reg_loss(real_gt_labels=batch_target_labels, real_pred_labels=real_disc_out_dict['reg_output'], fake_gt_labels=fake_gt_labels, fake_pred_labels=fake_disc_out_dict['reg_output'], epsilon=np.maximum(kappa_l_all, kappa_r_all))
                             d_loss += self.aux_loss_params['weight_d_aux_reg_loss'] * d_reg_loss
-                            d_reg_loss_val = d_reg_loss.item()
+                            metrics.add("d_reg", d_reg_loss)
 
                         ### auxiliary dre loss
                         if self.aux_loss_params["use_dre_reg"]:
@@ -730,22 +794,21 @@ class Trainer(object):
                             dr_fake = fake_disc_out_dict["dre_output"]
                             d_dre_loss = self.penalized_softplus_loss(dr_real=dr_real, dr_fake=dr_fake)
                             d_loss += self.aux_loss_params["weight_d_aux_dre_loss"] * d_dre_loss
-                            d_dre_loss_val = d_dre_loss.item()
+                            metrics.add("d_dre", d_dre_loss)
 
                         d_loss /= float(self.num_grad_acc_d)
                     
                     # === 数值稳定性检查：如果 d_loss 本身是 NaN 或 Inf，跳过这个 batch ===
-                    if torch.isnan(d_loss) or torch.isinf(d_loss):
-                        if self.accelerator.is_main_process and divisible_by(self.step, 20):
-                            print("\n[WARNING] Step {}: d_loss is NaN/Inf, skipping this batch.".format(self.step))
-                        continue
-                    
-                    self.accelerator.backward(d_loss)
+                    ## a non-finite d_loss skips the D step on the device (see _step_if_finite); skipped batches are counted and reported with the losses
+                    d_finite = torch.isfinite(d_loss)
+                    metrics.add("d_skipped", (~d_finite).float())
+                    self._backward_if_finite(self.accelerator, d_loss, d_finite, self.netD.parameters())
+                    d_step_finite = d_step_finite & d_finite
                 ##end for 
                 
                 self.accelerator.clip_grad_norm_(self.netD.parameters(), self.max_grad_norm)
                 self.accelerator.wait_for_everyone()
-                self.optD.step()
+                self._step_if_finite(self.optD, d_step_finite)
                 self.optD.zero_grad()
                 self.accelerator.wait_for_everyone()
                 
@@ -788,36 +851,40 @@ class Trainer(object):
             ### Train Generator
             
             self.netG.train()
+            ## the G step is skipped if any of its accumulated batches has a non-finite g_loss
+            g_step_finite = torch.ones((), dtype=torch.bool, device=device)
             
-            # === OOD-增强：初始化损失值变量 ===
-            L_perturb_val = 0.0
-            L_interp_val = 0.0
-           
             for _ in range(self.num_grad_acc_g):
                 
                 # generate fake images
-                ## randomly draw batch_size_gene y's from unique_train_labels
-                batch_target_labels_in_dataset = np.random.choice(self.unique_train_labels, size=self.batch_size_gene, replace=True)
-                ## add Gaussian noise; we estimate image distribution conditional on these labels
-                batch_epsilons = np.random.normal(0, self.vicinal_params["kernel_sigma"], self.batch_size_gene)
-                batch_target_labels = batch_target_labels_in_dataset + batch_epsilons
+                ## target labels drawn from unique_train_labels with Gaussian noise
+                batch_target_labels = iter_batches["gene"].pop(0)
                 batch_target_labels = torch.from_numpy(batch_target_labels).type(torch.float).to(device)
 
                 z = torch.randn(self.batch_size_gene, self.dim_z, dtype=torch.float).to(device)
                 
                 with self.accelerator.autocast():
-                    batch_fake_images = self.netG(z, self.fn_y2h(batch_target_labels))
+                    if self.fuse_g_reg_passes and (self.lambda_perturb > 0 or self.lambda_interp > 0):
+                        ## the labels of L_perturb and L_interp are drawn first, so that the images with gradients come from one netG forward
+                        g_reg_labels = self._draw_g_reg_labels(batch_target_labels)
+                        batch_fake_images, batch_target_embed, g_reg_images = self._fused_g_forward(z, batch_target_labels, g_reg_labels)
+                    else:
+                        ## the embedding of the target labels is computed once and shared by G, D and the L_interp pairs
+                        batch_target_embed = self.fn_y2h(batch_target_labels)
+                        batch_fake_images = self.netG(z, batch_target_embed)
+                        g_reg_labels, g_reg_images = None, {}
 
                     # g loss
                     if self.use_diffaug:
-                        disc_out_dict = self.netD(DiffAugment(batch_fake_images, policy=self.diffaug_policy), self.fn_y2h(batch_target_labels))
+                        disc_out_dict = self.netD(DiffAugment(batch_fake_images, policy=self.diffaug_policy), batch_target_embed)
                     else:
-                        disc_out_dict = self.netD(batch_fake_images, self.fn_y2h(batch_target_labels))
+                        disc_out_dict = self.netD(batch_fake_images, batch_target_embed)
                     
                     ## adv loss
                     g_adv_loss = self.fn_gene_adv_loss(adv_out=disc_out_dict['adv_output'])
-                    g_adv_loss_val = g_adv_loss.item()
+                    metrics.add("g_adv", g_adv_loss)
                     g_loss = g_adv_loss
+                    g_finite = torch.ones((), dtype=torch.bool, device=device)
                     
                     ### auxiliary regression loss
                     if self.aux_loss_params["weight_g_aux_reg_loss"]>0 and (self.aux_loss_params["use_aux_reg_branch"] or self.aux_loss_params["use_aux_reg_model"]):
@@ -827,68 +894,64 @@ class Trainer(object):
                             fake_pred_labels = self.aux_reg_net(batch_fake_images)
                         g_reg_loss = self.fn_gene_aux_reg_loss(fake_gt_labels=batch_target_labels, fake_pred_labels=fake_pred_labels)
                         g_loss += self.aux_loss_params["weight_g_aux_reg_loss"] * g_reg_loss
-                        g_reg_loss_val = g_reg_loss.item()
+                        metrics.add("g_reg", g_reg_loss)
                         
                     ### auxiliary dre penalty
                     if self.aux_loss_params["use_dre_reg"]:
                         g_dre_loss = (disc_out_dict["dre_output"].mean() - 1)**2 #f-divergence when f=(t-1)^2
                         g_loss += self.aux_loss_params["weight_g_aux_dre_loss"] * g_dre_loss
-                        g_dre_loss_val = g_dre_loss.item()
+                        metrics.add("g_dre", g_dre_loss)
                     
+                    if g_reg_labels is None and (self.lambda_perturb > 0 or self.lambda_interp > 0):
+                        g_reg_labels = self._draw_g_reg_labels(batch_target_labels)
 
                     # === OOD-增强：条件扰动一致性正则（L_perturb） ===
                     if self.lambda_perturb > 0:
-                        # 生成随机扰动：从正态分布采样，标准差为sigma_y
-                        delta = torch.randn_like(batch_target_labels) * self.sigma_y
-                        # 对原始标签施加扰动，并裁剪到[0,1]有效范围
-                        batch_target_labels_shifted = torch.clamp(batch_target_labels + delta, 0.0,
-                                                                  1.0)
+                        # 对原始标签施加扰动（标准差为sigma_y），并裁剪到[0,1]有效范围
+                        batch_target_labels_shifted = g_reg_labels["shifted"]
 
                         # x_origin 不需要梯度，detach 掉（因为这是原始生成图像）
                         x_origin = batch_fake_images.detach()
 
                         # x_shifted 保留梯度：用扰动后的标签生成图像
-                        x_shifted = self.netG(z, self.fn_y2h(batch_target_labels_shifted))
+                        x_shifted = g_reg_images.get("shifted")
+                        if x_shifted is None:
+                            x_shifted = self.netG(z, self.fn_y2h(batch_target_labels_shifted))
 
                         # 计算L1距离损失：要求扰动前后的生成图像差异小
                         L_perturb = torch.mean(torch.abs(x_origin - x_shifted))
 
                         # 数值稳定性检查
-                        if not (torch.isnan(L_perturb) or torch.isinf(L_perturb)):
-                            # 将扰动损失加到生成器总损失中
-                            g_loss += self.lambda_perturb * L_perturb
-                            L_perturb_val = L_perturb.item()
-                        else:
-                            L_perturb_val = 0.0
-                    else:
-                        L_perturb_val = 0.0
+                        ## a non-finite L_perturb is left out of g_loss on the device; its gradients are discarded below
+                        g_finite = g_finite & torch.isfinite(L_perturb)
+                        g_loss += self.lambda_perturb * torch.where(torch.isfinite(L_perturb), L_perturb, 0.0)
+                        metrics.add("L_perturb", L_perturb)
 
                     # === OOD-增强：条件插值一致性正则（L_interp） ===
                     if self.lambda_interp > 0:
                         # 获取batch大小
                         batch_size = batch_target_labels.shape[0]
 
-                        # 生成随机插值系数λ，均匀分布在[0,1]之间
-                        lam = torch.rand(batch_size, device=batch_target_labels.device,
-                                         dtype=batch_target_labels.dtype)
-                        # 生成随机排列索引，用于选择配对的标签
-                        perm_idx = torch.randperm(batch_size, device=batch_target_labels.device)
+                        # 随机插值系数λ（均匀分布在[0,1]之间）和随机排列索引（用于选择配对的标签）
+                        lam, perm_idx = g_reg_labels["lam"], g_reg_labels["perm_idx"]
                         # 获取随机配对的标签y_perm
                         y_perm = batch_target_labels[perm_idx]
-                        # 计算插值标签：y_mix = λ*y + (1-λ)*y_perm
-                        y_mix = lam * batch_target_labels + (1 - lam) * y_perm
-                        y_mix = torch.clamp(y_mix, 0.0, 1.0) # 确保在有效范围内
+                        # 插值标签：y_mix = λ*y + (1-λ)*y_perm，并裁剪到[0,1]有效范围
+                        y_mix = g_reg_labels["mix"]
 
                         # ----------- 关键修改：x1、x2 停梯度（No grad） ----------
                         # x1: 原始标签y生成的图像（停梯度）
                         with torch.no_grad():
                             x1 = batch_fake_images.clone()
                             # x2: 随机配对标签y_perm生成的图像（停梯度）
-                            x2 = self.netG(z, self.fn_y2h(y_perm))
+                            ## x2[i] = G(z[i], y_perm[i]) pairs the noise of sample i with the label of sample perm_idx[i], so it is not a permutation of batch_fake_images and needs its own forward
+                            x2 = self.netG(z, batch_target_embed[perm_idx]) #the embedding of y_perm
 
                         # ----------- 只让 x_mix 保留梯度 -------------------------
                         # x_mix: 插值标签y_mix生成的图像（保留梯度）
-                        x_mix = self.netG(z, self.fn_y2h(y_mix))
+                        x_mix = g_reg_images.get("mix")
+                        if x_mix is None:
+                            x_mix = self.netG(z, self.fn_y2h(y_mix))
 
                         # 将λ从1D转换为4D，以便与图像tensor进行广播计算
                         lam_4d = lam.view(batch_size, 1, 1, 1)
@@ -900,59 +963,63 @@ class Trainer(object):
                         L_interp = torch.mean((x_mix - x_lin) ** 2)
 
                         # 数值稳定性检查
-                        if not (torch.isnan(L_interp) or torch.isinf(L_interp)):
-                            g_loss += self.lambda_interp * L_interp
-                            L_interp_val = L_interp.item()
-                        else:
-                            L_interp_val = 0.0
+                        g_finite = g_finite & torch.isfinite(L_interp)
+                        g_loss += self.lambda_interp * torch.where(torch.isfinite(L_interp), L_interp, 0.0)
+                        metrics.add("L_interp", L_interp)
 
                         # 内存优化：释放中间变量
                         del x2, x_mix, x_lin, lam_4d, y_perm, y_mix, lam, perm_idx
-                    else:
-                        L_interp_val = 0.0
 
                     g_loss /= float(self.num_grad_acc_g)
                     
                     # === 数值稳定性检查：如果 g_loss 本身是 NaN 或 Inf，跳过这个 batch ===
                     # 说明：训练后期可能出现梯度爆炸，导致 g_loss 变成 NaN。
                     # 如果直接 backward，会让模型参数也变成 NaN，导致后续训练完全失败。
-                    if torch.isnan(g_loss) or torch.isinf(g_loss):
-                        # 打印警告，但继续训练（跳过这个 batch）
-                        if self.accelerator.is_main_process and divisible_by(self.step, 20):
-                            print("\n[WARNING] Step {}: g_loss is NaN/Inf, skipping this batch.".format(self.step))
-                        # 不执行 backward，直接跳过
-                        continue
-
-                    self.accelerator.backward(g_loss)
+                    ## a non-finite g_loss (or regularizer) skips the G step on the device instead of branching on the host; its netD gradients are zeroed
+                    g_finite = g_finite & torch.isfinite(g_loss)
+                    metrics.add("g_skipped", (~g_finite).float())
+                    self._backward_if_finite(self.accelerator, g_loss, g_finite, list(self.netG.parameters())+list(self.netD.parameters()))
+                    g_step_finite = g_step_finite & g_finite
             ##end for           
             self.accelerator.clip_grad_norm_(self.netG.parameters(), self.max_grad_norm)
             self.accelerator.wait_for_everyone()
-            self.optG.step()
+            self._step_if_finite(self.optG, g_step_finite)
             self.optG.zero_grad()
             self.accelerator.wait_for_everyone()
             
             self.step += 1
             
-            if self.accelerator.is_main_process:
+            if self.accelerator.is_main_process and not warmup:
                 
                 if self.use_ema:
                     self.ema_g.update()
                 
                 # print loss
                 if divisible_by(self.step, 20):
+                    data_wait_ms = data_wait_time/20*1e3 #average data wait per step since the last print
+                    data_wait_time = 0.0
+                    step_ms = (timeit.default_timer()-log_start_time)/20*1e3 #average wall time per step since the last print
+                    log_start_time = timeit.default_timer()
+                    ## mean losses over the steps since the last print; the single host sync of these 20 steps
+                    losses, sums = metrics.read()
+                    d_adv_loss_val, d_reg_loss_val, d_dre_loss_val = losses["d_adv"], losses["d_reg"], losses["d_dre"]
+                    g_adv_loss_val, g_reg_loss_val, g_dre_loss_val = losses["g_adv"], losses["g_reg"], losses["g_dre"]
+                    L_perturb_val, L_interp_val = losses["L_perturb"], losses["L_interp"]
+                    if sums["d_skipped"]>0 or sums["g_skipped"]>0:
+                        print("\n[WARNING] Step {}: skipped {} D and {} G batches with NaN/Inf losses since the last print.".format(self.step, int(sums["d_skipped"]), int(sums["g_skipped"])))
                     # [原始代码] 保留原有格式，添加OOD增强损失项
                     if self.lambda_perturb > 0 or self.lambda_interp > 0:
-                        print ("\n CcGAN,%s,%s: [Iter %d/%d] [D loss: %.3f/%.3f/%.3f] [G loss: %.3f/%.3f/%.3f] [L_perturb: %.4f] [L_interp: %.4f] [Time: %.3f]" % (self.net_name, self.loss_type, self.step, self.niters, d_adv_loss_val, d_reg_loss_val, d_dre_loss_val, g_adv_loss_val, g_reg_loss_val, g_dre_loss_val, L_perturb_val, L_interp_val, timeit.default_timer()-start_time))
+                        print ("\n CcGAN,%s,%s: [Iter %d/%d] [D loss: %.3f/%.3f/%.3f] [G loss: %.3f/%.3f/%.3f] [L_perturb: %.4f] [L_interp: %.4f] [Time: %.3f] [Step: %.1f ms] [Data wait: %.2f ms/step]" % (self.net_name, self.loss_type, self.step, self.niters, d_adv_loss_val, d_reg_loss_val, d_dre_loss_val, g_adv_loss_val, g_reg_loss_val, g_dre_loss_val, L_perturb_val, L_interp_val, timeit.default_timer()-start_time, step_ms, data_wait_ms))
                     else:
-                        print ("\n CcGAN,%s,%s: [Iter %d/%d] [D loss: %.3f/%.3f/%.3f] [G loss: %.3f/%.3f/%.3f] [Time: %.3f]" % (self.net_name, self.loss_type, self.step, self.niters, d_adv_loss_val, d_reg_loss_val, d_dre_loss_val, g_adv_loss_val, g_reg_loss_val, g_dre_loss_val, timeit.default_timer()-start_time))
+                        print ("\n CcGAN,%s,%s: [Iter %d/%d] [D loss: %.3f/%.3f/%.3f] [G loss: %.3f/%.3f/%.3f] [Time: %.3f] [Step: %.1f ms] [Data wait: %.2f ms/step]" % (self.net_name, self.loss_type, self.step, self.niters, d_adv_loss_val, d_reg_loss_val, d_dre_loss_val, g_adv_loss_val, g_reg_loss_val, g_dre_loss_val, timeit.default_timer()-start_time, step_ms, data_wait_ms))
                     
                 if divisible_by(self.step, 500):
                     with open(log_filename, 'a') as file:
                         # [原始代码] 保留原有格式，添加OOD增强损失项
                         if self.lambda_perturb > 0 or self.lambda_interp > 0:
-                            file.write("CcGAN,%s,%s: [Iter %d/%d] [D loss: %.3f/%.3f/%.3f] [G loss: %.3f/%.3f/%.3f] [L_perturb: %.4f] [L_interp: %.4f] [Time: %.3f] \n" % (self.net_name, self.loss_type, self.step, self.niters, d_adv_loss_val, d_reg_loss_val, d_dre_loss_val, g_adv_loss_val, g_reg_loss_val, g_dre_loss_val, L_perturb_val, L_interp_val, timeit.default_timer()-start_time))
+                            file.write("CcGAN,%s,%s: [Iter %d/%d] [D loss: %.3f/%.3f/%.3f] [G loss: %.3f/%.3f/%.3f] [L_perturb: %.4f] [L_interp: %.4f] [Time: %.3f] [Step: %.1f ms] [Data wait: %.2f ms/step] \n" % (self.net_name, self.loss_type, self.step, self.niters, d_adv_loss_val, d_reg_loss_val, d_dre_loss_val, g_adv_loss_val, g_reg_loss_val, g_dre_loss_val, L_perturb_val, L_interp_val, timeit.default_timer()-start_time, step_ms, data_wait_ms))
                         else:
-                            file.write("CcGAN,%s,%s: [Iter %d/%d] [D loss: %.3f/%.3f/%.3f] [G loss: %.3f/%.3f/%.3f] [Time: %.3f] \n" % (self.net_name, self.loss_type, self.step, self.niters, d_adv_loss_val, d_reg_loss_val, d_dre_loss_val, g_adv_loss_val, g_reg_loss_val, g_dre_loss_val, timeit.default_timer()-start_time))
+                            file.write("CcGAN,%s,%s: [Iter %d/%d] [D loss: %.3f/%.3f/%.3f] [G loss: %.3f/%.3f/%.3f] [Time: %.3f] [Step: %.1f ms] [Data wait: %.2f ms/step] \n" % (self.net_name, self.loss_type, self.step, self.niters, d_adv_loss_val, d_reg_loss_val, d_dre_loss_val, g_adv_loss_val, g_reg_loss_val, g_dre_loss_val, timeit.default_timer()-start_time, step_ms, data_wait_ms))
                 
                 if self.step != 0 and divisible_by(self.step, self.sample_freq):
                     if self.use_ema:
@@ -972,7 +1039,10 @@ class Trainer(object):
                     # self.ema_g.ema_model.eval()
                     self.save(milestone)            
  
-        self.accelerator.print('training complete \n')
+        if exists(batch_producer):
+            batch_producer.close()
+        if not warmup:
+            self.accelerator.print('training complete \n')
         ## end while self.step
     ##end def train
     
@@ -1099,21 +1169,27 @@ class Trainer(object):
         self.dre_net.dre_linear.train()
         for step in range(dre_ft_niters):
             ## randomly draw batch_size_disc y's from unique_train_labels
-            batch_real_indx = np.random.choice(np.arange(len(self.train_labels)), size=dre_ft_batch_size, replace=True)
+            if self.data_on_device == "device":
+                batch_real_indx = torch.randint(0, len(self.train_labels), (dre_ft_batch_size,), device=device)
+            else:
+                batch_real_indx = np.random.choice(np.arange(len(self.train_labels)), size=dre_ft_batch_size, replace=True)
 
             ## draw real image/label batch from the training set
-            batch_real_images = self.fn_transform(self.train_images[batch_real_indx])
-            batch_real_images = torch.from_numpy(normalize_images(batch_real_images, to_neg_one_to_one=True)).type(torch.float).to(device)
-            batch_target_labels = torch.from_numpy(self.train_labels[batch_real_indx]).type(torch.float).to(device)
+            batch_real_images = self._fetch_real_images(batch_real_indx)
+            if self.data_on_device == "off":
+                batch_target_labels = torch.from_numpy(self.train_labels[batch_real_indx]).type(torch.float).to(device)
+            else:
+                batch_target_labels = self.train_labels_tensor[torch.as_tensor(batch_real_indx, device=device)]
             
             ## generate the fake image batch
             z = torch.randn(dre_ft_batch_size, self.dim_z, dtype=torch.float).to(device)
-            batch_fake_images = self.netG(z, self.fn_y2h(batch_target_labels))
+            batch_target_embed = self.fn_y2h(batch_target_labels)
+            batch_fake_images = self.netG(z, batch_target_embed)
     
             ## density ratios for real images
-            DR_real = self.dre_net(batch_real_images, self.fn_y2h(batch_target_labels))["dre_output"]
+            DR_real = self.dre_net(batch_real_images, batch_target_embed)["dre_output"]
             ## density ratios for fake images
-            DR_fake = self.dre_net(batch_fake_images, self.fn_y2h(batch_target_labels))["dre_output"]
+            DR_fake = self.dre_net(batch_fake_images, batch_target_embed)["dre_output"]
     
             ## Softplus loss
             softplus_fn = torch.nn.Softplus(beta=1,threshold=20)
@@ -1137,8 +1213,8 @@ class Trainer(object):
             if divisible_by(step+1, 100):
                 self.dre_net.dre_linear.eval()
                 with torch.no_grad():
-                    DR_real2 = self.dre_net(batch_real_images, self.fn_y2h(batch_target_labels))["dre_output"]
-                    DR_fake2 = self.dre_net(batch_fake_images, self.fn_y2h(batch_target_labels))["dre_output"]
+                    DR_real2 = self.dre_net(batch_real_images, batch_target_embed)["dre_output"]
+                    DR_fake2 = self.dre_net(batch_fake_images, batch_target_embed)["dre_output"]
                     print("\n Debug DR real (train): {:.3f}; DR fake (train): {:.3f}".format(DR_real.mean().item(), DR_fake.mean().item()))
                     print("\n Debug DR real (eval): {:.3f}; DR fake (eval): {:.3f}".format(DR_real2.mean().item(), DR_fake2.mean().item()))
                 self.dre_net.dre_linear.train()
@@ -1201,63 +1277,99 @@ class Trainer(object):
         
     ## rejection sampling for one label
     def rejection_sampling_given_label(self, given_label, nfake, nburnin, batch_size=100, verbose=False):
-        # given_label is a value    
-        
-        if batch_size>nfake:
-            batch_size = nfake
-        ## Burn-in Stage
-        burnin_labels = np.ones(nburnin)*given_label
-        burnin_images, _ = self.sample_given_labels(given_labels=burnin_labels, batch_size=np.min([batch_size, nburnin]), denorm=True, to_numpy=True, verbose=False)
-        ### get the maximum density ratio
-        burnin_density_ratios = self.compute_density_ratio(images=burnin_images, labels=burnin_labels, batch_size=np.min([batch_size, nburnin]), to_numpy=True)
-        print((burnin_density_ratios.min(), np.median(burnin_density_ratios), np.mean(burnin_density_ratios), burnin_density_ratios.max()))
-        M_bar = np.max(burnin_density_ratios)
-        
-        ## Rejection sampling
-        if verbose:
-            pb = SimpleProgressBar()
-        enhanced_imgs = []
-        num_imgs = 0
-        while num_imgs < nfake:
-            batch_images, batch_labels = self.sample_given_labels(given_labels=np.ones(batch_size)*given_label, batch_size=batch_size, denorm=True, to_numpy=True, verbose=False)
-            batch_ratios = self.compute_density_ratio(images=batch_images, labels=batch_labels, batch_size=batch_size, to_numpy=True)
-            M_bar = np.max([M_bar, np.max(batch_ratios)])
-            #threshold
-            batch_p = batch_ratios/M_bar
-            batch_psi = np.random.uniform(size=batch_size).reshape(-1,1)
-            indx_accept = np.where(batch_psi<=batch_p)[0]
-            if len(indx_accept)>0:
-                enhanced_imgs.append(batch_images[indx_accept])
-            num_imgs+=len(indx_accept)
-            if verbose:
-                pb.update(np.min([float(num_imgs)*100/nfake,100]))
-        enhanced_imgs = np.concatenate(enhanced_imgs, axis=0)
-        enhanced_imgs = enhanced_imgs[0:nfake]
-        return enhanced_imgs, given_label*np.ones(nfake)         
-    
+        # given_label is a value
+        fake_images, _ = self.rejection_sampling_given_labels(given_label*np.ones(nfake), nburnin_per_label=nburnin, batch_size=batch_size, verbose=verbose)
+        return fake_images, given_label*np.ones(nfake)
+
+    ## generate images for labels (a tensor on the device) and score them with the DRE branch without leaving the device
+    ## images are returned in [-1,1] and are scored before quantization; only accepted images are quantized and copied to the host by the caller
+    ## as in sample_given_labels, NaNs are replaced by the nanmean of the batch, but on the device and without the warning (which would need a host sync); values outside [-1,1] are clamped instead of failing the range assert of sample_given_labels
+    def _sample_and_score(self, labels, dre_net):
+        netG = self.ema_g.ema_model if self.use_ema else self.netG
+        netG.eval()
+        with torch.inference_mode():
+            z = torch.randn(len(labels), self.dim_z, dtype=torch.float, device=labels.device)
+            y_embed = self.fn_y2h(labels.view(-1,1)) #shared by netG and dre_net
+            images = netG(z, y_embed)
+            images = torch.where(torch.isnan(images), torch.nanmean(images), images).clamp(-1.0, 1.0)
+            ratios = dre_net(images, y_embed)["dre_output"]
+        return images, ratios.view(-1).float()
+
     ## rejection sampling for some labels
+    ## all pending labels share mixed-label batches of batch_size, so every generator and DRE forward pass runs at full size; labels are retired once they have enough accepted images
     def rejection_sampling_given_labels(self, given_labels, nburnin_per_label, batch_size=100, verbose=False):
         # given_labels is an array
         print("\n Start rejection sampling...")
         assert isinstance(given_labels, np.ndarray)
         assert given_labels.min()>=0 and given_labels.max()<=1.0
-        unique_labels, counts_elements = np.unique(given_labels, return_counts=True) 
-        fake_images = []
-        fake_labels = []
+        unique_labels, counts_elements = np.unique(given_labels, return_counts=True)
+        num_labels = len(unique_labels)
+        nfake = int(counts_elements.sum())
         start = timeit.default_timer()
-        for i in range(len(unique_labels)):
-            label_i = unique_labels[i]
-            nfake_i = counts_elements[i]
-            print("\n [{}/{}] Start generating {} fake images for label {}.".format(i+1, len(unique_labels), nfake_i, label_i))
-            fake_images_i, fake_labels_i = self.rejection_sampling_given_label(given_label=label_i, nfake=nfake_i, nburnin=nburnin_per_label, batch_size=batch_size, verbose=verbose)
-            assert isinstance(fake_images_i, np.ndarray) and isinstance(fake_labels_i, np.ndarray)
-            assert fake_images_i.max()>1 and fake_images_i.max()<=255.0 and fake_labels_i.min()>=0 and fake_labels_i.max()<=1
-            fake_images.append(fake_images_i)
-            fake_labels.append(fake_labels_i.reshape(-1))
-            print("\n [{}/{}] Finish generating {} fake images for label {}. Time elapses: {}".format(i+1, len(unique_labels), nfake_i, label_i, timeit.default_timer()-start))
-        ##end for i
-        fake_images = np.concatenate(fake_images, axis=0)
-        fake_labels = np.concatenate(fake_labels, axis=0)
+
+        if self.ft_dre_flag:
+            device = self.dre_accelerator.device
+            dre_net = self.dre_net
+        else:
+            device = self.accelerator.device
+            dre_net = self.netD
+        dre_net.eval()
+
+        ## per-label state, kept on the device
+        labels_all = torch.from_numpy(unique_labels).type(torch.float).to(device)
+        counts = torch.from_numpy(counts_elements).to(device)
+        offsets = torch.cumsum(counts, dim=0) - counts #output rows of label i start at offsets[i]
+        M_bar = torch.zeros(num_labels, device=device)
+        sum_ratios = torch.zeros(num_labels, device=device)
+        num_drawn = torch.full((num_labels,), float(nburnin_per_label), device=device)
+        num_got = torch.zeros(num_labels, dtype=torch.long, device=device) #acceptance counters
+
+        ## Burn-in Stage: streaming over nburnin_per_label images per label, keep the per-label maximum density ratio
+        burnin_label_indx = torch.arange(num_labels, device=device).repeat_interleave(nburnin_per_label)
+        for i in range(0, len(burnin_label_indx), batch_size):
+            batch_label_indx = burnin_label_indx[i:(i+batch_size)]
+            _, batch_ratios = self._sample_and_score(labels_all[batch_label_indx], dre_net)
+            M_bar.scatter_reduce_(0, batch_label_indx, batch_ratios, reduce="amax")
+            sum_ratios.index_add_(0, batch_label_indx, batch_ratios)
+        print("\n Burn-in done for {} labels. Time elapses: {}".format(num_labels, timeit.default_timer()-start))
+        print((M_bar.min().item(), M_bar.median().item(), M_bar.mean().item(), M_bar.max().item()))
+
+        ## Rejection sampling
+        if verbose:
+            pb = SimpleProgressBar()
+        fake_images = np.zeros((nfake, self.img_ch, self.img_size, self.img_size), dtype=np.uint8)
+        ones = torch.ones(batch_size, device=device)
+        while True:
+            deficit = counts - num_got
+            num_left = deficit.sum().item()
+            if verbose:
+                pb.update(float(nfake-num_left)*100/nfake)
+            if num_left==0:
+                break
+            ## allocate the slots of a batch to pending labels in proportion to the expected number of draws they still need
+            acc_rate = torch.nan_to_num(sum_ratios/num_drawn/M_bar).clamp(1e-3, 1.0)
+            batch_label_indx = torch.sort(torch.multinomial(deficit/acc_rate, batch_size, replacement=True))[0]
+            batch_images, batch_ratios = self._sample_and_score(labels_all[batch_label_indx], dre_net)
+            M_bar.scatter_reduce_(0, batch_label_indx, batch_ratios, reduce="amax")
+            sum_ratios.index_add_(0, batch_label_indx, batch_ratios)
+            num_drawn.index_add_(0, batch_label_indx, ones)
+            #threshold
+            batch_p = batch_ratios/M_bar[batch_label_indx]
+            batch_psi = torch.rand(batch_size, device=device)
+            indx_accept = torch.nonzero(batch_psi<=batch_p).view(-1)
+            ## write accepted images to the rows of their labels; surplus images of a label are dropped
+            accept_label_indx = batch_label_indx[indx_accept]
+            first = torch.searchsorted(accept_label_indx, accept_label_indx) #batch_label_indx is sorted
+            rank = num_got[accept_label_indx] + torch.arange(len(indx_accept), device=device) - first
+            keep = rank < counts[accept_label_indx]
+            indx_accept, accept_label_indx, rank = indx_accept[keep], accept_label_indx[keep], rank[keep]
+            num_got.index_add_(0, accept_label_indx, torch.ones_like(accept_label_indx))
+            accept_images = (batch_images[indx_accept]*0.5+0.5)*255.0
+            fake_images[(offsets[accept_label_indx]+rank).cpu().numpy()] = accept_images.type(torch.uint8).cpu().numpy()
+        ##end while
+        fake_labels = np.repeat(unique_labels, counts_elements)
+        assert fake_images.max()>1 and fake_images.max()<=255.0 and fake_labels.min()>=0 and fake_labels.max()<=1
+        print("\n Acceptance rate: {:.3f}. Time elapses: {}".format(nfake/(num_drawn.sum().item()-nburnin_per_label*num_labels), timeit.default_timer()-start))
         print('\n End generating fake data!')
         print("\n We got {} fake images.".format(len(fake_images)))
         return fake_images, fake_labels
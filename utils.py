@@ -9,10 +9,14 @@ import torchvision
 import matplotlib.pyplot as plt
 import matplotlib as mpl
 from torch.nn import functional as F
+from torch.nn.utils.spectral_norm import SpectralNorm
 import sys
 import PIL
 from PIL import Image
 import random
+import os
+import hashlib
+import contextlib
 
 
 # ################################################################################
@@ -128,9 +132,9 @@ def predict_class_labels(net, images, batch_size=500, verbose=False, num_workers
 ## transformation on images
 
 ## horizontal flip images
-def random_hflip(batch_images, return_flipped_indx=False):
+def random_hflip(batch_images, return_flipped_indx=False, rng=np.random):
     ''' for numpy arrays '''
-    uniform_threshold = np.random.uniform(0,1,len(batch_images))
+    uniform_threshold = rng.uniform(0,1,len(batch_images))
     indx_gt = np.where(uniform_threshold>0.5)[0]
     batch_images[indx_gt] = np.flip(batch_images[indx_gt], axis=3)
     if return_flipped_indx:
@@ -154,14 +158,14 @@ def normalize_images(batch_images, to_neg_one_to_one=True):
 
 
 ## vertical flip images
-def random_vflip(images, p=0.5):
-    flip_mask = np.random.rand(images.shape[0]) < p
+def random_vflip(images, p=0.5, rng=np.random):
+    flip_mask = rng.uniform(0,1,images.shape[0]) < p
     flipped_images = np.where(flip_mask[:, None, None, None], images[:, :, ::-1, :], images)
     return flipped_images
 
 ## random rotation
-def random_rotate_90_degrees(image):
-    angle = random.choice([0, 90, 180, 270])
+def random_rotate_90_degrees(image, rng=None):
+    angle = random.choice([0, 90, 180, 270]) if rng is None else rng.choice([0, 90, 180, 270])
     if angle == 0:
         return image
     elif angle == 90:
@@ -171,11 +175,24 @@ def random_rotate_90_degrees(image):
     elif angle == 270:
         return np.rot90(image, k=3, axes=(1, 2))
  
-def random_rotate(images):
-    images = np.concatenate([random_rotate_90_degrees(image) for image in images], axis=0)
+def random_rotate(images, rng=None):
+    images = np.concatenate([random_rotate_90_degrees(image, rng) for image in images], axis=0)
     return images[:,np.newaxis,:,:]
 
 
+## the same transformations for torch tensors; random numbers are drawn on the tensor's device so no host sync is needed
+def random_flip_tensor(batch_images, dim, p=0.5):
+    ''' flip along dim=3 (horizontal) or dim=2 (vertical) '''
+    flip_mask = torch.rand(len(batch_images), device=batch_images.device) < p
+    return torch.where(flip_mask[:, None, None, None], torch.flip(batch_images, dims=[dim]), batch_images)
+
+def random_rotate_tensor(batch_images):
+    ''' rotate square images by a random multiple of 90 degrees '''
+    k = torch.randint(0, 4, (len(batch_images),), device=batch_images.device)
+    rotated = torch.stack([torch.rot90(batch_images, k=i, dims=(2, 3)) for i in range(4)], dim=0)
+    return rotated[k, torch.arange(len(batch_images), device=batch_images.device)]
+
+
 
 ###########################################
 # helper functions
@@ -200,6 +217,106 @@ def check_unnormalized_imgs(img):
     return cond1 and cond2
 
 
+_FILE_HASHES = {} #(path, size, mtime) -> sha1 of the file contents
+
+## sha1 of the contents of a file, computed once per process
+def file_hash(path, chunk_size=2**24):
+    stat = os.stat(path)
+    key = (os.path.abspath(path), stat.st_size, stat.st_mtime)
+    if key not in _FILE_HASHES:
+        sha = hashlib.sha1()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(chunk_size), b""):
+                sha.update(chunk)
+        _FILE_HASHES[key] = sha.hexdigest()
+    return _FILE_HASHES[key]
+
+
+###########################################
+# running sums of scalar losses on the device
+## add() only queues device ops; read() copies all sums to the host at once, which is the only host sync
+## non-finite values are left out of the means
+class DeviceMetrics:
+    def __init__(self, names, device):
+        self.index = {name: i for i, name in enumerate(names)}
+        self.sums = torch.zeros(len(names), dtype=torch.float64, device=device)
+        self.counts = torch.zeros(len(names), dtype=torch.float64, device=device)
+        self.num_syncs = 0
+    
+    def add(self, name, value):
+        i = self.index[name]
+        value = value.detach().reshape(()).double()
+        finite = torch.isfinite(value)
+        self.sums[i] += torch.where(finite, value, 0.0)
+        self.counts[i] += finite.double()
+    
+    ## means (0 for metrics without values) and sums since the last read
+    def read(self, reset=True):
+        sums, counts = torch.stack([self.sums, self.counts]).cpu().numpy()
+        self.num_syncs += 1
+        if reset:
+            self.sums.zero_()
+            self.counts.zero_()
+        means = np.where(counts>0, sums/np.maximum(counts, 1), 0.0)
+        return {name: means[i] for name, i in self.index.items()}, {name: sums[i] for name, i in self.index.items()}
+
+
+###########################################
+# stacked forward passes through a model with BatchNorm
+## within the context, every BatchNorm layer of model in training mode normalizes each of num_chunks equal chunks of its input with the chunk's own statistics, and updates its running statistics chunk by chunk;
+## so a forward on num_chunks stacked batches gives the same outputs as num_chunks forwards on the batches one after another
+@contextlib.contextmanager
+def chunked_batch_norm(model, num_chunks):
+    bn_layers = [m for m in model.modules() if isinstance(m, nn.modules.batchnorm._BatchNorm) and m.training]
+    def chunked_forward(forward):
+        return lambda x: torch.cat([forward(x_i) for x_i in x.chunk(num_chunks)], dim=0)
+    if num_chunks > 1:
+        for m in bn_layers:
+            m.forward = chunked_forward(m.forward)
+    try:
+        yield model
+    finally:
+        if num_chunks > 1:
+            for m in bn_layers:
+                del m.forward
+
+
+###########################################
+# torch.compile
+## spectral_norm (the hook-based version used in models/) updates its u and v buffers in place in every training forward; inside an inductor graph this in-place update gives wrong weight gradients and breaks the backward after a second forward.
+## So the power iteration runs eagerly before each call of the compiled module, rebinding u and v to new tensors as eager spectral_norm does with its clones, and the hooks in the graph only divide the weights by the spectral norm estimate.
+class _SpectralNormNoPowerIteration(SpectralNorm):
+    def __call__(self, module, inputs):
+        setattr(module, self.name, self.compute_weight(module, do_power_iteration=False))
+
+@torch._dynamo.disable
+def _spectral_norm_power_iteration(module, inputs):
+    if not module.training:
+        return
+    with torch.no_grad():
+        for m in module.modules():
+            for hook in m._forward_pre_hooks.values():
+                if isinstance(hook, SpectralNorm):
+                    weight_mat = hook.reshape_weight_to_matrix(getattr(m, hook.name + "_orig"))
+                    u, v = getattr(m, hook.name + "_u"), getattr(m, hook.name + "_v")
+                    for _ in range(hook.n_power_iterations):
+                        v = F.normalize(torch.mv(weight_mat.t(), u), dim=0, eps=hook.eps)
+                        u = F.normalize(torch.mv(weight_mat, v), dim=0, eps=hook.eps)
+                    m._buffers[hook.name + "_u"], m._buffers[hook.name + "_v"] = u, v
+
+## torch.compile a module in place (its state dict keeps its keys) for static shapes; each new input shape or mode compiles its own graph once
+def compile_module(module):
+    has_spectral_norm = False
+    for m in module.modules():
+        for hook in m._forward_pre_hooks.values():
+            if isinstance(hook, SpectralNorm):
+                hook.__class__ = _SpectralNormNoPowerIteration
+                has_spectral_norm = True
+    if has_spectral_norm:
+        module.register_forward_pre_hook(_spectral_norm_power_iteration)
+    module.compile(dynamic=False)
+    return module
+
 
 ###########################################
 # extra functions
@@ -0,0 +1,286 @@
+"""
+Batched vicinity engine for CcGAN training.
+
+Given a whole batch of target labels, it finds the real images in the (hard/soft/hybrid, fixed or adaptive) vicinity of every target and draws the labels used to generate fake images, in one vectorized pass.
+Training labels are indexed once: they are sorted, grouped by unique label, and each unique label gets an offset into the sorted order. A vicinity is then a contiguous range of unique labels found by `np.searchsorted`, so the cost per batch no longer grows with the number of training images.
+
+"""
+
+import os
+import numpy as np
+
+
+class VicinityEngine:
+    def __init__(self, train_labels, vicinal_params):
+        """
+        train_labels: normalized training labels, in [0,1]
+        vicinal_params: the dict of vicinal parameters built in main.py
+        """
+        self.train_labels = train_labels
+        self.vicinal_params = vicinal_params
+
+        ## sorted label index: the images with unique_labels[k] are sorted_indx[offsets[k]:offsets[k+1]]
+        self.sorted_indx = np.argsort(train_labels, kind="stable")
+        self.unique_labels, self.counts = np.unique(train_labels, return_counts=True)
+        self.offsets = np.concatenate(([0], np.cumsum(self.counts)))
+
+    ## find the unique labels satisfying `fn_in_vicinity` for each target; the result is a range [idx_start, idx_stop) over unique_labels
+    def _vicinity_range(self, lower, upper, fn_in_vicinity):
+        """
+        lower, upper: approximate bounds of the vicinities
+        fn_in_vicinity: fn_in_vicinity(idx, rows) tells whether unique_labels[idx] is in the vicinity of the targets `rows`
+
+        The vicinity is contiguous in label space, so the searchsorted bounds are only adjusted by one unique label when rounding puts a boundary label on the wrong side. This keeps the selected images identical to the element-wise test.
+        """
+        n_unique = len(self.unique_labels)
+        rows = np.arange(len(lower))
+        idx_start = np.searchsorted(self.unique_labels, lower, side="left")
+        idx_stop = np.searchsorted(self.unique_labels, upper, side="right")
+
+        cond = (idx_start > 0)
+        cond[cond] = fn_in_vicinity(idx_start[cond]-1, rows[cond])
+        idx_start[cond] -= 1
+        cond = (idx_start < idx_stop)
+        cond[cond] = ~fn_in_vicinity(idx_start[cond], rows[cond])
+        idx_start[cond] += 1
+
+        cond = (idx_stop < n_unique)
+        cond[cond] = fn_in_vicinity(idx_stop[cond], rows[cond])
+        idx_stop[cond] += 1
+        cond = (idx_stop > idx_start)
+        cond[cond] = ~fn_in_vicinity(idx_stop[cond]-1, rows[cond])
+        idx_stop[cond] -= 1
+
+        return idx_start, np.maximum(idx_stop, idx_start)
+
+    ## uniformly draw one training image whose label is in unique_labels[idx_start:idx_stop]
+    def _draw_real_indx(self, idx_start, idx_stop, rng):
+        pos_start = self.offsets[idx_start]
+        n_in_vicinity = self.offsets[idx_stop] - pos_start
+        pos = pos_start + np.floor(rng.uniform(0, 1, len(idx_start))*n_in_vicinity).astype(int)
+        pos = np.minimum(pos, pos_start+n_in_vicinity-1)
+        return self.sorted_indx[pos]
+
+    ## precompute the radius table of the adaptive vicinity
+    def build_radius_table(self, path_to_table=None):
+        """
+        The adaptive vicinity of a target y grows from y toward the nearest unique labels until it covers min_n_per_vic images, so it is the smallest ball around y holding a window unique_labels[L:R_L+1] with at least min_n_per_vic images, where R_L only depends on L.
+        The table stores R_L and the window midpoints, which are sorted, so the radii of a batch are found by bisection in O(log U) per target. Targets at or beyond the first/last unique labels only grow inward and use the precomputed one-sided windows.
+        If path_to_table is given, the table is loaded from there when it matches the training labels, and saved there otherwise.
+        """
+        min_n_per_vic = self.vicinal_params["min_n_per_vic"]
+        ada_eps = self.vicinal_params["ada_eps"]
+
+        if path_to_table is not None and os.path.isfile(path_to_table):
+            table = np.load(path_to_table)
+            if np.array_equal(table["unique_labels"], self.unique_labels) and np.array_equal(table["counts"], self.counts) and table["min_n_per_vic"]==min_n_per_vic and table["ada_eps"]==ada_eps:
+                self.radius_table = {k: table[k] for k in table.files}
+                print("\n Loaded the adaptive vicinity radius table from {}".format(path_to_table))
+                return self.radius_table
+
+        n_unique = len(self.unique_labels)
+        cum_counts = self.offsets
+        n_total = cum_counts[-1]
+
+        ## windows growing from the first/last unique label only
+        idx_r_first = min(np.searchsorted(cum_counts[1:], min_n_per_vic, side="left"), n_unique-1)
+        idx_l_last = max(np.sum((n_total-cum_counts[:-1])>=min_n_per_vic)-1, 0)
+
+        ## two-sided windows: unique_labels[L:R_L+1] is the shortest window starting at L with enough images
+        win_left = np.arange(n_unique)
+        win_right = np.searchsorted(cum_counts, cum_counts[win_left]+min_n_per_vic, side="left")-1
+        valid = win_right<=n_unique-1
+        win_left, win_right = win_left[valid], win_right[valid]
+        win_mid = (self.unique_labels[win_left]+self.unique_labels[win_right])/2
+
+        self.radius_table = {
+            "unique_labels": self.unique_labels,
+            "counts": self.counts,
+            "min_n_per_vic": np.array(min_n_per_vic),
+            "ada_eps": np.array(ada_eps),
+            "idx_r_first": np.array(idx_r_first),
+            "idx_l_last": np.array(idx_l_last),
+            "win_left": win_left,
+            "win_right": win_right,
+            "win_mid": win_mid,
+        }
+        if path_to_table is not None:
+            np.savez(path_to_table, **self.radius_table)
+        return self.radius_table
+
+    ## radii of the adaptive vicinities for a batch of target labels
+    def ada_radii(self, batch_target_labels):
+        if not hasattr(self, "radius_table"):
+            self.build_radius_table()
+        table = self.radius_table
+        unique_labels = self.unique_labels
+        n_unique = len(unique_labels)
+        ada_eps = self.vicinal_params["ada_eps"]
+        target_y = np.asarray(batch_target_labels, dtype=float)
+
+        kappa_l_all = np.ones(len(target_y))*ada_eps
+        kappa_r_all = np.ones(len(target_y))*ada_eps
+        idx_y = np.searchsorted(unique_labels, target_y, side="left")
+
+        ## case 1: target_y is either the first element of unique_train_labels or smaller than it. Only move toward right
+        cond = idx_y<=0
+        idx_r = int(table["idx_r_first"])
+        kappa_r_all[cond] = np.abs(target_y[cond]-unique_labels[idx_r]) + (ada_eps if idx_r==0 else 0)
+
+        ## case 2: target_y is either the last element of unique_train_labels or larger than it. Only move toward left
+        cond = (idx_y>=n_unique-1) & (idx_y>0)
+        idx_l = int(table["idx_l_last"])
+        kappa_l_all[cond] = np.abs(target_y[cond]-unique_labels[idx_l]) + (ada_eps if idx_l==n_unique-1 else 0)
+
+        ## case 3: other cases; grow a ball around target_y
+        rows = np.where((idx_y>0) & (idx_y<n_unique-1))[0]
+        if len(rows)>0:
+            t = target_y[rows]
+            win_left, win_right = table["win_left"], table["win_right"]
+            if len(win_left)>0:
+                ## the best window is next to the midpoints bracketing t; nearby candidates are also checked against rounding
+                pos = np.searchsorted(table["win_mid"], t, side="right")
+                cand = np.clip(pos[:,None]+np.arange(-2,2)[None,:], 0, len(win_left)-1)
+                radius = np.maximum(t[:,None]-unique_labels[win_left[cand]], unique_labels[win_right[cand]]-t[:,None])
+                radius = radius.min(axis=1)
+            else:
+                ## not enough images in the whole training set; the vicinity covers all labels
+                radius = np.maximum(t-unique_labels[0], unique_labels[-1]-t)
+            ## unique labels within the radius
+            fn_in_ball = lambda idx, sub: np.abs(t[sub]-unique_labels[idx])<=radius[sub]
+            idx_start, idx_stop = self._vicinity_range(t-radius, t+radius, fn_in_ball)
+            label_l, label_r = unique_labels[idx_start], unique_labels[idx_stop-1]
+            kappa_l_all[rows] = np.where(label_l<t, np.abs(t-label_l), ada_eps)
+            kappa_r_all[rows] = np.where(label_r>t, np.abs(t-label_r), ada_eps)
+
+        # symmetric adaptive vicinity
+        if self.vicinal_params["use_symm_vic"]:
+            kappa_l_all = kappa_r_all = np.maximum(kappa_l_all, kappa_r_all)
+
+        return kappa_l_all, kappa_r_all
+
+    ## make vicinity for a batch of target labels
+    def sample(self, batch_target_labels, batch_target_labels_in_dataset, rng=np.random):
+        """
+        batch_target_labels: target labels with Gaussian noise; for fixed vicinities, the entries with empty vicinities are redrawn in place
+        batch_target_labels_in_dataset: the training labels the targets were drawn from
+        rng: np.random or a np.random.Generator
+
+        Return the indices of the selected real images, the labels for generating fake images, and the left/right radii of the vicinities.
+        """
+        vicinal_params = self.vicinal_params
+        batch_size = len(batch_target_labels)
+        threshold_type = vicinal_params["threshold_type"].lower()
+        log_nonzero_threshold = -np.log(vicinal_params["nonzero_soft_weight_threshold"])
+
+        ###########################################
+        ## fixed vicinity, conventional hard/soft vicinity
+        if not vicinal_params["use_ada_vic"]:
+            kappa = vicinal_params["kappa"]
+            if threshold_type == "hard":
+                radius = kappa
+                fn_in_vicinity = lambda idx, rows: np.abs(self.unique_labels[idx]-batch_target_labels[rows]) <= kappa
+            else:
+                # reverse the weight function for SVDL
+                radius = np.sqrt(log_nonzero_threshold/kappa)
+                fn_in_vicinity = lambda idx, rows: (self.unique_labels[idx]-batch_target_labels[rows])**2 <= log_nonzero_threshold/kappa
+
+            idx_start, idx_stop = self._vicinity_range(batch_target_labels-radius, batch_target_labels+radius, fn_in_vicinity)
+
+            ## if the max gap between two consecutive ordered unique labels is large, some vicinities may be empty; redraw their noise
+            indx_empty = np.where(idx_stop<=idx_start)[0]
+            while len(indx_empty)>0:
+                batch_target_labels[indx_empty] = batch_target_labels_in_dataset[indx_empty] + rng.normal(0, vicinal_params["kernel_sigma"], len(indx_empty))
+                idx_start_j, idx_stop_j = self._vicinity_range(batch_target_labels[indx_empty]-radius, batch_target_labels[indx_empty]+radius, lambda idx, rows: fn_in_vicinity(idx, indx_empty[rows]))
+                idx_start[indx_empty], idx_stop[indx_empty] = idx_start_j, idx_stop_j
+                indx_empty = indx_empty[idx_stop_j<=idx_start_j]
+
+            batch_real_indx = self._draw_real_indx(idx_start, idx_stop, rng)
+
+            ## labels for fake images generation
+            lb = np.maximum(0.0, batch_target_labels - radius)
+            ub = np.minimum(batch_target_labels + radius, 1.0)
+            assert np.all(lb<=ub)
+            assert np.all(lb>=0) and np.all(ub>=0)
+            assert np.all(lb<=1) and np.all(ub<=1)
+            batch_fake_labels = rng.uniform(lb, ub, size=batch_size)
+
+            kappa_l_all = np.ones(batch_size)*kappa #the left radii of the vicinity for the target labels
+            kappa_r_all = np.ones(batch_size)*kappa #the right radii of the vicinity for the target labels
+
+            return batch_real_indx, batch_fake_labels, kappa_l_all, kappa_r_all
+
+        ###########################################
+        ## adaptive vicinity
+        ada_vic_type = vicinal_params["ada_vic_type"].lower()
+        if ada_vic_type not in ["vanilla", "hybrid"]:
+            raise ValueError('Not supported vicinity type!!!')
+
+        kappa_l_all, kappa_r_all = self.ada_radii(batch_target_labels)
+        nu_l_all = 1/kappa_l_all**2 #decay weight for the left soft vicinity
+        nu_r_all = 1/kappa_r_all**2 #decay weight for the right soft vicinity
+
+        ## index for HV
+        hard_lower = batch_target_labels-kappa_l_all
+        hard_upper = batch_target_labels+kappa_r_all
+        fn_in_hard = lambda idx, rows: (self.unique_labels[idx]>=hard_lower[rows]) & (self.unique_labels[idx]<=hard_upper[rows])
+        idx_start_hard, idx_stop_hard = self._vicinity_range(hard_lower, hard_upper, fn_in_hard)
+
+        ## index for SV; labels <= target use the left decay weight and labels > target use the right one
+        thresh_l = log_nonzero_threshold/nu_l_all
+        thresh_r = log_nonzero_threshold/nu_r_all
+        def fn_in_soft(idx, rows):
+            diff = self.unique_labels[idx]-batch_target_labels[rows]
+            return np.where(diff<=0, diff**2<=thresh_l[rows], diff**2<=thresh_r[rows])
+        idx_start_soft, idx_stop_soft = self._vicinity_range(batch_target_labels-np.sqrt(thresh_l), batch_target_labels+np.sqrt(thresh_r), fn_in_soft)
+
+        if ada_vic_type=="vanilla":
+            if threshold_type == "hard":
+                idx_start, idx_stop = idx_start_hard, idx_stop_hard
+            else:
+                idx_start, idx_stop = idx_start_soft, idx_stop_soft
+        else:
+            #soft in hard, smaller vicinity
+            idx_start, idx_stop = np.maximum(idx_start_hard, idx_start_soft), np.minimum(idx_stop_hard, idx_stop_soft)
+        assert np.all(idx_stop>idx_start)
+        batch_real_indx = self._draw_real_indx(idx_start, idx_stop, rng)
+
+        ## labels for fake images generation
+        lb_hard = np.maximum(0.0, batch_target_labels - kappa_l_all)
+        ub_hard = np.minimum(batch_target_labels + kappa_r_all, 1.0)
+        assert np.all(lb_hard<=ub_hard) and np.all(lb_hard>=0) and np.all(lb_hard<=1) and np.all(ub_hard>=0) and np.all(ub_hard<=1)
+        lb_soft = np.maximum(0.0, batch_target_labels - np.sqrt(thresh_l))
+        ub_soft = np.minimum(batch_target_labels + np.sqrt(thresh_r), 1.0)
+        assert np.all(lb_soft<=ub_soft) and np.all(lb_soft>=0) and np.all(lb_soft<=1) and np.all(ub_soft>=0) and np.all(ub_soft<=1)
+        if ada_vic_type=="vanilla":
+            if threshold_type == "hard":
+                lb, ub = lb_hard, ub_hard
+            else:
+                lb, ub = lb_soft, ub_soft
+        else:
+            lb, ub = np.maximum(lb_hard, lb_soft), np.minimum(ub_hard, ub_soft) #soft in hard, smaller vicinity
+        batch_fake_labels = rng.uniform(lb, ub, size=batch_size)
+
+        return batch_real_indx, batch_fake_labels, kappa_l_all, kappa_r_all
+
+    ## vicinal weights of the selected real images and of the fake labels
+    def vicinal_weights(self, batch_target_labels, batch_real_labels, batch_fake_labels, kappa_l_all, kappa_r_all):
+        vicinal_params = self.vicinal_params
+        if not vicinal_params["use_ada_vic"]:
+            ## fixed vicinity, conventional hard/soft vicinity
+            if vicinal_params["threshold_type"]=="hard":
+                return np.ones(len(batch_target_labels)), np.ones(len(batch_target_labels))
+            real_weights = np.exp(-vicinal_params["kappa"]*(batch_real_labels-batch_target_labels)**2)
+            fake_weights = np.exp(-vicinal_params["kappa"]*(batch_fake_labels-batch_target_labels)**2)
+        elif vicinal_params["threshold_type"].lower()=="soft" or vicinal_params["ada_vic_type"].lower()=="hybrid":
+            ## adaptive vicinity; labels on the left of (or equal to) the target use nu_l, labels on the right use nu_r
+            nu_l_all, nu_r_all = 1/kappa_l_all**2, 1/kappa_r_all**2
+            real_diff = batch_real_labels-batch_target_labels
+            fake_diff = batch_fake_labels-batch_target_labels
+            real_weights = np.exp(-np.where(real_diff<=0, nu_l_all, nu_r_all)*real_diff**2)
+            fake_weights = np.exp(-np.where(fake_diff<=0, nu_l_all, nu_r_all)*fake_diff**2)
+        elif vicinal_params["threshold_type"]=="hard":
+            return np.ones(len(batch_target_labels)), np.ones(len(batch_target_labels))
+        else:
+            raise ValueError('Not supported vicinal weight type!!!')
+        return real_weights, fake_weights